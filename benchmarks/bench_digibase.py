@@ -0,0 +1,288 @@
+#! /bin/env python3
+
+"""
+bench_digibase.py - Benchmarks of the digibase readout, decoding and file I/O paths
+------------------------------------------------------------------------------------
+
+Runs against the software emulated digiBase so no hardware is needed. The
+emulator is driven by a frozen clock and its list buffer is filled up front,
+so the readout numbers measure the host side (command dispatch, buffer
+handling, decoding, file writes) rather than the emulated hit generation.
+Results are printed, or written with -o, as JSON so that they can be compared
+between releases:
+
+    $ python benchmarks/bench_digibase.py -o bench-0.3.7.json
+"""
+
+import os, sys, json, platform, tempfile
+from argparse import ArgumentParser
+from datetime import datetime
+from time import perf_counter
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import digibase
+
+class FrozenClock:
+    "Emulator time source that only moves when told to"
+    def __init__(self):
+        self.t = 0.0
+
+    def __call__(self):
+        return self.t
+
+def make_base(rate=1e6, buffer_size=1 << 20):
+    clock = FrozenClock()
+    emu = digibase.digiBaseEmulator(serial='1', rate=rate, configured=True,
+                                    buffer_size=buffer_size, clock=clock, seed=1)
+    base = digibase.digiBase(transport=emu)
+    base.lld = 0
+    return base, clock
+
+def filled_list_mode_base(nwords):
+    "A base in list mode with (about) nwords waiting in its list buffer"
+    base, clock = make_base(buffer_size=nwords)
+    base.set_acq_mode_list()
+    base.start()
+    clock.t += 2 * nwords / base.transport.rate
+    base.transport._advance()
+    return base
+
+def latency_stats(dt):
+    dt = np.asarray(dt) * 1e6
+    return {
+        'calls': len(dt),
+        'mean_us': float(dt.mean()),
+        'median_us': float(np.median(dt)),
+        'p99_us': float(np.percentile(dt, 99)),
+    }
+
+def time_calls(fn, n):
+    dt = np.empty(n)
+    for i in range(n):
+        t0 = perf_counter()
+        fn()
+        dt[i] = perf_counter() - t0
+    return latency_stats(dt)
+
+def bench_hits(nwords):
+    "Drain the list buffer through the tuple-returning hits property"
+    base = filled_list_mode_base(nwords)
+    total = 0
+    t0 = perf_counter()
+    while len(h := base.hits) > 0: total += len(h)
+    dt = perf_counter() - t0
+    return {'words': total, 'seconds': dt, 'words_per_s': total / dt}
+
+def bench_hits_array(nwords):
+    "Drain the list buffer through hits_array()"
+    base = filled_list_mode_base(nwords)
+    total = 0
+    t0 = perf_counter()
+    while len(h := base.hits_array()) > 0: total += len(h)
+    dt = perf_counter() - t0
+    return {'words': total, 'seconds': dt, 'words_per_s': total / dt}
+
+def bench_hits_burst(nwords, depth=4):
+    "Drain the list buffer with several requests in flight through hits_burst()"
+    base = filled_list_mode_base(nwords)
+    total = 0
+    t0 = perf_counter()
+    while True:
+        n = 0
+        for h in base.hits_burst(depth): n += len(h)
+        if n == 0: break
+        total += n
+    dt = perf_counter() - t0
+    return {'words': total, 'seconds': dt, 'words_per_s': total / dt, 'depth': depth}
+
+def bench_acq_write(nwords):
+    "Drain the list buffer through a ListModeStream into a DBLM file, as acq does"
+    base = filled_list_mode_base(nwords)
+    expected = base.transport._nbuffer
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'bench.dblm')
+        total = 0
+        t0 = perf_counter()
+        with open(filename, 'wb') as f:
+            f.write(b'DBLM\x00\x00\x00\x00' + bytes(24))
+            stream = base.list_mode_stream()
+            stream.start()
+            for block in stream:
+                total += len(block)
+                f.write(block)
+                if total >= expected: stream.stop()
+        dt = perf_counter() - t0
+        nbytes = os.path.getsize(filename)
+    return {'words': total, 'seconds': dt, 'words_per_s': total / dt,
+            'bytes_written': nbytes, 'high_water': stream.high_water}
+
+def bench_spectrum(n):
+    "Latency of a PHA spectrum read"
+    base, clock = make_base()
+    base.set_acq_mode_pha()
+    base.start()
+    clock.t += 1.0
+    return {
+        'spectrum': time_calls(lambda: base.spectrum, n),
+        'spectrum_array': time_calls(base.spectrum_array, n),
+    }
+
+def bench_status(n):
+    "Status register round trips"
+    base, clock = make_base()
+    def configure():
+        with base.configure():
+            base.hv = 800
+            base.lld = 24
+            base.fine_gain = 0.5
+            base.ext_gate = digibase.ExtGateMode.OFF
+    def setters():
+        base.hv = 800
+        base.lld = 24
+        base.fine_gain = 0.5
+        base.ext_gate = digibase.ExtGateMode.OFF
+    return {
+        'read': time_calls(base.read_status_register, n),
+        'write': time_calls(base.write_status_register, n),
+        'four_setters': time_calls(setters, n),
+        'four_setters_configure': time_calls(configure, n),
+    }
+
+def bench_decode(nwords):
+    "HitDecoder throughput, in chunks as they come off the device and in one go"
+    base = filled_list_mode_base(nwords)
+    words = np.frombuffer(base.transport._buffer.tobytes(), dtype=np.uint32)
+    result = {}
+    for chunk in (1024, 1 << 16, len(words)):
+        decoder = digibase.HitDecoder()
+        t0 = perf_counter()
+        for i in range(0, len(words), chunk):
+            decoder.decode(words[i:i+chunk])
+        dt = perf_counter() - t0
+        result[f'chunk_{chunk}'] = {'words': len(words), 'seconds': dt,
+                                    'words_per_s': len(words) / dt}
+    return result
+
+def bench_histogram(nwords):
+    "ListModeHistogrammer throughput into 1 ms and into 1 s slices"
+    base = filled_list_mode_base(nwords)
+    words = np.frombuffer(base.transport._buffer.tobytes(), dtype=np.uint32)
+    t_end = int(digibase.decode_hits(words)[0][-1])
+    result = {}
+    for width in (1_000, 1_000_000):
+        h = digibase.ListModeHistogrammer(np.arange(0, t_end + width, width))
+        t0 = perf_counter()
+        for i in range(0, len(words), 1 << 20):
+            h.add_words(words[i:i + (1 << 20)])
+        dt = perf_counter() - t0
+        result[f'slice_{width}us'] = {'words': len(words), 'slices': len(h.spectra),
+                                      'seconds': dt, 'words_per_s': len(words) / dt}
+    return result
+
+def bench_coincidence(nhits, nbases=3):
+    "CoincidenceBuilder throughput on nhits hits per base fed in 1 Mi word chunks"
+    rng = np.random.default_rng(1)
+    t = [np.sort(rng.integers(0, 10 * nhits, nhits)) for i in range(nbases)]
+    adc = [rng.integers(0, 1024, nhits).astype(np.uint16) for i in range(nbases)]
+    cb = digibase.CoincidenceBuilder(nbases, window=1, offsets=[0, 5, -5][:nbases])
+    ngroups = 0
+    t0 = perf_counter()
+    for j in range(0, nhits, 1 << 20):
+        for i in range(nbases):
+            cb.add(i, t[i][j:j + (1 << 20)], adc[i][j:j + (1 << 20)])
+        ngroups += cb.pop().ngroups
+    ngroups += cb.finish().ngroups
+    dt = perf_counter() - t0
+    return {'hits': nhits * nbases, 'groups': ngroups, 'seconds': dt,
+            'hits_per_s': nhits * nbases / dt}
+
+def bench_read_spectrum(nfiles):
+    "Read back DBKG spectrum files one by one with read_background and in bulk with read_spectra"
+    rng = np.random.default_rng(1)
+    with tempfile.TemporaryDirectory() as tmp:
+        filenames = [os.path.join(tmp, f'bkg-{i:05d}.dat') for i in range(nfiles)]
+        for filename in filenames:
+            digibase.write_background(filename, rng.poisson(100, 1024), 1.0,
+                                      'benchmark', serial=1, hv=800, disc=20)
+        t0 = perf_counter()
+        for filename in filenames:
+            digibase.read_background(filename)
+        dt = perf_counter() - t0
+        t0 = perf_counter()
+        digibase.read_spectra(os.path.join(tmp, 'bkg-*.dat'))
+        dt_bulk = perf_counter() - t0
+    return {'files': nfiles, 'seconds': dt, 'files_per_s': nfiles / dt,
+            'read_spectra_seconds': dt_bulk, 'read_spectra_files_per_s': nfiles / dt_bulk}
+
+def bench_analyze(nhits):
+    "analyze_list_mode of a raw word file into 1 s slices, in process and on all cores"
+    rng = np.random.default_rng(1)
+    t = np.sort(rng.integers(0, nhits * 100, nhits))
+    adc = rng.integers(0, 1024, nhits).astype(np.uint32)
+    words = (adc << 21) | (t & 0x1f_ffff).astype(np.uint32)
+    bounds = np.arange(1, t[-1] // (1 << 21) + 1, dtype=np.int64) << 21
+    rollover = (0x8000_0000 | (bounds & 0x7fff_ffff)).astype(np.uint32)
+    words = np.insert(words, np.searchsorted(t, bounds), rollover)
+    result = {'hits': nhits, 'cores': os.cpu_count()}
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'bench.dblm')
+        with open(filename, 'wb') as f:
+            f.write(b'DBLM\x00\x00\x00\x00' + bytes(24))
+            f.write(words.tobytes())
+        for name, jobs in (('jobs_1', 1), ('jobs_all', None)):
+            t0 = perf_counter()
+            digibase.analyze_list_mode(filename, width=1.0, jobs=jobs)
+            dt = perf_counter() - t0
+            result[name] = {'seconds': dt, 'hits_per_s': nhits / dt}
+    result['speedup'] = result['jobs_1']['seconds'] / result['jobs_all']['seconds']
+    return result
+
+BENCHMARKS = {
+    'hits':          (bench_hits, 1 << 20),
+    'hits_array':    (bench_hits_array, 1 << 22),
+    'hits_burst':    (bench_hits_burst, 1 << 22),
+    'acq_write':     (bench_acq_write, 1 << 22),
+    'spectrum':      (bench_spectrum, 2000),
+    'status':        (bench_status, 2000),
+    'decode':        (bench_decode, 1 << 24),
+    'histogram':     (bench_histogram, 1 << 24),
+    'coincidence':   (bench_coincidence, 1 << 22),
+    'read_spectrum': (bench_read_spectrum, 2000),
+    'analyze':       (bench_analyze, 1 << 25),
+}
+
+def main():
+    parser = ArgumentParser(description='Benchmarks of digibase hot paths')
+    parser.add_argument('-o', '--output', help='Write JSON results to this file')
+    parser.add_argument('-s', '--scale', type=float, default=1.0,
+                        help='Scale the problem sizes, e.g. 0.1 for a quick run')
+    parser.add_argument('names', nargs='*', 
+                        help='Benchmarks to run (default all): ' + ', '.join(BENCHMARKS))
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS: parser.error(f'Unknown benchmark {name}')
+
+    results = {}
+    for name in args.names or BENCHMARKS:
+        fn, size = BENCHMARKS[name]
+        print(f'Running {name} ...', file=sys.stderr)
+        results[name] = fn(max(int(size * args.scale), 1))
+
+    report = {
+        'digibase_version': digibase.__version__,
+        'timestamp': datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f: f.write(text + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -44,18 +44,21 @@ accessed in this class as a 640-bit register. Known subfields are:
     608     Clear counters
 """
 
-import usb.core
-import usb.util
 from array import array
 import sys, os
-from argparse import ArgumentParser
-from time import sleep
+from glob import glob
+from time import sleep, monotonic, perf_counter, time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, lru_cache
 from datetime import datetime, timedelta
 import numpy as np
-from struct import pack, unpack
+from struct import pack, unpack, calcsize
+import zlib, gzip
 import logging
 from enum import Enum
-from typing import Any
+from typing import Any, NamedTuple
+from contextlib import contextmanager, nullcontext
 
 __version__ = '0.3.7'
 
@@ -158,50 +161,340 @@ class ExtGateMode(Enum):
     COINCIDENCE = 1
     ENABLED = 3
 
+class StatusSnapshot(NamedTuple):
+    "Decoded status register fields from a single register read"
+    livetime: float
+    realtime: float
+    livetime_preset: float
+    realtime_preset: float
+    busy: bool
+    hv: float
+    hv_enabled: bool
+    fine_gain: float
+    lld: int
+    uld: int
+    pw: float
+    ext_gate: ExtGateMode
+    livetime_preset_enabled: bool = False
+    realtime_preset_enabled: bool = False
+
+    @property
+    def remaining(self) -> float:
+        """
+        Least time, in seconds, until an enabled preset stops the 
+        acquisition (the livetime counter never runs faster than the
+        realtime counter); None without presets
+        """
+        left = []
+        if self.livetime_preset_enabled: left.append(self.livetime_preset - self.livetime)
+        if self.realtime_preset_enabled: left.append(self.realtime_preset - self.realtime)
+        return min(left) if left else None
+
+# Status register fields checked by configure(verify=True)
+CONFIG_FIELDS = {
+    'pha_mode':         slice(0, 1),
+    'livetime_enable':  slice(2, 3),
+    'realtime_enable':  slice(3, 4),
+    'auto_stabilize':   slice(4, 6),
+    'hv_enabled':       slice(6, 7),
+    'pw':               slice(16, 24),
+    'ext_gate':         slice(56, 64),
+    'lld':              slice(170, 180),
+    'livetime_preset':  slice(192, 224),
+    'realtime_preset':  slice(256, 288),
+    'hv':               slice(336, 352),
+}
+
+class SpectrumSnapshot(NamedTuple):
+    "Spectrum and the counters read around it; see digiBase.spectrum_snapshot()"
+    spectrum: np.ndarray    # Counts per channel
+    livetime: float         # Seconds
+    realtime: float         # Seconds
+    time: float             # POSIX timestamp of the spectrum read
+    skew: float             # Seconds the counters ran while the snapshot was taken
+
+    def since(self, previous: 'SpectrumSnapshot') -> 'SpectrumSnapshot':
+        """
+        The interval from a previous snapshot to this one. Its skew is
+        the sum of both, the time over which counts may have been
+        attributed to the wrong side of the interval boundaries.
+        """
+        return SpectrumSnapshot(
+            self.spectrum.astype(np.int64) - previous.spectrum,
+            self.livetime - previous.livetime,
+            self.realtime - previous.realtime,
+            self.time, self.skew + previous.skew
+        )
+
+class Metrics:
+    """
+    Registry of performance metrics of a digiBase: latency histograms
+    per command (status read/write, spectrum, hits, ...) and for file
+    writes, byte/hit/empty poll counters and an estimate of the list 
+    buffer occupancy. Pass one to digiBase(metrics=...); without a 
+    registry nothing is recorded.
+
+    >>> metrics = Metrics(callback=print, interval=10.0)
+    >>> base = digiBase(metrics=metrics)
+    >>> metrics.serve(9100)     # Text exposition on http://127.0.0.1:9100/metrics
+
+    Parameters
+    ----------
+    callback : callable, optional
+        Called with snapshot() (rates over the reporting interval) every
+        interval seconds, from the thread that records the metrics - 
+        keep it short
+    interval : float
+        Reporting interval of the callback, seconds
+    list_buffer_words : int
+        Size of the device list buffer, for the occupancy estimate
+    """
+    BUCKETS = (1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 1.0)
+    COUNTERS = ('bytes_written', 'bytes_read', 'list_words', 'hits', 'empty_polls')
+
+    def __init__(self, callback=None, interval: float=10.0, list_buffer_words: int=32768):
+        self.callback = callback
+        self.interval = interval
+        self.list_buffer_words = list_buffer_words
+        self.serial = None
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.start_time = monotonic()
+            self.commands = {}      # Command -> [bucket counts, sum, count]
+            self.timers = {}        # Host side timings, e.g. file_write
+            self.counters = dict.fromkeys(Metrics.COUNTERS, 0)
+            self.gauges = {'list_buffer_occupancy': 0.0, 'list_buffer_occupancy_max': 0.0}
+            self._last_report = self.start_time
+            self._last_counters = dict(self.counters)
+
+    @staticmethod
+    def _observe(histograms, name, seconds):
+        h = histograms.get(name)
+        if h is None: h = histograms[name] = [[0] * (len(Metrics.BUCKETS) + 1), 0.0, 0]
+        i = 0
+        for le in Metrics.BUCKETS:
+            if seconds <= le: break
+            i += 1
+        h[0][i] += 1
+        h[1] += seconds
+        h[2] += 1
+
+    def command(self, name: str, seconds: float, written: int=0, read: int=0):
+        "Record one device command round trip"
+        with self._lock:
+            Metrics._observe(self.commands, name, seconds)
+            self.counters['bytes_written'] += written
+            self.counters['bytes_read'] += read
+        self._maybe_report()
+
+    def list_read(self, words):
+        "Record one list mode read (the words read)"
+        n = len(words)
+        with self._lock:
+            if n == 0: 
+                self.counters['empty_polls'] += 1
+            else:
+                self.counters['list_words'] += n
+                self.counters['hits'] += int(np.count_nonzero(words < HitDecoder.ROLLOVER))
+
+    def list_buffer(self, words: int):
+        "Record the words drained from the list buffer in one poll cycle"
+        occupancy = words / self.list_buffer_words
+        with self._lock:
+            self.gauges['list_buffer_occupancy'] = occupancy
+            self.gauges['list_buffer_occupancy_max'] = max(
+                occupancy, self.gauges['list_buffer_occupancy_max'])
+
+    @contextmanager
+    def timed(self, name: str):
+        "Time the enclosed block into the histogram name, e.g. 'file_write'"
+        t0 = monotonic()
+        try:
+            yield
+        finally:
+            dt = monotonic() - t0
+            with self._lock: Metrics._observe(self.timers, name, dt)
+
+    def _maybe_report(self):
+        if self.callback is None: return
+        now = monotonic()
+        if now - self._last_report < self.interval: return
+        with self._lock:
+            since, last = self._last_report, self._last_counters
+            self._last_report, self._last_counters = now, dict(self.counters)
+        self.callback(self.snapshot(since, last))
+
+    def snapshot(self, since: float=None, last: dict=None) -> dict:
+        """
+        The metrics as a dict: counters, gauges, per second rates of the
+        counters (since the start, or since the monotonic time since when
+        the counters were last) and histogram summaries.
+        """
+        with self._lock:
+            now = monotonic()
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            hists = {'command': {k: (list(v[0]), v[1], v[2]) for k, v in self.commands.items()},
+                     'timer': {k: (list(v[0]), v[1], v[2]) for k, v in self.timers.items()}}
+        if since is None: since, last = self.start_time, dict.fromkeys(counters, 0)
+        dt = max(now - since, 1e-9)
+        return {
+            'serial': self.serial,
+            'elapsed': now - self.start_time,
+            'counters': counters,
+            'rates': {k + '_per_s': (counters[k] - last[k]) / dt for k in counters},
+            'gauges': gauges,
+            'commands': {k: Metrics._summary(*v) for k, v in hists['command'].items()},
+            'timers': {k: Metrics._summary(*v) for k, v in hists['timer'].items()},
+        }
+
+    @staticmethod
+    def _summary(counts, total, n) -> dict:
+        "Count, mean and bucket upper bounds of the median and 99th percentile"
+        def quantile(q):
+            c = np.cumsum(counts)
+            i = int(np.searchsorted(c, q * n, side='left'))
+            return Metrics.BUCKETS[i] if i < len(Metrics.BUCKETS) else float('inf')
+        return {'count': n, 'mean': total / n if n else 0.0, 
+                'p50_le': quantile(0.5) if n else 0.0, 'p99_le': quantile(0.99) if n else 0.0}
+
+    def exposition(self) -> str:
+        "The metrics in the Prometheus text exposition format"
+        with self._lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            hists = [('command', self.commands), ('timer', self.timers)]
+            hists = [(kind, {k: (list(v[0]), v[1], v[2]) for k, v in h.items()}) for kind, h in hists]
+        label = f'serial="{self.serial}"' if self.serial is not None else ''
+        def labels(*extra):
+            return '{' + ','.join(x for x in (label,) + extra if x) + '}'
+        lines = []
+        for kind, h in hists:
+            metric = f'digibase_{kind}_seconds'
+            lines.append(f'# TYPE {metric} histogram')
+            for name, (counts, total, n) in sorted(h.items()):
+                tag = f'{kind}="{name}"'
+                cum = 0
+                for le, c in zip(Metrics.BUCKETS + ('+Inf',), counts):
+                    cum += c
+                    bound = f'le="{le}"'
+                    lines.append(f'{metric}_bucket{labels(tag, bound)} {cum}')
+                lines.append(f'{metric}_sum{labels(tag)} {total}')
+                lines.append(f'{metric}_count{labels(tag)} {n}')
+        for name, value in counters.items():
+            lines.append(f'# TYPE digibase_{name}_total counter')
+            lines.append(f'digibase_{name}_total{labels()} {value}')
+        for name, value in gauges.items():
+            lines.append(f'# TYPE digibase_{name} gauge')
+            lines.append(f'digibase_{name}{labels()} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, port: int=9100, host: str='127.0.0.1'):
+        """
+        Serve exposition() at http://host:port/metrics from a daemon 
+        thread; shutdown() the returned server to stop.
+        """
+        from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.exposition().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, name='digiBase-metrics', daemon=True).start()
+        return server
+
+
+@lru_cache(maxsize=None)
+def _read_firmware(path) -> bytes:
+    "Firmware bitstream, read from disk once per process"
+    with open(path, 'rb') as f:
+        return f.read()
+
+
 class digiBase:
     VENDOR_ID: int  = 0x0a2d
 
-    def __init__(self, serialNumber=None):
+    def __init__(self, serialNumber=None, max_age: float=None, transport=None, 
+                 metrics: Metrics=None, fast_attach: bool=False):
+        """
+        Open a digiBase.
 
+        Parameters
+        ----------
+        serialNumber : str or int
+            S/N of the device to open; the first device found if None
+        max_age : float
+            If not None, property getters use a cached copy (shadow) of
+            the status register that is up to max_age seconds old instead
+            of reading the register every time. Use refresh() to force a
+            read.
+        transport : object
+            Transport carrying the device commands; a UsbTransport for
+            the device with the given serial number if None. Anything
+            providing the same interface can be used, for example a 
+            digiBaseEmulator.
+        metrics : Metrics
+            Registry recording command latencies, throughput and list
+            buffer occupancy; nothing is recorded if None
+        fast_attach : bool
+            Attach to a device that already has its firmware without
+            resetting it or pulsing the HV readback (bit 610), e.g. to 
+            reconnect a running base. Falls back to a USB reset if the
+            device does not answer. The time taken is in attach_time.
+        """
+        t0 = perf_counter()
         self.log = logging.getLogger('digiBase')
-        self.dev = None
+        self.transport = None
+        self.metrics = metrics
 
-        if serialNumber is None:
-            self.dev = usb.core.find(idVendor=digiBase.VENDOR_ID)
-        else:
-            # Find all devices and match serial number
-            if not isinstance(serialNumber, str): serialNumber = str(serialNumber)
-            for dev in usb.core.find(idVendor=digiBase.VENDOR_ID, find_all=True):
-                sn = dev.serial_number.strip('\x00')
-                self.log.debug(f'Bus {dev.bus:03d} Device {dev.address:03d}: '
-                               f'ID {dev.idVendor:04x}:{dev.idProduct:04x} '
-                               ' S/N', sn)
-                if sn == serialNumber:
-                    self.dev = dev
-                    break
-
-        if self.dev is None: raise ValueError("Device not found")
-        self.log.info(f'Found ORTEC digiBase device {self.dev.idVendor:04x}:{self.dev.idProduct:04x}')
-        self.isRH = self.dev.idProduct == 0x001f
-
-        self.dev.reset()
-        self.dev.set_configuration()
-        self.serial = usb.util.get_string(self.dev, self.dev.iSerialNumber).rstrip('\x00')
-        cfg = self.dev.get_active_configuration()
+        # Shadow status register caching and batching state
+        self.max_age = max_age
+        self._status_time = float('-inf')
+        self._batch = 0
+        self._dirty = False
 
-        # Determine whether device needs firmware bitstream 
-        if self.isRH:
-            # Write out a START (0x06, 0x00, 0x02, 0x00)
-            r = self.send_command(b'\x06\x00\x02\x00', init=True)
-            needs_init = (r[0] == 4 and r[1] == 0x80)
-        else:
-            r = self.send_command(b'\x06')
-            needs_init = (r[0] == 0)
+        # Serializes command / response pairs across threads
+        self._lock = threading.RLock()
+
+        # Preallocated readout buffers for spectrum_array() and hits_array()
+        self._spectrum_buffer = array('B', bytes(5000))
+        self._hits_buffer = array('B', bytes(132_000))
+        self._burst_buffers = []
+
+        if transport is None: transport = UsbTransport.find(serialNumber, reset=not fast_attach)
+        self.transport = transport
+        self.log.info(f'Found ORTEC digiBase device {digiBase.VENDOR_ID:04x}:{transport.idProduct:04x}')
+        self.isRH = transport.idProduct == 0x001f
+
+        transport.open()
+        self.serial = transport.serial
+        if metrics is not None and metrics.serial is None: metrics.serial = self.serial
+
+        try:
+            needs_init = self._needs_firmware()
+        except IOError:
+            if not (fast_attach and isinstance(transport, UsbTransport)): raise
+            self.log.warning(f'S/N {self.serial} not answering, resetting')
+            transport.close()
+            transport.reset = True
+            transport.open()
+            needs_init = self._needs_firmware()
 
         if needs_init:
-            firmware_path = self._find_firmware()
-            with open(firmware_path, 'rb') as f:
-                fw = f.read()
+            fw = _read_firmware(self._find_firmware())
             if self.isRH:
                 # Firmware configuration needed - write a START2 packet
                 self.send_command(b'\x04\x00\x02\x00', init=True)
@@ -251,17 +544,29 @@ class digiBase:
                 self.log.debug(f'STAT_6[1] &= 0xf3: {r[0]}')
 
             self.clear_spectrum()
-        else:
+        elif not fast_attach:
             # No firmware config needed
             self.read_status_register()
           
             # Set CNT byte
             self._status[610] = 0
-            self.write_status_register()
+            self.write_status_register(force=True)
             self._status[610] = 1
-            self.write_status_register()
+            self.write_status_register(force=True)
         
         self.read_status_register()
+        self.attach_time = perf_counter() - t0
+        self.log.info(f'Attached S/N {self.serial} in {1e3*self.attach_time:.1f} ms'
+                      + (' (firmware loaded)' if needs_init else ''))
+
+    def _needs_firmware(self) -> bool:
+        "Probe whether the device needs its firmware bitstream"
+        if self.isRH:
+            # Write out a START (0x06, 0x00, 0x02, 0x00)
+            r = self.send_command(b'\x06\x00\x02\x00', init=True)
+            return r[0] == 4 and r[1] == 0x80
+        r = self.send_command(b'\x06')
+        return r[0] == 0
 
     def _find_firmware(self):
         from pathlib import Path
@@ -273,58 +578,255 @@ class digiBase:
             if path_to_fw.is_file(): return path_to_fw
         raise RuntimeError("Unable to find digiBase Firmware")
         
-    def read_status_register(self):
-        self._status = bit_register(
+    def _read_status(self) -> bit_register:
+        "Read the status register from the device, leaving the shadow copy alone"
+        return bit_register(
             int.from_bytes(
                 self.send_command(b'\x01', init=False), 
                 byteorder='little'
             )
         )
 
-    def write_status_register(self):
+    def read_status_register(self):
+        with self._lock:
+            self._status = self._read_status()
+            self._status_time = monotonic()
+
+    def write_status_register(self, force: bool=False):
+        """
+        Write the shadow status register to the device. Inside a
+        configure() block the write is deferred to the end of the
+        block unless force is True. Callers changing the shadow copy
+        hold the device lock until it is written, so that a status read
+        from another thread cannot replace the copy in between.
+        """
+        if self._batch > 0 and not force:
+            self._dirty = True
+            return None
         resp = self.send_command(
             b'\x00' + self._status.reg.to_bytes(80, byteorder='little')
         )
+        self._dirty = False
         return resp
         #assert len(resp) == 0
 
+    def refresh(self):
+        "Read the status register, regardless of the age of the shadow copy"
+        self.read_status_register()
+
+    def _sync_status(self):
+        """
+        Bring the shadow status register up to date for a getter: it is 
+        read unless caching is enabled and the copy is recent enough, or
+        a configure() block holds unwritten changes.
+        """
+        with self._lock:
+            if self._batch > 0: return
+            if self.max_age is not None and monotonic() - self._status_time <= self.max_age:
+                return
+            self.read_status_register()
+
+    @contextmanager
+    def configure(self, verify: bool=False):
+        """
+        Collect several setting changes into a single status register 
+        write, made when the block exits:
+
+        >>> with base.configure(verify=True):
+        ...     base.hv = 800
+        ...     base.lld = 24
+        ...     base.fine_gain = 0.5
+
+        Getters inside the block return the pending values. If the 
+        block raises, pending changes are discarded. With verify=True 
+        the register is read back after the write and an IOError raised
+        if any of the CONFIG_FIELDS does not match.
+
+        The block holds the device lock: other threads' commands, 
+        setters and getters wait until it ends, so do not wait in it
+        for a thread using the device (e.g. a ListModeStream reader).
+        """
+        with self._lock:
+            if self._batch == 0: self._sync_status()
+            self._batch += 1
+            try:
+                yield self
+            except BaseException:
+                self._batch -= 1
+                if self._batch == 0:
+                    self._dirty = False
+                    self.read_status_register()
+                raise
+            self._batch -= 1
+            if self._batch > 0 or not self._dirty: return
+            expected = bit_register(self._status.reg)
+            self.write_status_register()
+            if verify:
+                self.read_status_register()
+                bad = [name for name, sl in CONFIG_FIELDS.items()
+                       if self._status[sl] != expected[sl]]
+                if len(bad) > 0:
+                    raise IOError("Status register verification failed: " + ', '.join(bad))
+
     def clear_spectrum(self):
         self.send_command(b'\x02' + b'\x00'*4096)
 
     def clear_counters(self):
         "Clear livetime and realtime counters"
-        self._status[608] = 1
-        self.write_status_register()
-        self._status[608] = 0
-        self.write_status_register()
+        with self._lock:
+            self._status[608] = 1
+            self.write_status_register(force=True)
+            self._status[608] = 0
+            self.write_status_register(force=True)
+
+    def _endpoints(self, init: bool=False) -> tuple:
+        "(OUT, IN) endpoint addresses for commands"
+        if self.isRH:
+            return (0x01, 0x81) if init else (0x08, 0x82)
+        return (0x02, 0x82)
+
+    # Command names used by Metrics, by first command byte
+    COMMAND_NAMES = {0x00: 'status_write', 0x01: 'status_read', 0x02: 'clear_spectrum', 0x80: 'readout'}
 
     def send_command(
             self, 
             cmd, 
             init:bool=False, 
             max_length:int=80,
-            no_read=False):
-        if self.isRH:
-            epID = (0x01, 0x81) if init else (0x08, 0x82)
-        else:
-            epID = (0x02, 0x82)
-        n = self.dev.write(epID[0], cmd, timeout=1000)
-        self.log.debug(f"Wrote {n} bytes to endpoint {epID[0]:02x}")
-        if n != len(cmd): raise IOError("Incomplete write")
-        if no_read: return array('B')
-        resp = self.dev.read(epID[1], max_length, timeout=125)
+            no_read=False,
+            buffer:array=None,
+            name:str=None):
+        """
+        Write a command to the device and read back the response.
+        If buffer (an array('B')) is given the response is read into
+        it instead of a newly allocated array and the number of bytes
+        read is returned. name labels the command in the metrics.
+        """
+        if self.metrics is None: 
+            return self._send_command(cmd, init, max_length, no_read, buffer)
+        t0 = monotonic()
+        resp = self._send_command(cmd, init, max_length, no_read, buffer)
+        if name is None:
+            name = 'init' if init else self.COMMAND_NAMES.get(cmd[0] if cmd else None, 'other')
+        self.metrics.command(name, monotonic() - t0, len(cmd), 
+                             resp if buffer is not None else len(resp))
+        return resp
+
+    def _send_command(self, cmd, init, max_length, no_read, buffer):
+        epID = self._endpoints(init)
+        with self._lock:
+            n = self.transport.write(epID[0], cmd, timeout=1000)
+            self.log.debug(f"Wrote {n} bytes to endpoint {epID[0]:02x}")
+            if n != len(cmd): raise IOError("Incomplete write")
+            if no_read: return array('B')
+            if buffer is not None:
+                n = self.transport.read(epID[1], buffer, timeout=125)
+                self.log.debug(f"Read {n} bytes from endpoint {epID[1]:02x}")
+                return n
+            resp = self.transport.read(epID[1], max_length, timeout=125)
         self.log.debug(f"Read {len(resp)} bytes from endpoint {epID[1]:02x}")
         return resp
             
     def start(self):
         "Start the acquisition"
-        self._status[1] = 1
-        self.write_status_register()
+        with self._lock:
+            self._status[1] = 1
+            self.write_status_register()
 
     def stop(self):
         "Stop the acquisition"
-        self._status[1] = 0
-        self.write_status_register()
+        with self._lock:
+            self._status[1] = 0
+            self.write_status_register()
+
+    def apply_settings(self, verify: bool=False, **settings):
+        """
+        Apply several settings in a single status register write. 
+        Keywords are property names (hv, lld, fine_gain, ext_gate, 
+        livetime_preset, ...) plus mode ('pha' or 'list'), presets and
+        auto_stabilize, whose (dict) values are passed on to 
+        set_presets() and auto_stabilize():
+
+        >>> base.apply_settings(hv=800, lld=24, presets=dict(livetime=True),
+        ...                     livetime_preset=60.0, mode='pha')
+        """
+        mode = settings.pop('mode', None)
+        presets = settings.pop('presets', None)
+        stabilize = settings.pop('auto_stabilize', None)
+        if mode not in (None, 'pha', 'list'): raise ValueError(f"Unknown mode {mode}")
+        for key in settings:
+            if not isinstance(getattr(digiBase, key, None), property):
+                raise ValueError(f"Unknown setting {key}")
+        with self.configure(verify=verify):
+            # The list mode reset pulse is written straight away; the
+            # settings follow in the single write at the end of the block
+            if mode == 'pha':
+                self.set_acq_mode_pha()
+            elif mode == 'list':
+                self.set_acq_mode_list()
+            for key, val in settings.items(): setattr(self, key, val)
+            if presets is not None: self.set_presets(**presets)
+            if stabilize is not None: self.auto_stabilize(**stabilize)
+
+    def status_snapshot(self, refresh: bool=False) -> StatusSnapshot:
+        """
+        All decoded status register fields from (at most) one register 
+        read; with refresh=True the register is always read.
+        """
+        with self._lock:
+            if refresh and self._batch == 0:
+                self.read_status_register()
+            else:
+                self._sync_status()
+            return self._snapshot(self._status)
+
+    @staticmethod
+    def _snapshot(st: bit_register) -> StatusSnapshot:
+        "Decode a status register"
+        return StatusSnapshot(
+            livetime=st[224:256] / 50,
+            realtime=st[288:320] / 50,
+            livetime_preset=st[192:224] / 50,
+            realtime_preset=st[256:288] / 50,
+            busy=bool(st[8]),
+            hv=st[336:352] * 5 / 4,
+            hv_enabled=bool(st[6]),
+            fine_gain=st[96:128] / 0x400000,
+            lld=st[170:180],
+            uld=st[176:192],
+            pw=0.0625 * (st[16:24] - 12) + 0.75,
+            ext_gate=ExtGateMode(st[56:64]),
+            livetime_preset_enabled=bool(st[2]),
+            realtime_preset_enabled=bool(st[3])
+        )
+
+    def wait_until_done(self, timeout: float=None, interval: float=10.0, 
+                        margin: float=0.05, poll: float=0.01) -> bool:
+        """
+        Wait for the acquisition to stop, e.g. on reaching a livetime or
+        realtime preset. Rather than polling at a fixed rate this sleeps
+        until margin seconds before the earliest time a preset can be
+        reached (see StatusSnapshot.remaining) and polls every poll
+        seconds from there, so a run takes a handful of status reads.
+        Sleeps are at most interval seconds, also without presets.
+
+        Returns
+        -------
+        bool
+            True when the acquisition stopped, False if it was still 
+            running after timeout seconds
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        while True:
+            st = self.status_snapshot(refresh=True)
+            if not st.busy: return True
+            remaining = st.remaining
+            delay = interval if remaining is None else min(max(remaining - margin, poll), interval)
+            if deadline is not None:
+                left = deadline - monotonic()
+                if left <= 0: return False
+                delay = min(delay, left)
+            sleep(delay)
 
     def print_status(self):
         srbytes = array('B', self._status.reg.to_bytes(80, byteorder='little'))
@@ -335,69 +837,118 @@ class digiBase:
     @property
     def livetime(self) -> float:
         "Acquisition livetime, in seconds"
-        self.read_status_register()
+        self._sync_status()
         return self._status[224:256] / 50
     
     @property
     def livetime_preset(self) -> float:
         "Acquisition livetime limit, in seconds"
-        self.read_status_register()
+        self._sync_status()
         return self._status[192:224] / 50
     
     @livetime_preset.setter
     def livetime_preset(self, val: float):
-        self._status[192:224] = int(val * 50) & 0xffff_ffff
-        self.write_status_register()
+        with self._lock:
+            self._status[192:224] = int(val * 50) & 0xffff_ffff
+            self.write_status_register()
     
     @property
     def realtime(self) -> float:
-        self.read_status_register()
+        self._sync_status()
         return self._status[288:320] / 50
 
     @property
     def realtime_preset(self) -> float:
-        self.read_status_register()
+        self._sync_status()
         return self._status[256:288] / 50
     
     @realtime_preset.setter
     def realtime_preset(self, val: float):
-        self._status[256:288] = int(val * 50) & 0xffff_ffff
-        self.write_status_register()
+        with self._lock:
+            self._status[256:288] = int(val * 50) & 0xffff_ffff
+            self.write_status_register()
 
     @property
     def spectrum(self):
-        resp = self.send_command(b'\x80', max_length=5000)
+        resp = self.send_command(b'\x80', max_length=5000, name='spectrum')
         return unpack('1024I', resp)
     
     @property
     def hits(self):
-        resp = self.send_command(b'\x80', max_length=132_000)
+        resp = self.send_command(b'\x80', max_length=132_000, name='hits')
         n = len(resp) // 4
-        return unpack(f'{n}I', resp)
+        hits = unpack(f'{n}I', resp)
+        if self.metrics is not None: self.metrics.list_read(np.frombuffer(resp, dtype=np.uint32))
+        return hits
+
+    def spectrum_array(self) -> np.ndarray:
+        """
+        Read the MCA channels as a uint32 NumPy array of length 1024.
+        The array is a view of a buffer that is reused by the next
+        call so copy it if it needs to be kept around.
+        """
+        n = self.send_command(b'\x80', buffer=self._spectrum_buffer, name='spectrum')
+        if n != 4096: raise IOError(f"Short spectrum read ({n} bytes)")
+        return np.frombuffer(self._spectrum_buffer, dtype=np.uint32, count=1024)
+
+    def spectrum_snapshot(self) -> SpectrumSnapshot:
+        """
+        Read the spectrum without stopping the acquisition, bracketed by
+        two status register reads. Livetime and realtime are the mean of
+        both reads and skew the time between them; nothing else talks
+        to the device in between. Subtract consecutive snapshots with
+        SpectrumSnapshot.since() for dead-time-free interval spectra.
+        """
+        with self._lock:
+            if self._batch: raise RuntimeError("spectrum_snapshot() inside configure()")
+            t0 = monotonic()
+            self.read_status_register()
+            livetime, realtime = self._status[224:256], self._status[288:320]
+            spectrum = self.spectrum_array().copy()
+            now = time()
+            self.read_status_register()
+            skew = monotonic() - t0
+            livetime += self._status[224:256]
+            realtime += self._status[288:320]
+        return SpectrumSnapshot(spectrum, livetime / 100, realtime / 100, now, skew)
+
+    def hits_array(self) -> np.ndarray:
+        """
+        Read the list mode hit buffer as a uint32 NumPy array.
+        Like spectrum_array() this returns a view of a reused
+        buffer which is only valid until the next call.
+        """
+        n = self.send_command(b'\x80', buffer=self._hits_buffer, name='hits')
+        words = np.frombuffer(self._hits_buffer, dtype=np.uint32, count=n // 4)
+        if self.metrics is not None: self.metrics.list_read(words)
+        return words
 
     @property
     def hv_enabled(self):
-        self.read_status_register()
+        self._sync_status()
         return bool(self._status[6])
     
     @hv_enabled.setter
     def hv_enabled(self, val: bool):
-        self._status[6] = 1 if val else 0
-        self.write_status_register
+        with self._lock:
+            self._status[6] = 1 if val else 0
+            self.write_status_register()
 
     @DeprecationWarning
     def enable_hv(self):
-        self._status[6] = 1
-        self.write_status_register()
+        with self._lock:
+            self._status[6] = 1
+            self.write_status_register()
         
     @DeprecationWarning
     def disable_hv(self):
-        self._status[6] = 0
-        self.write_status_register()
+        with self._lock:
+            self._status[6] = 0
+            self.write_status_register()
 
     @property
     def hv(self) -> float:
-        self.read_status_register()
+        self._sync_status()
         return self._status[336:352] * 5 / 4
     
     @hv.setter
@@ -405,53 +956,57 @@ class digiBase:
         val = int(val)
         if val >= 1200: raise ValueError(f"{val} > Max HV 1200V")
         val = (val * 4) // 5
-        self._status[336:352] = val
-        self.write_status_register()
+        with self._lock:
+            self._status[336:352] = val
+            self.write_status_register()
 
     @property
     def pw(self):
-        self.read_status_register()
+        self._sync_status()
         return 0.0625 * (self._status[16:24] - 12) + 0.75
 
     @pw.setter
     def pw(self, val):
         if val < 0.75 or val > 2.0: raise ValueError("Pulse width out of range")
         val = 16 * (val - 0.75) + 12
-        self._status[16:24] = val
-        self.write_status_register()
+        with self._lock:
+            self._status[16:24] = val
+            self.write_status_register()
 
     @property
     def hv_readback(self):
         # Trigger HV ADC read
-        self._status[610] = 0
-        self.write_status_register()
-        self._status[610] = 1
-        self.write_status_register()
-        sleep(0.01)
-        self.read_status_register()
-        return (self._status[24:32] | (self._status[13:15] << 8)) * 1.25
+        with self._lock:
+            self._status[610] = 0
+            self.write_status_register(force=True)
+            self._status[610] = 1
+            self.write_status_register(force=True)
+            sleep(0.01)
+            self.read_status_register()
+            return (self._status[24:32] | (self._status[13:15] << 8)) * 1.25
     
     @property
     def lld(self):
         "Lower level discriminator"
-        self.read_status_register()
+        self._sync_status()
         return self._status[170:180]
     
     @lld.setter
     def lld(self, val):
         val &= 0x3ff
-        self._status[170:180] = val
-        self.write_status_register()
+        with self._lock:
+            self._status[170:180] = val
+            self.write_status_register()
     
     @property
     def uld(self):
         "Upper level discriminator"
-        self.read_status_register()
+        self._sync_status()
         return self._status[176:192]
     
     @property
     def fine_gain(self) -> float:
-        self.read_status_register()
+        self._sync_status()
         return self._status[96:128] / 0x400000
     
     @fine_gain.setter
@@ -462,24 +1017,27 @@ class digiBase:
         val = int(val * 0x400000)
         # Set high bit to 1 to active register write
         # On read the bit should be cleared
-        self._status[128:152] = val | 0x800000
-        self.write_status_register()
+        with self._lock:
+            self._status[128:152] = val | 0x800000
+            self.write_status_register()
 
     @uld.setter
     def uld(self, val):
         val &= 0xffff
-        self._status[176:192] = val
-        self.write_status_register()
+        with self._lock:
+            self._status[176:192] = val
+            self.write_status_register()
 
     @property
     def ext_gate(self) -> ExtGateMode:
-        self.read_status_register()
+        self._sync_status()
         return ExtGateMode(self._status[56:64])
     
     @ext_gate.setter
     def ext_gate(self, mode: ExtGateMode):
-        self._status[56:64] = mode.value
-        self.write_status_register()
+        with self._lock:
+            self._status[56:64] = mode.value
+            self.write_status_register()
 
     def auto_stabilize(self, gain: tuple=None, zero: tuple=None):
         """ 
@@ -494,18 +1052,19 @@ class digiBase:
         zero : list
             (hi_ch, center_ch, lo_ch) tuple or None for zero stabilization
         """
-        self._status[4:6] = 0
-        if gain is not None and isinstance(gain, (tuple,list)) and len(gain) == 3:
-            self._status[4] = 1
-            self._status[448:464] = gain[0]
-            self._status[464:480] = gain[1]
-            self._status[480:496] = gain[2]
-        if zero is not None and isinstance(zero, (tuple,list)) and len(zero) == 3:
-            self._status[5] = 1
-            self._status[528:544] = zero[0]
-            self._status[544:560] = zero[1]
-            self._status[560:576] = zero[2]
-        self.write_status_register()
+        with self._lock:
+            self._status[4:6] = 0
+            if gain is not None and isinstance(gain, (tuple,list)) and len(gain) == 3:
+                self._status[4] = 1
+                self._status[448:464] = gain[0]
+                self._status[464:480] = gain[1]
+                self._status[480:496] = gain[2]
+            if zero is not None and isinstance(zero, (tuple,list)) and len(zero) == 3:
+                self._status[5] = 1
+                self._status[528:544] = zero[0]
+                self._status[544:560] = zero[1]
+                self._status[560:576] = zero[2]
+            self.write_status_register()
 
     def set_presets(self, livetime: bool=False, realtime: bool=False):
         """
@@ -513,235 +1072,3205 @@ class digiBase:
         The DBASE will stop acquisition when either preset is reached.
         The livetime and realtiem preset values are set elsewhere.
         """
-        self._status[2] = 1 if livetime else 0
-        self._status[3] = 1 if realtime else 0
+        with self._lock:
+            self._status[2] = 1 if livetime else 0
+            self._status[3] = 1 if realtime else 0
+            self.write_status_register()
     
     def set_acq_mode_list(self):
-        self._status[0:2] = 0
-        self._status[7] = 1
-        self._status[608] = 1
-        self.write_status_register()
-        self._status[7] = 0
-        self._status[608] = 0
-        self.write_status_register()
+        with self._lock:
+            self._status[0:2] = 0
+            self._status[7] = 1
+            self._status[608] = 1
+            self.write_status_register(force=True)
+            self._status[7] = 0
+            self._status[608] = 0
+            self.write_status_register(force=True)
 
     def set_acq_mode_pha(self):
-        self._status[0] = 1
-        self.write_status_register()
+        with self._lock:
+            self._status[0] = 1
+            self.write_status_register()
+
+    def hits_burst(self, depth: int=1, max_reads: int=256):
+        """
+        Generator draining the list buffer in batches of depth 0x80 
+        requests sent at once, so the device has the next request 
+        queued while the host reads the previous response. Batches 
+        stop after one with an empty response (or after max_reads 
+        requests). Yields uint32 views of rotating buffers, each valid
+        until the next batch is read. Other commands to the device wait
+        for the batch in progress only.
+
+        Whether the firmware queues more than one list mode request is
+        not verified on hardware (the emulator answers each in turn), 
+        so depth is 1 unless asked for.
+        """
+        ep_out, ep_in = self._endpoints()
+        if len(self._burst_buffers) < depth + 1:
+            self._burst_buffers = [array('B', bytes(132_000)) for i in range(depth + 1)]
+        buffers = self._burst_buffers[:depth+1]
+        metrics = self.metrics
+        issued = i = 0
+        more = True
+        while more and issued < max_reads:
+            # The lock is held per batch of requests, not while the consumer
+            # handles the words, so other threads' commands get in between
+            words = []
+            with self._lock:
+                inflight = 0
+                try:
+                    while inflight < depth and issued < max_reads:
+                        if self.transport.write(ep_out, b'\x80', timeout=1000) != 1:
+                            raise IOError("Incomplete write")
+                        inflight += 1
+                        issued += 1
+                    while inflight > 0:
+                        buf = buffers[i % len(buffers)]
+                        i += 1
+                        if metrics is not None: t0 = monotonic()
+                        n = self.transport.read(ep_in, buf, timeout=125)
+                        inflight -= 1
+                        if n == 0: more = False
+                        if metrics is not None:
+                            # Time waited for this response with the others in flight
+                            metrics.command('hits_burst', monotonic() - t0, 1, n)
+                            metrics.list_read(np.frombuffer(buf, dtype=np.uint32, count=n // 4))
+                        if n > 0: words.append(np.frombuffer(buf, dtype=np.uint32, count=n // 4))
+                finally:
+                    # Collect responses still in flight after an error; a
+                    # failing read (pyusb's USBError is an IOError) ends the
+                    # drain without replacing the original exception
+                    while inflight > 0:
+                        inflight -= 1
+                        try:
+                            self.transport.read(ep_in, buffers[0], timeout=125)
+                        except IOError:
+                            break
+            yield from words
+
+    def list_mode_stream(self, **kwargs) -> 'ListModeStream':
+        "Create a ListModeStream reading from this device; see ListModeStream"
+        return ListModeStream(self, **kwargs)
+
+    def close(self):
+        "Release the device; also done when the object is garbage collected"
+        if self.transport is not None:
+            self.log.debug('Closing device')
+            self.transport.close()
+            self.transport = None
 
     def __del__(self):
-        self.log.debug('Closing device')
-        if self.dev is not None:
-            usb.util.release_interface(self.dev, 0)
-            usb.util.dispose_resources(self.dev)
+        self.close()
 
 
-def write_background(filename, s:array, exposure:float, comment:str, serial:int):
-    global args
-    with open(filename, 'wb') as f:
-        f.write(b'DBKG\x00\x00\x00\x01')
-        f.write(pack('d', datetime.now().timestamp()))
-        f.write(pack('d', exposure))
-        f.write(pack('i', serial))
-        f.write(pack('H', args.pmt_hv))
-        f.write(pack('H', args.disc))
-        f.write(pack('i', ExtGateMode[args.external_gate].value))
-        f.write(pack('d', args.gain))
-        if comment is None:
-            f.write(b'\x00'*64)
-        else:
-            f.write(comment.encode('utf-8')[:63].ljust(64, b'\x00'))
-        f.write(pack('1024i', *s))
+class StatusWatcher:
+    """
+    Calls back on status register bit transitions of a base, watched
+    by reading the register from a background thread:
 
-def read_spectrum(fileobj) -> tuple[np.ndarray, float, float, object]:
-    """ More modern version to read spectrum file given file-like object"""
-    if fileobj.read(6) != b'DBKG\x00\x00': raise ValueError("Unknown file format")
-    ver, = unpack('H', fileobj.read(2))
-    t, exp = unpack('2d', fileobj.read(16))
-    if ver > 0:
-        serial, hv, disc, ext_gate, gain = unpack('=i2Hid', fileobj.read(20))
-    comment = fileobj.read(64).decode('utf-8')
-    s = np.array(unpack('1024i', fileobj.read(4096)), 'i')
-    if ver == 0: return s, t, exp, comment
-    return s, t, exp, (comment, serial, hv, disc, ext_gate, gain)
+    >>> watcher = StatusWatcher(base)
+    >>> watcher.on('stopped', lambda st: print(f'Done, livetime {st.livetime} s'))
+    >>> with watcher:
+    ...     base.start()
+    ...     watcher.wait('stopped', timeout=600)
 
-def read_background(filename) -> tuple[np.ndarray, float, float, Any]:
-    """Legacy interface to spectrum reader"""
-    with open(filename, 'rb') as f: return read_spectrum(f)
-    
-if __name__ == "__main__":
-    parser = ArgumentParser(prog='digibase.py', description='Simple DAQ for ORTEC/AMETEK digiBase')
-    parser.add_argument('--pmt-hv', type=int, default=800)
-    parser.add_argument('--disc', type=int, default=20)
-    parser.add_argument('-X', '--external-gate', default='OFF', choices=['OFF', 'COINCIDENCE', 'ENABLED'])
-    parser.add_argument('-g', '--gain', type=float, default=0.5)
-    parser.add_argument('--realtime-preset', type=float, default=0.0)
-    parser.add_argument('--livetime-preset', type=float, default=0.0)
-    parser.add_argument('--sn', help='S/N of digiBase (in case of >1)')
-    parser.add_argument('-q', '--quiet', action='store_true')
-    parser.add_argument('-L', '--log-level', nargs='?', default='WARNING', const='INFO')
+    Named events are the acquisition started / stopped (busy, bit 8)
+    and HV readback ADC busy / ready (bit 11); watch() takes any other
+    bit. Only transitions between two reads are seen. The register is 
+    read every interval seconds, every poll seconds while the HV ADC is
+    busy, and during a run with presets the thread sleeps until just 
+    before the earliest time they can be reached, as wait_until_done()
+    does.
+    """
+    EVENTS = {
+        'started':      (8, 1),
+        'stopped':      (8, 0),
+        'hv_adc_busy':  (11, 1),
+        'hv_adc_ready': (11, 0),
+    }
 
-    subparsers = parser.add_subparsers(dest='command', help='Run modes')
-    parser_spe = subparsers.add_parser('spect', help='Acquire spectrum, write to file')
-    parser_spe.add_argument('duration', type=float, 
-                            help='Time, in seconds to integrate spectrum')
-    parser_spe.add_argument('filename', 
-                            help='Output file in which spectrum is saved; ' 
-                            'note can contain bracketed expressions {seq} '
-                            'and {serial} which will be replaced by the '
-                            'current sequence of a multi-sequence run '
-                            '(triggered by -I option), and the digiBase '
-                            'S/N, respectively.'
-                            )
-    parser_spe.add_argument('-m', '--comment', help='Short run description (max 63 char)')
-    parser_spe.add_argument('-I', '--interval', type=float, default=0.0, 
-                            help='Slice spectral captures into intervals, if > 0')
+    def __init__(self, base: digiBase, interval: float=1.0, margin: float=0.05, 
+                 poll: float=0.01):
+        self.base = base
+        self.interval = interval
+        self.margin = margin
+        self.poll = poll
+        self._watches = {name: [bit, value, []] for name, (bit, value) in self.EVENTS.items()}
+        self._counts = dict.fromkeys(self._watches, 0)
+        self._waited = dict.fromkeys(self._watches, 0)
+        self._cv = threading.Condition()
+        self._stopping = threading.Event()
+        self._thread = None
+        self.reads = 0          # Status register reads made
+        self.error = None       # Exception raised in the watcher thread
 
-    parser_det = subparsers.add_parser('detect', help='Detect presence of signal over background')
-    parser_det.add_argument('duration', type=float, help='Integration time of each query interval')
-    parser_det.add_argument('n', type=int, help='Number of intervals')
-    parser_det.add_argument('sig0', type=int, help='Channel # of low side of signal RoI')
-    parser_det.add_argument('sig1', type=int, help='Channel # of high side of signal RoI')
-    parser_det.add_argument('filename', nargs='+', help='Spectrum file for background subtraction')
-    parser_det.add_argument('-a', '--alpha', type=float, help='Exponential Moving Average parameter.')
-    parser_det.add_argument('--norm-roi')
+    def watch(self, name: str, bit: int, value: int, callback=None):
+        "Add an event for status bit becoming value"
+        with self._cv:
+            self._watches[name] = [bit, value, [] if callback is None else [callback]]
+            self._counts[name] = self._waited[name] = 0
 
-    parser_acq = subparsers.add_parser('acq', help='List mode acquisition')
-    parser_acq.add_argument('duration', type=float, help='Acquisition time')
-    parser_acq.add_argument('filename', help='Output file for list mode data')
-    
-    args = parser.parse_args()
+    def on(self, name: str, callback):
+        "Call callback(status_snapshot) on every occurrence of the event"
+        if name not in self._watches: raise ValueError(f"Unknown event {name}")
+        self._watches[name][2].append(callback)
 
-    logging.basicConfig(level=args.log_level)
-    log = logging.getLogger()
+    def wait(self, name: str, timeout: float=None) -> bool:
+        """
+        Wait until the event occurs; returns at once if it did since
+        the watcher started or the last wait() for it returned. False
+        on timeout.
+        """
+        if name not in self._watches: raise ValueError(f"Unknown event {name}")
+        with self._cv:
+            if not self._cv.wait_for(lambda: self._counts[name] > self._waited[name] 
+                                     or self.error is not None, timeout):
+                return False
+            if self.error is not None: raise self.error
+            self._waited[name] = self._counts[name]
+            return True
+
+    def start(self):
+        if self._thread is not None: raise RuntimeError("Watcher already started")
+        self._thread = threading.Thread(
+            target=self._run, name=f'digiBase-{self.base.serial}-status', daemon=True)
+        self._thread.start()
 
-    base = digiBase(args.sn)
+    def stop(self):
+        if self._thread is None: return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        self._stopping.clear()
 
-    # Configure the device to sane defaults    
-    base.clear_spectrum()
-    base.clear_counters()
-    
-    base.livetime_preset = args.livetime_preset
-    base.realtime_preset = args.realtime_preset
-    base.set_presets(livetime=args.livetime_preset > 0, realtime=args.realtime_preset > 0)
-
-    base.lld = args.disc
-    base.ext_gate = ExtGateMode[args.external_gate]
-
-    # Disable auto gain and zero stabilization
-    base.auto_stabilize()
-
-    # HV and gain settings
-    if base.hv != args.pmt_hv: base.hv = args.pmt_hv
-    if not base.hv_enabled: 
-        base.hv_enabled = True
-        sleep(5.0)
-    base.fine_gain = args.gain
-
-    if args.command == 'spect':
-        base.set_acq_mode_pha()
-        base.start()
-        t0 = datetime.now()
-        t1 = t0
-        run_time = timedelta(seconds=args.duration)
-        interval = timedelta(seconds=args.interval)
-        iseq = 0
-        while (elapsed_time := datetime.now() - t0) < run_time:
-            if interval > timedelta(0.0) and datetime.now() - t1 > interval:
-                filename = args.filename.format(seq=iseq, serial=base.serial)
-                base.stop()
-                spectrum = base.spectrum
-                livetime = base.livetime
-                base.start()
-                write_background(filename, spectrum, livetime,
-                                 args.comment, serial=int(base.serial))
-                t1 = datetime.now()
-                iseq += 1
-            if not args.quiet: print("Elapsed time: " + str(elapsed_time), end='\r')
-            sleeptime = (interval - (datetime.now() - t1)) / timedelta(seconds=1.0)
-            if sleeptime > 0.0:
-                sleeptime = min(sleeptime, 0.25)
-                sleep(sleeptime)
-        base.stop()
-        spectrum = base.spectrum
-        if not args.quiet: 
-            print("Elapsed time: " + str(elapsed_time))
-            print(f"Collected {sum(spectrum)} counts")
-            print(f"Livetime {base.livetime:.3f} s")
-            print(f"Realtime {base.realtime:.3f} s")
-        filename = args.filename.format(iseq, base.serial)
-        write_background(filename, spectrum, base.livetime, 
-                         args.comment, serial=int(base.serial))
-    elif args.command == 'detect':
-        base.set_acq_mode_pha()
-        base.start()
-        bkg = np.zeros(1024, dtype=np.int32)
-        exp_bkg = 0.0
-        for filename in args.filename:
-            s, t_bkg, pex, comment = read_background(filename)
-            bkg += s
-            exp_bkg += pex
-        
-        # Normalize control to counts per bin per second
-        bkg = bkg / exp_bkg
-        log.debug(f'Total background counts after normalization {np.sum(bkg)}')
-        log.debug(f'ROI background counts after normalization {np.sum(bkg[args.sig0:args.sig1])}')
-        spectrum_last = np.zeros(1024, dtype=np.int32)
-        livetime_last = 0.0
-        counts = None
-
-        # Optional mode normalizes not on exposure time but a portion of the spectrum
-        norm_roi = None
-        if args.norm_roi is not None:
-            nr0, nr1 = args.norm_roi.split(',')
-            norm_roi = (int(nr0), int(nr1))
+    def __enter__(self):
+        self.start()
+        return self
 
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _read(self):
+        # A private copy: replacing the base's shadow register could undo
+        # a setter running in another thread
+        reg = self.base._read_status()
+        self.reads += 1
+        return self.base._snapshot(reg), reg
+
+    def _run(self):
         try:
-            for i in range(args.n):
-                sleep(args.duration)
-                spectrum = np.array(base.spectrum, dtype=np.int32)
-                livetime = base.livetime
-                livetime_diff = livetime - livetime_last
-                spectrum_diff = spectrum - spectrum_last
-                cspec = np.sum(spectrum_diff)
-                if norm_roi is not None:
-                    bkg_norm = np.sum(bkg[norm_roi[0]:norm_roi[1]])
-                    det_norm = np.sum(spectrum_diff[norm_roi[0]:norm_roi[1]])
-                    bkg_sub = np.zeros(1024, dtype=np.int32)
-                    if det_norm > 0:
-                        bkg_sub = bkg_norm / det_norm * spectrum_diff - bkg
+            st, reg = self._read()
+            last = {name: reg[w[0]] for name, w in self._watches.items()}
+            while True:
+                if st.busy and st.remaining is not None:
+                    delay = min(max(st.remaining - self.margin, self.poll), self.interval)
                 else:
-                    bkg_sub = spectrum_diff - bkg * livetime_diff
-                spectrum_last = spectrum
-                livetime_last = livetime
-                c = np.sum(bkg_sub[args.sig0:args.sig1])
-                craw = np.sum(spectrum_diff[args.sig0:args.sig1])
-                counts = c if counts is None else c*args.alpha + counts*(1-args.alpha)
-                print(datetime.now(), '-', f'cs: {cspec:.1f} craw {craw} counts {counts:.2f}', flush=True)
-        except KeyboardInterrupt:
-            print("User terminated run")
-        base.stop()
-    elif args.command == 'acq':
-        nhits = 0
-        with open(args.filename, 'wb') as fhits:
-            base.set_acq_mode_list()
-            base.start()
-            t0 = datetime.now()
-            run_time = timedelta(seconds=args.duration)
-            fhits.write(b'DBLM\x00\x00\x00\x00')
-            fhits.write(pack('d', t0.timestamp()))
-            fhits.seek(16, os.SEEK_CUR)
-            while (elapsed_time := datetime.now() - t0) < run_time:
-                hits = base.hits
-                nhits += len(hits)
-                if len(hits) > 0: fhits.write(pack(f'{len(hits)}I', *hits))
-                if not args.quiet: print("Elapsed time: " + str(elapsed_time), end='\r')
-            base.stop()
-            if not args.quiet: print("Elapsed time: " + str(elapsed_time))
-            fhits.seek(16, os.SEEK_SET)
-            fhits.write(pack('d', base.livetime))
-            fhits.write(pack('d', base.realtime))
-        if not args.quiet:
-            print(f"Collected {nhits} hits")
-            print(f"Livetime {base.livetime:.3f} s")
-            print(f"Realtime {base.realtime:.3f} s")
+                    delay = self.interval
+                if reg[11]: delay = self.poll
+                if self._stopping.wait(delay): break
+                st, reg = self._read()
+                fired = []
+                with self._cv:
+                    for name, (bit, value, callbacks) in self._watches.items():
+                        now = reg[bit]
+                        if now == value and last.get(name, now) != value:
+                            self._counts[name] += 1
+                            fired.extend(callbacks)
+                        last[name] = now
+                    self._cv.notify_all()
+                for callback in fired: callback(st)
+        except Exception as e:
+            self.error = e
+            with self._cv: self._cv.notify_all()
+
+
+class ArraySnapshot(NamedTuple):
+    "Spectra and counters of all bases of a digiBaseArray, read together"
+    time: np.ndarray        # Per base wall time of the readout (midpoint), in seconds
+    spectra: np.ndarray     # Spectra, one row per base
+    livetime: np.ndarray
+    realtime: np.ndarray
+
+    @property
+    def skew(self) -> float:
+        "Spread of the readout times across bases, in seconds"
+        return float(self.time.max() - self.time.min())
+
+
+class digiBaseArray:
+    """
+    Several digiBases operated as one. Commands are sent to all bases
+    concurrently with one worker thread per base, so that readout time
+    stays flat as bases are added:
+
+    >>> with digiBaseArray() as bases:
+    ...     bases.configure(hv=800, lld=24, fine_gain=0.5, mode='pha')
+    ...     bases.clear()
+    ...     bases.start()
+    ...     sleep(10)
+    ...     snap = bases.snapshot()
+
+    Parameters
+    ----------
+    serials : list
+        S/Ns of the bases to open; all attached bases if None
+    bases : list
+        Already opened digiBase objects to manage instead; these are 
+        left open by close(), the bases opened by the array are closed
+    max_age : float
+        Status register caching policy of the opened bases; see digiBase
+    fast_attach : bool
+        Attach to already running bases without resetting them; see digiBase
+    transports : list
+        Transports to open the bases on instead of looking up serials
+    """
+    def __init__(self, serials=None, bases=None, max_age: float=None, 
+                 fast_attach: bool=False, transports=None):
+        self.log = logging.getLogger('digiBase')
+        self._owned = bases is None
+        if bases is None:
+            if transports is None:
+                transports = UsbTransport.find_all(serials, reset=not fast_attach)
+            if len(transports) == 0: raise ValueError("Device not found")
+            t0 = perf_counter()
+            with ThreadPoolExecutor(max_workers=len(transports)) as pool:
+                bases = list(pool.map(
+                    lambda t: digiBase(transport=t, max_age=max_age, fast_attach=fast_attach), 
+                    transports))
+            self.log.info(f'Attached {len(bases)} bases in {1e3*(perf_counter() - t0):.1f} ms')
+        self.bases = list(bases)
+        if len(self.bases) == 0: raise ValueError("No bases given")
+        self._pool = ThreadPoolExecutor(max_workers=len(self.bases), 
+                                        thread_name_prefix='digiBaseArray')
+
+    @property
+    def serials(self) -> list:
+        return [base.serial for base in self.bases]
+
+    def __len__(self):
+        return len(self.bases)
+
+    def __iter__(self):
+        return iter(self.bases)
+
+    def __getitem__(self, key):
+        "Base by position or by S/N"
+        if isinstance(key, int): return self.bases[key]
+        for base in self.bases:
+            if base.serial == str(key): return base
+        raise KeyError(key)
+
+    def map(self, fn, aligned: bool=False) -> list:
+        """
+        Call fn(base) for all bases concurrently and return the results 
+        in base order. With aligned=True the workers wait for each other
+        before making the call, to line up the device commands in time.
+        """
+        if aligned:
+            barrier = threading.Barrier(len(self.bases))
+            def call(base):
+                barrier.wait()
+                return fn(base)
+        else:
+            call = fn
+        return list(self._pool.map(call, self.bases))
+
+    def configure(self, verify: bool=False, **settings):
+        "Apply the same settings to all bases; see digiBase.apply_settings()"
+        self.map(lambda base: base.apply_settings(verify=verify, **settings))
+
+    def clear(self):
+        "Clear spectra and counters of all bases"
+        def clear(base):
+            base.clear_spectrum()
+            base.clear_counters()
+        self.map(clear)
+
+    def start(self):
+        "Start acquisition on all bases together"
+        self.map(digiBase.start, aligned=True)
+
+    def stop(self):
+        "Stop acquisition on all bases together"
+        self.map(digiBase.stop, aligned=True)
+
+    def wait_until_done(self, timeout: float=None) -> bool:
+        "Wait for all bases to stop acquiring; see digiBase.wait_until_done"
+        return all(self.map(lambda base: base.wait_until_done(timeout)))
+
+    def snapshot(self) -> ArraySnapshot:
+        "Read spectra and counters of all bases at (nearly) the same time"
+        def read(base):
+            t0 = time()
+            spectrum = base.spectrum_array().copy()
+            status = base.status_snapshot(refresh=True)
+            return (t0 + time()) / 2, spectrum, status.livetime, status.realtime
+        t, spectra, livetime, realtime = zip(*self.map(read, aligned=True))
+        return ArraySnapshot(np.array(t), np.array(spectra), 
+                             np.array(livetime), np.array(realtime))
+
+    def drain(self) -> list:
+        "Read out the list buffers of all bases until empty; one uint32 array per base"
+        def drain(base):
+            chunks = []
+            while len(words := base.hits_array()) > 0: chunks.append(words.copy())
+            return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.uint32)
+        return self.map(drain)
+
+    def close(self):
+        "Stop the worker threads and close the bases the array opened"
+        self._pool.shutdown()
+        if self._owned:
+            for base in self.bases: base.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncDigiBase:
+    """
+    asyncio interface to a digiBase. The blocking USB I/O of each device
+    runs on its own worker thread, so several devices and other tasks
+    can share one event loop without blocking each other:
+
+    >>> abase = await AsyncDigiBase.open(4886)
+    >>> await abase.configure(hv=800, lld=24, mode='pha')
+    >>> await abase.start()
+    >>> await asyncio.sleep(10)
+    >>> spectrum = await abase.spectrum()
+    >>> status = await abase.status()
+
+    Commands to the same device are executed in the order awaited.
+    """
+    def __init__(self, base: digiBase):
+        self.base = base
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix=f'digiBase-{base.serial}')
+
+    @classmethod
+    async def open(cls, serialNumber=None, **kwargs) -> 'AsyncDigiBase':
+        "Open a device without blocking the event loop; arguments as for digiBase"
+        import asyncio
+        loop = asyncio.get_running_loop()
+        base = await loop.run_in_executor(None, partial(digiBase, serialNumber, **kwargs))
+        return cls(base)
+
+    @property
+    def serial(self) -> str:
+        return self.base.serial
+
+    async def run(self, fn, *args, **kwargs):
+        "Run a blocking call on this device's worker thread"
+        import asyncio
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(fn, *args, **kwargs))
+
+    async def spectrum(self) -> np.ndarray:
+        "The MCA channels as uint32 array (a copy)"
+        return await self.run(lambda: self.base.spectrum_array().copy())
+
+    async def hits(self) -> np.ndarray:
+        "One read of the list mode buffer as uint32 array (a copy)"
+        return await self.run(lambda: self.base.hits_array().copy())
+
+    async def status(self, refresh: bool=True) -> StatusSnapshot:
+        return await self.run(self.base.status_snapshot, refresh)
+
+    async def configure(self, verify: bool=False, **settings):
+        "See digiBase.apply_settings()"
+        await self.run(self.base.apply_settings, verify=verify, **settings)
+
+    async def start(self):
+        await self.run(self.base.start)
+
+    async def stop(self):
+        await self.run(self.base.stop)
+
+    async def clear(self):
+        "Clear spectrum and counters"
+        await self.run(self.base.clear_spectrum)
+        await self.run(self.base.clear_counters)
+
+    async def wait_until_done(self, timeout: float=None, interval: float=10.0,
+                              margin: float=0.05, poll: float=0.01) -> bool:
+        """
+        Wait for the acquisition to stop, sleeping on the event loop
+        between status reads; see digiBase.wait_until_done
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while True:
+            st = await self.status()
+            if not st.busy: return True
+            remaining = st.remaining
+            delay = interval if remaining is None else min(max(remaining - margin, poll), interval)
+            if deadline is not None:
+                left = deadline - loop.time()
+                if left <= 0: return False
+                delay = min(delay, left)
+            await asyncio.sleep(delay)
+
+    def list_mode_stream(self, **kwargs) -> 'AsyncListModeStream':
+        "Asynchronous ListModeStream of this device; arguments as for ListModeStream"
+        return AsyncListModeStream(self, **kwargs)
+
+    async def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class AsyncListModeStream:
+    """
+    Asynchronous iterator over the list mode blocks of a ListModeStream:
+
+    >>> async with abase.list_mode_stream() as stream:
+    ...     async for block in stream:
+    ...         process(block)
+    ...         if done: await stream.stop()
+    """
+    def __init__(self, abase: AsyncDigiBase, poll: float=0.1, **kwargs):
+        self.abase = abase
+        self.stream = ListModeStream(abase.base, **kwargs)
+        self.poll = poll
+
+    async def start(self):
+        await self.abase.run(self.stream.start)
+
+    async def stop(self):
+        await self.abase.run(self.stream.stop)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def __aiter__(self):
+        # Waiting on the ring happens off the device thread so that
+        # other commands to the device are not held up
+        import asyncio
+        loop = asyncio.get_running_loop()
+        blocks = self.stream.blocks(timeout=self.poll)
+        while (block := await loop.run_in_executor(None, next, blocks, None)) is not None:
+            if len(block) > 0: yield block
+
+
+def _usb():
+    "pyusb, imported when the first device is opened so that the rest works without it"
+    import usb.core, usb.util
+    return usb
+
+
+class UsbTransport:
+    """
+    Transport to a physical digiBase over pyusb. This is the default
+    transport of digiBase; alternative transports must provide the
+    same interface: idProduct and serial attributes, open(), close()
+    and pyusb-style write() and read() methods.
+
+    With reset False, open() leaves an already configured device as
+    it is instead of resetting it.
+    """
+    def __init__(self, dev, reset: bool=True):
+        self.dev = dev
+        self.idProduct = dev.idProduct
+        self.serial = None
+        self.reset = reset
+
+    @classmethod
+    def find(cls, serialNumber=None, reset: bool=True) -> 'UsbTransport':
+        "Find the device with the given S/N, or the first one if None"
+        log = logging.getLogger('digiBase')
+        if serialNumber is None:
+            dev = _usb().core.find(idVendor=digiBase.VENDOR_ID)
+            if dev is None: raise ValueError("Device not found")
+            return cls(dev, reset)
+        # Find all devices and match serial number
+        if not isinstance(serialNumber, str): serialNumber = str(serialNumber)
+        for dev in _usb().core.find(idVendor=digiBase.VENDOR_ID, find_all=True):
+            sn = dev.serial_number.strip('\x00')
+            log.debug(f'Bus {dev.bus:03d} Device {dev.address:03d}: '
+                      f'ID {dev.idVendor:04x}:{dev.idProduct:04x} '
+                      f' S/N {sn}')
+            if sn == serialNumber: return cls(dev, reset)
+        raise ValueError("Device not found")
+
+    @classmethod
+    def find_all(cls, serials=None, reset: bool=True) -> list:
+        "Transports for all attached digiBases, or those with the given S/Ns in that order"
+        devs = list(_usb().core.find(idVendor=digiBase.VENDOR_ID, find_all=True))
+        if serials is None: return [cls(dev, reset) for dev in devs]
+        by_serial = {dev.serial_number.strip('\x00'): dev for dev in devs}
+        missing = [str(sn) for sn in serials if str(sn) not in by_serial]
+        if missing: raise ValueError(f"Device not found: S/N {', '.join(missing)}")
+        return [cls(by_serial[str(sn)], reset) for sn in serials]
+
+    def open(self):
+        usb = _usb()
+        if self.reset:
+            self.dev.reset()
+            self.dev.set_configuration()
+        else:
+            # set_configuration() on a configured device resets its endpoints
+            try:
+                configured = self.dev.get_active_configuration() is not None
+            except usb.core.USBError:
+                configured = False
+            if not configured: self.dev.set_configuration()
+        self.serial = usb.util.get_string(self.dev, self.dev.iSerialNumber).rstrip('\x00')
+
+    def write(self, endpoint, data, timeout=None) -> int:
+        return self.dev.write(endpoint, data, timeout=timeout)
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        return self.dev.read(endpoint, size_or_buffer, timeout=timeout)
+
+    def close(self):
+        usb = _usb()
+        usb.util.release_interface(self.dev, 0)
+        usb.util.dispose_resources(self.dev)
+
+
+# USB traffic traces (DBTR): a header then one record per transport call, in
+# the order the calls happened. The file is gzip compressed.
+DBTR_HEADER = '<4sIHH'          # b'DBTR', version, idProduct, length of serial
+DBTR_RECORD = '<BBIdfI'         # Kind, endpoint, size/count, start, duration, payload length
+TRACE_OPEN, TRACE_WRITE, TRACE_READ, TRACE_CLOSE = 1, 2, 3, 4
+TRACE_ERROR = 0x80              # Or'ed to the kind; payload is 'ExceptionName: message'
+
+
+class RecordingTransport:
+    """
+    Transport wrapper recording every call (command written, response
+    read, timing and exceptions) to a DBTR trace file for later replay 
+    with ReplayTransport. Wraps any transport:
+
+    >>> rec = RecordingTransport(UsbTransport.find(4886), 'field.dbtr')
+    >>> base = digiBase(transport=rec)
+    """
+    def __init__(self, transport, filename):
+        self.transport = transport
+        self.idProduct = transport.idProduct
+        self.serial = None
+        self.filename = filename
+        self._f = None
+        self._lock = threading.Lock()
+
+    def _record(self, kind, endpoint, count, t0, payload=b''):
+        rec = pack(DBTR_RECORD, kind, endpoint, count, t0 - self._t0, monotonic() - t0, len(payload))
+        with self._lock:
+            self._f.write(rec)
+            self._f.write(payload)
+
+    def _call(self, kind, endpoint, count, fn, *args, **kwargs):
+        t0 = monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            self._record(kind | TRACE_ERROR, endpoint, count, t0, 
+                         f'{type(e).__name__}: {e}'.encode('utf-8'))
+            raise
+        return t0, result
+
+    def open(self):
+        self._t0 = monotonic()
+        t0 = monotonic()
+        self.transport.open()
+        self.serial = self.transport.serial
+        serial = self.serial.encode('utf-8')
+        self._f = gzip.open(self.filename, 'wb', compresslevel=1)
+        self._f.write(pack(DBTR_HEADER, b'DBTR', 1, self.idProduct, len(serial)) + serial)
+        self._record(TRACE_OPEN, 0, 0, t0)
+
+    def write(self, endpoint, data, timeout=None) -> int:
+        t0, n = self._call(TRACE_WRITE, endpoint, 0, self.transport.write, endpoint, data, timeout=timeout)
+        self._record(TRACE_WRITE, endpoint, n, t0, bytes(data))
+        return n
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        size = size_or_buffer if isinstance(size_or_buffer, int) else len(size_or_buffer)
+        t0, result = self._call(TRACE_READ, endpoint, size, self.transport.read, 
+                                endpoint, size_or_buffer, timeout=timeout)
+        if isinstance(result, int):
+            data = memoryview(size_or_buffer).cast('B')[:result]
+        else:
+            data = result
+        self._record(TRACE_READ, endpoint, size, t0, bytes(data))
+        return result
+
+    def close(self):
+        if self._f is None: return
+        t0, _ = self._call(TRACE_CLOSE, 0, 0, self.transport.close)
+        self._record(TRACE_CLOSE, 0, 0, t0)
+        self._f.close()
+        self._f = None
+
+
+class ReplayTransport:
+    """
+    Transport feeding a trace recorded by RecordingTransport back to an
+    unmodified digiBase, at the original pace scaled by speed (None 
+    replays as fast as possible). Calls must come in the recorded order;
+    exceptions are raised again where they happened. 
+
+    When several threads use the device (a ListModeStream reader and
+    the thread stopping it) their interleaving differs from run to run;
+    queries without side effects (list mode polls and status reads)
+    absorb the difference:
+
+    - recorded empty polls and status reads are dropped when another
+      call comes early past them (_skip_to)
+    - a command (with its response) that comes early is taken out of 
+      order from behind queries still to be replayed (_take_out_of_order)
+    - queries beyond the recorded ones get the answer the device would 
+      have given: an empty poll, the last recorded status (acquiring if
+      the last status write started it) (_can_answer)
+
+    Any other mismatch raises ValueError, a call past the end of the 
+    trace EOFError.
+
+    >>> base = digiBase(transport=ReplayTransport('field.dbtr', speed=None))
+    """
+    EXCEPTIONS = {'TimeoutError': TimeoutError}
+    POLL, STATUS = b'\x80', b'\x01'
+
+    def __init__(self, filename, speed: float=1.0):
+        self.speed = speed
+        self.events = []
+        hsize, rsize = calcsize(DBTR_HEADER), calcsize(DBTR_RECORD)
+        data = bytearray()
+        with gzip.open(filename, 'rb') as f:
+            try:
+                while chunk := f.read(1 << 16): data += chunk
+            except EOFError:
+                pass    # Not closed by the recorder; the records after data are lost
+        data = bytes(data)
+        magic, version, self.idProduct, nserial = unpack(DBTR_HEADER, data[:hsize])
+        if magic != b'DBTR' or version != 1: raise ValueError("Not a DBTR trace")
+        pos = hsize
+        self.serial = data[pos:pos+nserial].decode('utf-8')
+        pos += nserial
+        # A trace cut short by a crash ends at the last complete record
+        while pos + rsize <= len(data):
+            kind, endpoint, count, t, dt, n = unpack(DBTR_RECORD, data[pos:pos+rsize])
+            if pos + rsize + n > len(data): break
+            self.events.append((kind, endpoint, count, t, dt, data[pos+rsize:pos+rsize+n]))
+            pos += rsize + n
+        self.position = 0
+        self.extra_queries = 0      # Polls and status reads beyond the trace
+        self.skipped_queries = 0    # Recorded empty polls and status reads dropped
+        self.reordered = 0          # Commands taken out of order
+        self._lock = threading.Lock()
+        self._taken = set()         # Events ahead of position already taken
+        self._reply = None          # Response of a command taken out of order
+        self._owed = []             # (query, synthetic response or None if recorded)
+        self._status = None         # Last recorded status register response
+        self._t0 = None
+
+    @staticmethod
+    def _exception(name):
+        "Exception class of a recorded error; pyusb's only if it is installed"
+        if name.startswith('USB'):
+            try:
+                return getattr(_usb().core, name)
+            except (ImportError, AttributeError):
+                pass
+        return ReplayTransport.EXCEPTIONS.get(name, IOError)
+
+    @staticmethod
+    def _settings(data):
+        """
+        A command as compared to the trace: of status writes only the
+        start bit and the configuration (CONFIG_FIELDS), the rest is
+        echoed by the host from whatever status it read last
+        """
+        if len(data) != 81 or data[0] != 0: return data
+        reg = bit_register(int.from_bytes(data[1:], byteorder='little'))
+        return (reg[1],) + tuple(reg[sl] for sl in CONFIG_FIELDS.values())
+
+    def _matches(self, event, kind, endpoint, data) -> bool:
+        return (event[0] & ~TRACE_ERROR, event[1]) == (kind, endpoint) and \
+               (data is None or event[0] & TRACE_ERROR or 
+                self._settings(event[5]) == self._settings(data))
+
+    def _is_query(self, i) -> bool:
+        return self.events[i][0] == TRACE_WRITE and self.events[i][5] in (self.POLL, self.STATUS)
+
+    def _is_skippable(self, i) -> bool:
+        "Whether events i, i+1 are an empty poll or a status read, which have no side effects"
+        if i + 1 >= len(self.events) or not self._is_query(i): return False
+        resp = self.events[i+1]
+        return resp[0] == TRACE_READ and (self.events[i][5] == self.STATUS or len(resp[5]) == 0)
+
+    def _find(self, kind, endpoint, data):
+        """
+        Index of the event for this call and whether only skippable 
+        queries lie before it; None if it is not within reach
+        """
+        i = self.position
+        skippable = True
+        while i < len(self.events):
+            event = self.events[i]
+            if i in self._taken: 
+                i += 1
+            elif self._matches(event, kind, endpoint, data): 
+                return i, skippable
+            elif self._is_skippable(i):
+                i += 2
+            elif self._is_query(i) or event[0] == TRACE_READ:
+                skippable = False
+                i += 1
+            else:
+                break   # Commands with side effects keep their order
+        return None, False
+
+    def _next(self, kind, endpoint, data=None):
+        "Take the event for a kind call on endpoint (writing data); None for an extra query"
+        with self._lock:
+            while self.position in self._taken:
+                self._taken.discard(self.position)
+                self.position += 1
+            if self.position >= len(self.events) or \
+               (self.events[self.position][0] == TRACE_CLOSE and kind != TRACE_CLOSE):
+                raise EOFError("End of trace")
+            i, skippable = self._find(kind, endpoint, data)
+            if i is not None and (skippable or i == self.position):
+                self._skip_to(i)
+            elif i is not None and kind == TRACE_WRITE and self._has_reply(i):
+                self._take_out_of_order(i)
+            elif kind == TRACE_WRITE and self._can_answer(data):
+                return None
+            else:
+                event = self.events[self.position]
+                what = 'different data' if event[0] == kind else f'kind {kind}'
+                raise ValueError(f"Replay diverged from trace at event {self.position}: "
+                                 f"expected kind {event[0]} on endpoint {event[1]:02x}, "
+                                 f"got {what} on endpoint {endpoint:02x}")
+        return self._replay(self.events[i])
+
+    def _skip_to(self, i):
+        """
+        Rule 1: recorded exchanges before event i are dropped if the 
+        call matches event i and all of them are empty polls or status
+        reads (_is_skippable). Such queries have no side effects, so the
+        host not making them again changes nothing on the device. The
+        last dropped status read is kept for answering extra queries.
+        """
+        for k in range(self.position, i, 2):
+            if self.events[k][5] == self.STATUS: self._status = self.events[k+1][5]
+        self.skipped_queries += (i - self.position) // 2
+        self.position = i + 1
+
+    def _has_reply(self, i) -> bool:
+        return i + 1 < len(self.events) and self.events[i+1][0] & ~TRACE_ERROR == TRACE_READ
+
+    def _take_out_of_order(self, i):
+        """
+        Rule 2: a command at event i with a recorded response is taken 
+        ahead of queries still to be replayed - polls that returned 
+        data and status reads, which are kept for later calls. _find() 
+        only looks past queries, so no command with side effects is 
+        overtaken. The response is handed to the next read.
+        """
+        self._taken.update((i, i + 1))
+        self._reply = self.events[i+1]
+        self.reordered += 1
+
+    def _can_answer(self, data) -> bool:
+        """
+        Rule 3: a poll or status read with no recorded exchange within 
+        reach gets the answer the device would give, an empty poll or
+        the last recorded status (acquiring if a status write since 
+        started it). Status reads only once a status has been recorded.
+        """
+        return data == self.POLL or (data == self.STATUS and self._status is not None)
+
+    def _replay(self, event):
+        "Pace and raise as recorded"
+        if self.speed is not None:
+            # Return when the recorded call returned
+            delay = (event[3] + event[4]) / self.speed - (monotonic() - self._t0)
+            if delay > 0: sleep(delay)
+        if event[0] & TRACE_ERROR:
+            name, _, msg = event[5].decode('utf-8').partition(': ')
+            raise self._exception(name)(msg)
+        return event
+
+    def open(self):
+        self._t0 = monotonic()
+        self.position = 0
+        self._next(TRACE_OPEN, 0)
+
+    def write(self, endpoint, data, timeout=None) -> int:
+        data = bytes(data)
+        event = self._next(TRACE_WRITE, endpoint, data)
+        with self._lock:
+            if len(data) == 81 and data[0] == 0 and self._status is not None:
+                # Status write: start (bit 1) and busy (bit 8) follow it
+                acquiring = data[1] & 0x02
+                status = bytearray(self._status)
+                status[0] = (status[0] & ~0x02) | acquiring
+                status[1] = (status[1] & ~0x01) | (acquiring >> 1)
+                self._status = bytes(status)
+            if data in (self.POLL, self.STATUS):
+                # Responses come back in the order the queries were written
+                if event is None:
+                    self.extra_queries += 1
+                    self._owed.append((data, b'' if data == self.POLL else self._status))
+                    return len(data)
+                self._owed.append((data, None))
+        return event[2]
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        with self._lock:
+            query, data = self._owed.pop(0) if self._owed else (None, None)
+            event, self._reply = (self._reply, None) if data is None else (None, self._reply)
+        if data is None: 
+            if event is not None:
+                data = self._replay(event)[5]
+            else:
+                data = self._next(TRACE_READ, endpoint)[5]
+            if query == self.STATUS:
+                with self._lock: self._status = data
+        if isinstance(size_or_buffer, int): return array('B', data)
+        memoryview(size_or_buffer).cast('B')[:len(data)] = data
+        return len(data)
+
+    def close(self):
+        pass
+
+
+class digiBaseEmulator:
+    """
+    In-process software stand-in for a digiBase, to be used as the 
+    transport of a digiBase object when no hardware is at hand:
+
+    >>> base = digiBase(transport=digiBaseEmulator(rate=5000.0))
+
+    It implements the parts of the USB protocol that digiBase uses:
+    the firmware load handshake of both the RH and non-RH variants, 
+    the 80-byte status register with livetime / realtime counters and
+    presets, the 0x80 spectrum and list mode readout and the 0x02
+    spectrum clear. PMT hits arrive as a Poisson process at the given 
+    rate; their ADC values follow a simple spectrum of an exponential 
+    continuum plus a photopeak, both scaling with the fine gain. In
+    list mode, hits and time rollover words are queued in a finite
+    device buffer; acquisition stops when it is full.
+
+    Parameters
+    ----------
+    rh : bool
+        Emulate a digiBASE-RH (product ID 0x1f) instead of a digiBASE
+    serial : str
+        Device S/N
+    rate : float
+        Mean hit rate, in Hz
+    configured : bool
+        Start with the firmware already loaded (a warm device)
+    buffer_size : int
+        Depth of the list mode buffer, in 32-bit words
+    max_transfer : int
+        Maximum number of bytes returned by one list mode read
+    peak : float
+        Photopeak channel at a fine gain of 1
+    peak_fraction : float
+        Fraction of hits in the photopeak
+    clock : callable
+        Time source, in seconds; time.monotonic if None
+    seed : int
+        Random number generator seed
+    """
+    PACKET_SIZE = 64
+
+    def __init__(self, rh: bool=False, serial: str='0', rate: float=1000.0,
+                 configured: bool=False, buffer_size: int=32768, 
+                 max_transfer: int=4096, peak: float=600.0, 
+                 peak_fraction: float=0.3, clock=None, seed: int=None):
+        self.idProduct = 0x001f if rh else 0x000f
+        self.isRH = rh
+        self.serial = serial
+        self.rate = rate
+        self.configured = configured
+        self.max_transfer = max_transfer
+        self.peak = peak
+        self.peak_fraction = peak_fraction
+        self.clock = clock if clock is not None else monotonic
+        self.rng = np.random.default_rng(seed)
+        self.firmware = b''
+        self.overflowed = False
+
+        self._status = bit_register(int.from_bytes(
+            STAT_2[1:] if rh else dict_to_status(STAT_6), byteorder='little'))
+        self._status[96:128] = 0x200000     # Fine gain 0.5
+        self._spectrum = np.zeros(1024, dtype=np.uint32)
+        self._buffer = np.zeros(buffer_size, dtype=np.uint32)
+        self._first = 0                     # List buffer holds _buffer[_first:_first+_nbuffer]
+        self._nbuffer = 0
+        self._livetime = 0.0
+        self._clock_us = 0                  # List mode time, in microseconds
+        self._last = self.clock()
+        self._hv_adc_until = 0.0
+        self._partial = None                # Write waiting for a ZLP
+        self._responses = {0x81: [], 0x82: []}
+
+    # --- Transport interface
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def write(self, endpoint, data, timeout=None) -> int:
+        data = bytes(data)
+        n = len(data)
+        if self.isRH and endpoint == 0x01:
+            self._init_command(data)
+        elif endpoint == (0x08 if self.isRH else 0x02):
+            # A transfer that is a multiple of the packet size is only
+            # complete when terminated by a zero-length packet
+            if self._partial is not None:
+                if len(data) == 0: 
+                    data, self._partial = self._partial, None
+                else:
+                    self._partial += data
+                    return n
+            elif n > 0 and n % self.PACKET_SIZE == 0:
+                self._partial = data
+                return n
+            self._command(data)
+        else:
+            raise IOError(f"Invalid endpoint {endpoint:02x}")
+        return n
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        queue = self._responses.get(endpoint)
+        if queue is None: raise IOError(f"Invalid endpoint {endpoint:02x}")
+        if len(queue) == 0: raise TimeoutError("Operation timed out")
+        resp = queue.pop(0)
+        size = size_or_buffer if isinstance(size_or_buffer, int) else len(size_or_buffer)
+        if callable(resp): resp = resp(size)
+        resp = resp[:size]
+        if isinstance(size_or_buffer, int): return array('B', resp)
+        memoryview(size_or_buffer)[:len(resp)] = resp
+        return len(resp)
+
+    # --- Device emulation
+
+    def _init_command(self, cmd):
+        "RH firmware load handshake on the init endpoint"
+        op = cmd[0]
+        if op == 0x06:
+            self._respond(0x81, b'\x00\x00' if self.configured or len(self.firmware) > 0 
+                          else b'\x04\x80')
+            if len(self.firmware) > 0: self.configured = True
+        elif op == 0x04:
+            self.firmware = b''
+            self._respond(0x81, b'\x00\x00')
+        elif op == 0x05:
+            self.firmware += cmd[4:]
+            self._respond(0x81, b'\x00\x00')
+        else:
+            self._respond(0x81, b'\x00\x00')
+
+    def _command(self, cmd):
+        if len(cmd) == 0:
+            self._respond(0x82, b'\x00')
+            return
+        op = cmd[0]
+        if op == 0x00:
+            self._write_status(cmd[1:81])
+            self._respond(0x82, b'' if self.isRH else b'\x00')
+        elif op == 0x01:
+            self._advance()
+            self._respond(0x82, self._read_status())
+        elif op == 0x02:
+            self._spectrum[:] = 0
+            self._respond(0x82, b'')
+        elif op == 0x80:
+            self._respond(0x82, self._readout)
+        elif not self.isRH and op == 0x06:
+            self._respond(0x82, b'\x01' if self.configured or len(self.firmware) > 0 else b'\x00')
+            if len(self.firmware) > 0: self.configured = True
+        elif not self.isRH and op == 0x04:
+            self.firmware = b''
+            self._respond(0x82, b'\x00')
+        elif not self.isRH and op == 0x05:
+            self.firmware += cmd[1:]
+            self._respond(0x82, b'\x00')
+        else:
+            self._respond(0x82, b'')
+
+    def _respond(self, endpoint, resp):
+        self._responses[endpoint].append(resp)
+
+    def _read_status(self) -> bytes:
+        st = self._status
+        st[224:256] = int(self._livetime * 50) & 0xffff_ffff
+        st[288:320] = int(self._livetime * 50) & 0xffff_ffff
+        hv = st[336:352] if st[6] else 0
+        st[24:32] = hv & 0xff
+        st[13:15] = (hv >> 8) & 0x3
+        st[11] = 1 if self.clock() < self._hv_adc_until else 0
+        return st.reg.to_bytes(80, byteorder='little')
+
+    def _write_status(self, data):
+        self._advance()
+        old = self._status
+        new = bit_register(int.from_bytes(data, byteorder='little'))
+        # Read-only fields keep their device values
+        for sl in (slice(8, 9), slice(96, 128)):
+            new[sl] = old[sl]
+        if new[151]:
+            # Fine gain write strobe
+            new[96:128] = new[128:151]
+            new[151] = 0
+        if new[608]:
+            self._livetime = 0.0
+            self._clock_us = 0
+            self._first = 0
+            self._nbuffer = 0
+        if new[610] and not old[610]:
+            self._hv_adc_until = self.clock() + 0.005
+        if new[1] and not old[1]:
+            new[8] = 1
+            self.overflowed = False
+        elif not new[1]:
+            new[8] = 0
+        self._status = new
+
+    def _readout(self, size):
+        self._advance()
+        if self._status[0]:
+            return self._spectrum.tobytes()
+        n = min(size, self.max_transfer) // 4
+        n = min(n, self._nbuffer)
+        words = self._buffer[self._first:self._first+n].tobytes()
+        self._first += n
+        self._nbuffer -= n
+        if self._nbuffer == 0: self._first = 0
+        return words
+
+    def _stop(self):
+        # Stopping on its own the device clears the start bit as well
+        self._status[1] = 0
+        self._status[8] = 0
+
+    def _advance(self):
+        "Run the acquisition up to the current time"
+        now = self.clock()
+        dt = now - self._last
+        self._last = now
+        st = self._status
+        if not st[8] or dt <= 0: return
+        # Stop at the presets (realtime equals livetime here)
+        remaining = float('inf')
+        if st[2]: remaining = min(remaining, st[192:224] / 50 - self._livetime)
+        if st[3]: remaining = min(remaining, st[256:288] / 50 - self._livetime)
+        if remaining <= dt:
+            dt = max(remaining, 0.0)
+            self._stop()
+        if not st[0]:
+            # No point in generating (many) more hits than fit the list buffer
+            free = len(self._buffer) - self._nbuffer
+            dt = min(dt, (2 * free + 100) / max(self.rate, 1e-9))
+        
+        n = self.rng.poisson(self.rate * dt)
+        gain = st[96:128] / 0x400000
+        in_peak = self.rng.random(n) < self.peak_fraction
+        ch = np.where(in_peak,
+                      self.rng.normal(self.peak * gain, 0.03 * self.peak * gain, n),
+                      self.rng.exponential(0.25 * self.peak * gain, n))
+        adc = np.clip(ch, 0, 1023).astype(np.uint32)
+        keep = adc >= st[170:180]
+
+        if st[0]:
+            self._spectrum += np.bincount(adc[keep], minlength=1024).astype(np.uint32)
+            self._livetime += dt
+            return
+
+        # List mode: hit words plus a rollover word at each 2^21 us boundary
+        t0 = self._clock_us
+        t1 = t0 + int(dt * 1e6)
+        t = np.sort(self.rng.integers(t0, max(t1, t0 + 1), n))[keep]
+        words = (adc[keep] << 21) | (t.astype(np.uint32) & 0x1f_ffff)
+        bounds = np.arange((t0 >> 21) + 1, (t1 >> 21) + 1, dtype=np.int64) << 21
+        if len(bounds) > 0:
+            rollover = (0x8000_0000 | (bounds & 0x7fff_ffff)).astype(np.uint32)
+            words = np.insert(words, np.searchsorted(t, bounds), rollover)
+        free = len(self._buffer) - self._nbuffer
+        if len(words) > free:
+            # Device buffer full - acquisition stops, roughly when it filled up
+            self.overflowed = True
+            self._stop()
+            dt *= free / len(words)
+            t1 = t0 + int(dt * 1e6)
+            words = words[:free]
+        end = self._first + self._nbuffer
+        if end + len(words) > len(self._buffer):
+            self._buffer[:self._nbuffer] = self._buffer[self._first:end]
+            self._first, end = 0, self._nbuffer
+        self._buffer[end:end+len(words)] = words
+        self._nbuffer += len(words)
+        self._clock_us = t1
+        self._livetime += dt
+
+
+
+class PollScheduler:
+    """
+    Rate-adaptive pause between list mode polls.
+
+    A read shorter than the largest so far emptied the device list
+    buffer; reads as large may have been cut short by the USB transfer
+    size and are followed by another read at once. The words drained 
+    since the buffer was last empty tell how full it got and, over the
+    time since, the rate words arrive at (the estimate rises at once
+    and decays with time constant tau when the rate drops). The next
+    poll is scheduled for when the buffer is expected to be half way 
+    to the watermark: back to back during bursts, backing off to 
+    max_interval while the detector is quiet.
+
+    >>> stream = base.list_mode_stream(scheduler=PollScheduler(watermark=0.5))
+    >>> ...
+    >>> stream.scheduler.summary()
+
+    Parameters
+    ----------
+    buffer_words : int
+        Depth of the device list buffer, in 32-bit words
+    watermark : float
+        Fraction of the device buffer to keep occupancy below
+    max_interval : float
+        Longest pause between polls, in seconds
+    min_interval : float
+        Pauses shorter than this are not worth sleeping for, in seconds
+    tau : float
+        Decay time constant of the rate estimate, in seconds
+    clock : callable
+        Time source, in seconds; time.monotonic if None
+    """
+    def __init__(self, buffer_words: int=32768, watermark: float=0.5, 
+                 max_interval: float=0.05, min_interval: float=0.001, 
+                 tau: float=1.0, clock=None):
+        if not 0 < watermark <= 1: raise ValueError("Watermark must be in (0, 1]")
+        self.buffer_words = buffer_words
+        self.watermark = watermark
+        self.max_interval = max_interval
+        self.min_interval = min_interval
+        self.tau = tau
+        self.clock = clock if clock is not None else monotonic
+        self.reset()
+
+    def reset(self):
+        self.rate = 0.0             # Estimated words per second
+        self.peak_rate = 0.0
+        self.polls = 0
+        self.empty_polls = 0
+        self.busy_polls = 0         # Polls followed by another without pause
+        self.sleep_time = 0.0       # Total of the pauses, in seconds
+        self.occupancy = 0.0        # Device buffer fill when last emptied, fraction
+        self.max_occupancy = 0.0
+        self.max_read = 0           # Largest read, in words
+        self._backlog = 0           # Words read since the buffer was last empty
+        self._last = None           # When the buffer was last empty
+
+    def update(self, words: int) -> float:
+        "Account for a poll that returned words; the pause until the next one, in seconds"
+        now = self.clock()
+        self.polls += 1
+        if words == 0: self.empty_polls += 1
+        capped = words > 0 and words >= self.max_read
+        self.max_read = max(self.max_read, words)
+        self._backlog += words
+        if capped:
+            interval = 0.0
+        else:
+            self.occupancy = self._backlog / self.buffer_words
+            self.max_occupancy = max(self.max_occupancy, self.occupancy)
+            if self._last is not None and now > self._last:
+                dt = now - self._last
+                sample = self._backlog / dt
+                decayed = self.rate + (1 - np.exp(-dt / self.tau)) * (sample - self.rate)
+                self.rate = max(sample, decayed)
+                self.peak_rate = max(self.peak_rate, self.rate)
+            self._backlog = 0
+            self._last = now
+            if self.rate > 0:
+                interval = min(0.5 * self.watermark * self.buffer_words / self.rate, 
+                               self.max_interval)
+            else:
+                interval = self.max_interval
+        if interval < self.min_interval:
+            interval = 0.0
+            self.busy_polls += 1
+        self.sleep_time += interval
+        return interval
+
+    def summary(self) -> dict:
+        "Poll statistics"
+        return {
+            'polls': self.polls,
+            'empty_polls': self.empty_polls,
+            'busy_polls': self.busy_polls,
+            'sleep_time': self.sleep_time,
+            'rate': self.rate,
+            'peak_rate': self.peak_rate,
+            'max_occupancy': self.max_occupancy,
+        }
+
+
+class ListModeStream:
+    """
+    Background readout of list mode data.
+
+    A dedicated reader thread does nothing but drain the device
+    list buffer into a preallocated in-memory ring buffer so that
+    slow consumers (file writes, console output, ...) do not stall
+    the readout. Consumers pull blocks of uint32 words from the
+    ring by iterating over the stream:
+
+    >>> base.set_acq_mode_list()
+    >>> with base.list_mode_stream() as stream:
+    ...     for block in stream:
+    ...         f.write(block)
+
+    The stream starts the acquisition on start() and stops it on
+    stop(), after which the device buffer is drained and iteration
+    ends once all remaining words have been consumed.
+
+    Parameters
+    ----------
+    base : digiBase
+        Device to read out
+    capacity : int
+        Size of the ring buffer, in 32-bit words
+    block_size : int
+        Maximum number of words in a block handed to consumers
+    status_interval : float
+        Interval, in seconds, at which the reader checks whether the
+        device stopped acquiring while the endpoint is idle
+    depth : int
+        Number of list mode requests kept in flight; values above 1 
+        read through digiBase.hits_burst() and are not verified on
+        hardware
+    scheduler : PollScheduler
+        Paces the device polls to the hit rate; the device is polled
+        back to back if None
+    """
+    def __init__(self, base, capacity: int=1 << 24, block_size: int=1 << 16,
+                 status_interval: float=1.0, depth: int=1, scheduler: PollScheduler=None):
+        self.base = base
+        self.depth = depth
+        self.scheduler = scheduler
+        self.block_size = block_size
+        self.status_interval = status_interval
+        self._ring = np.empty(capacity, dtype=np.uint32)
+        self._head = 0      # Total words written into the ring
+        self._tail = 0      # Total words taken out of the ring
+        self._cv = threading.Condition()
+        self._stopping = threading.Event()
+        self._done = False
+        self._stopped = False
+        self._thread = None
+        self.words = 0          # Words read from the device
+        self.high_water = 0     # Maximum ring occupancy, in words
+        self.max_read = 0       # Largest single device read, in words
+        self.dropped = 0        # Words lost because the ring was full
+        self.overflow = False   # Device stopped acquiring on its own
+        self.error = None       # Exception raised in the reader thread
+        self._drained = 0       # Words read since the device buffer was last emptied
+
+    @property
+    def capacity(self) -> int:
+        return len(self._ring)
+
+    @property
+    def pending(self) -> int:
+        "Number of words in the ring waiting to be consumed"
+        with self._cv:
+            return self._head - self._tail
+
+    def start(self):
+        "Start the acquisition and the reader thread"
+        if self._thread is not None: raise RuntimeError("Stream already started")
+        self.base.start()
+        self._thread = threading.Thread(
+            target=self._reader, name=f'digiBase-{self.base.serial}-reader', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the acquisition and wait for the reader thread to drain 
+        what is left in the device buffer. Words already in the ring 
+        can still be consumed after this returns.
+        """
+        if self._thread is None or self._stopped: return
+        self._stopped = True
+        self.base.stop()
+        self._stopping.set()
+        self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def __iter__(self):
+        return self.blocks()
+
+    def blocks(self, timeout: float=None):
+        """
+        Generate blocks of list mode words (copies, safe to keep) until
+        the stream is stopped and the ring is empty. With a timeout, an
+        empty block is yielded whenever no data arrived within timeout
+        seconds so that the consumer can do housekeeping.
+        """
+        cap = len(self._ring)
+        while True:
+            with self._cv:
+                if self._head == self._tail and not self._done:
+                    self._cv.wait(timeout)
+                avail = self._head - self._tail
+                if avail == 0 and self._done: break
+                i = self._tail % cap
+                n = min(avail, self.block_size, cap - i)
+            if n == 0:
+                # Not under the lock: the consumer may call stop() meanwhile
+                if timeout is not None: yield np.empty(0, dtype=np.uint32)
+                continue
+            block = self._ring[i:i+n].copy()
+            with self._cv:
+                self._tail += n
+            yield block
+        if self.error is not None: raise self.error
+
+    def _push(self, words):
+        cap = len(self._ring)
+        n = len(words)
+        with self._cv:
+            free = cap - (self._head - self._tail)
+        if n > free:
+            self.dropped += n - free
+            n = free
+        i = self._head % cap
+        first = min(n, cap - i)
+        self._ring[i:i+first] = words[:first]
+        self._ring[:n-first] = words[first:n]
+        with self._cv:
+            self._head += n
+            self.high_water = max(self.high_water, self._head - self._tail)
+            self._cv.notify_all()
+
+    def _accept(self, words) -> int:
+        "Take in one device read"
+        n = len(words)
+        metrics = self.base.metrics
+        if metrics is not None:
+            # A read shorter than the largest one emptied the device buffer:
+            # the words read since the last such read had piled up in it
+            self._drained += n
+            if n < self.max_read and self._drained > 0:
+                metrics.list_buffer(self._drained)
+                self._drained = 0
+        if n > 0:
+            self.words += n
+            self.max_read = max(self.max_read, n)
+            self._push(words)
+        return n
+
+    def _device_stopped(self) -> bool:
+        "Check whether the device stopped acquiring; flag an overflow if no preset explains it"
+        # A private copy: replacing the shadow register could undo a setter
+        # running concurrently in another thread
+        st = self.base._read_status()
+        if st[8]: return False
+        preset_reached = (st[2] and st[224:256] >= st[192:224]) or \
+                         (st[3] and st[288:320] >= st[256:288])
+        if not preset_reached:
+            self.overflow = True
+            self.base.log.warning('Device stopped acquisition - list buffer overflow?')
+        return True
+
+    def _reader(self):
+        try:
+            last_check = monotonic()
+            while True:
+                # Only a read that started after the stop may end the drain
+                stopping = self._stopping.is_set()
+                if self.depth > 1:
+                    n = 0
+                    for words in self.base.hits_burst(self.depth):
+                        n += self._accept(words)
+                else:
+                    n = self._accept(self.base.hits_array())
+                if n == 0:
+                    # Endpoint is empty: finish when asked to or when the device stops
+                    if stopping: break
+                    if monotonic() - last_check > self.status_interval:
+                        last_check = monotonic()
+                        if self._device_stopped():
+                            # Anything still left is read on the next pass
+                            self._stopping.set()
+                if self.scheduler is not None:
+                    # A stop cuts the pause short so the drain starts at once
+                    interval = self.scheduler.update(n)
+                    if interval > 0: self._stopping.wait(interval)
+        except Exception as e:
+            self.error = e
+        finally:
+            with self._cv:
+                self._done = True
+                self._cv.notify_all()
+        if self.dropped > 0:
+            self.base.log.warning(f'Ring buffer full - dropped {self.dropped} words')
+
+
+class HitDecoder:
+    """
+    Vectorized decoder for list mode hit words.
+
+    Splits the raw 32-bit words read from the device into PMT hits and
+    time rollover words and rebuilds 64-bit timestamps (in microseconds)
+    from the 21-bit hit time field. The rollover epoch is kept between
+    calls so that consecutive chunks of a run - e.g. successive reads
+    of ``digiBase.hits`` - decode correctly. Wraps of the 31-bit epoch
+    itself are unwrapped as well.
+
+    >>> dec = HitDecoder()
+    >>> for chunk in chunks:
+    ...     t, adc = dec.decode(chunk)
+    """
+    ROLLOVER   = 0x8000_0000
+    EPOCH_MASK = 0x7fff_ffff
+    TIME_MASK  = 0x001f_ffff
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        "Forget the rollover state, e.g. at the start of a new run"
+        self.epoch = 0      # Last epoch seen, unwrapped, in microseconds
+        self.rollovers = 0  # Number of rollover words seen
+
+    def decode(self, words) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Decode a chunk of list mode words.
+
+        Parameters
+        ----------
+        words : array-like
+            Raw uint32 words as read from the device (anything
+            that supports the buffer protocol or converts to an
+            uint32 NumPy array)
+
+        Returns
+        -------
+        (t, adc) : tuple of np.ndarray
+            Hit times in microseconds (int64) and ADC values (uint16)
+        """
+        w = np.asarray(words, dtype=np.uint32)
+        if w.ndim != 1: w = w.ravel()
+        is_roll = (w & HitDecoder.ROLLOVER) != 0
+        roll_idx = np.flatnonzero(is_roll)
+        hit_mask = ~is_roll
+
+        if len(roll_idx) == 0:
+            hits = w[hit_mask]
+            t = (hits & HitDecoder.TIME_MASK).astype(np.int64) + self.epoch
+            return t, ((hits >> 21) & 0x3ff).astype(np.uint16)
+
+        # Unwrapped epochs of this chunk, prefixed by the carried epoch.
+        # A decrease of the 31-bit epoch means it wrapped around.
+        raw = np.empty(len(roll_idx) + 1, dtype=np.int64)
+        raw[0] = self.epoch & HitDecoder.EPOCH_MASK
+        raw[1:] = w[roll_idx] & HitDecoder.EPOCH_MASK
+        wraps = np.cumsum(np.diff(raw) < 0)
+        epochs = np.empty_like(raw)
+        epochs[0] = self.epoch
+        epochs[1:] = raw[1:] + (self.epoch - raw[0]) + (wraps << 31)
+
+        # Each hit takes the epoch of the closest preceding rollover
+        # word (index 0 if there is none in this chunk)
+        which = np.cumsum(is_roll)[hit_mask]
+        hits = w[hit_mask]
+        t = (hits & HitDecoder.TIME_MASK).astype(np.int64) + epochs[which]
+
+        self.epoch = int(epochs[-1])
+        self.rollovers += len(roll_idx)
+        return t, ((hits >> 21) & 0x3ff).astype(np.uint16)
+
+    __call__ = decode
+
+
+def decode_hits(words) -> tuple[np.ndarray, np.ndarray]:
+    "Decode a complete list of hit words; see HitDecoder"
+    return HitDecoder().decode(words)
+
+
+class RoiResult(NamedTuple):
+    "Per ROI outcome of one RoiDetector update"
+    raw: np.ndarray         # Counts in the ROI this interval
+    expected: np.ndarray    # Expected background counts in the ROI
+    net: np.ndarray         # Background subtracted counts, EMA smoothed
+    statistic: np.ndarray   # CUSUM or SPRT log-likelihood ratio
+    alarm: np.ndarray       # True where the statistic crossed the threshold
+
+
+class RoiDetector:
+    """
+    Background subtracted signal detection in many ROIs at once.
+
+    The background is turned into a cumulative-sum table once, so that
+    the counts of any number of ROIs [lo, hi) come from two lookups each,
+    for the background and for every interval spectrum alike. Per ROI
+    the detector keeps the EMA of the net counts (as ``detect`` always
+    printed) and a sequential test of the Poisson hypotheses
+
+        H0: rate = background,   H1: rate = ratio * background
+
+    either as CUSUM (alarm when the one-sided cumulative sum of the
+    log-likelihood ratio exceeds ``threshold``; it never stops) or as
+    Wald's SPRT (alarm when the summed log-likelihood ratio reaches
+    ``threshold``, dismissed when it falls below ``lower``; both decisions
+    restart the test).
+
+    Parameters
+    ----------
+    background : array-like
+        Background spectrum, counts per channel
+    exposure : float
+        Livetime of the background spectrum, seconds
+    rois : array-like
+        N x 2 ROI channel bounds, low inclusive, high exclusive
+    norm_roi : tuple, optional
+        Scale the background to the counts in this ROI instead of
+        the livetime of each interval
+    alpha : float
+        Exponential moving average parameter of the net counts
+    ratio : float
+        Signal to background rate ratio the tests are tuned for
+    method : str
+        'cusum' or 'sprt'
+    threshold : float
+        Alarm threshold of the log-likelihood ratio; ln(1000) by default
+    lower : float
+        SPRT lower bound; -ln(1000) by default
+
+    >>> det = RoiDetector(bkg, exposure, [(500, 560), (640, 700)])
+    >>> result = det.push(base.spectrum_array(), base.livetime)
+    """
+    def __init__(self, background, exposure: float, rois, norm_roi=None, 
+                 alpha: float=1.0, ratio: float=1.5, method: str='cusum', 
+                 threshold: float=None, lower: float=None):
+        if method not in ('cusum', 'sprt'): raise ValueError(f"Unknown method {method}")
+        if ratio <= 1.0: raise ValueError("ratio must be > 1")
+        if not 0.0 < alpha <= 1.0: raise ValueError("alpha must be in (0, 1]")
+        background = np.asarray(background, dtype=np.float64)
+        self.nchan = len(background)
+        self.rois = np.array(rois, dtype=np.intp).reshape(-1, 2)
+        if norm_roi is not None: norm_roi = tuple(int(x) for x in norm_roi)
+        bounds = self.rois if norm_roi is None else np.vstack((self.rois, [norm_roi]))
+        if np.any(bounds[:, 0] < 0) or np.any(bounds[:, 1] > self.nchan) or \
+           np.any(bounds[:, 0] >= bounds[:, 1]):
+            raise ValueError("ROIs must satisfy 0 <= lo < hi <= # channels")
+        self.norm_roi = norm_roi
+        self.alpha = alpha
+        self.method = method
+        self.log_ratio = np.log(ratio)
+        self.ratio = ratio
+        self.threshold = np.log(1000.0) if threshold is None else threshold
+        self.lower = -np.log(1000.0) if lower is None else lower
+
+        # Background rates (counts per second) of the ROIs and of the norm ROI
+        self.exposure = exposure
+        self._bkg_cumsum = np.concatenate(([0.0], np.cumsum(background)))
+        self.bkg_rate = self.roi_sums(self._bkg_cumsum) / exposure
+        if norm_roi is not None:
+            self.bkg_norm = (self._bkg_cumsum[norm_roi[1]] - self._bkg_cumsum[norm_roi[0]]) / exposure
+        self._cumsum = np.zeros(self.nchan + 1, dtype=np.int64)
+        self.reset()
+
+    def reset(self):
+        "Start over, e.g. after the device was cleared"
+        self.net = None
+        self.statistic = np.zeros(len(self.rois))
+        self.intervals = 0
+        self._last_spectrum = None
+        self._last_livetime = 0.0
+
+    def roi_sums(self, cumsum) -> np.ndarray:
+        "ROI sums from a cumulative-sum table with a leading 0"
+        return cumsum[self.rois[:, 1]] - cumsum[self.rois[:, 0]]
+
+    def push(self, spectrum, livetime: float) -> RoiResult:
+        """
+        Update from a running spectrum and livetime, as read from the
+        device; only the difference to the previous push is evaluated.
+        """
+        spectrum = np.asarray(spectrum)
+        if self._last_spectrum is None:
+            diff, dt = spectrum, livetime
+            self._last_spectrum = np.array(spectrum, dtype=np.int64)
+        else:
+            diff = spectrum - self._last_spectrum
+            dt = livetime - self._last_livetime
+            self._last_spectrum[:] = spectrum
+        self._last_livetime = livetime
+        return self.update(diff, dt)
+
+    def update(self, counts, livetime: float) -> RoiResult:
+        """
+        Update from the spectrum of one interval.
+
+        Parameters
+        ----------
+        counts : array-like
+            Counts per channel collected in the interval
+        livetime : float
+            Livetime of the interval, seconds
+        """
+        np.cumsum(counts, out=self._cumsum[1:])
+        raw = self.roi_sums(self._cumsum)
+        if self.norm_roi is None:
+            scale = None
+            expected = self.bkg_rate * livetime
+            net = raw - expected
+        else:
+            # Background scaled to the interval's counts in the norm ROI;
+            # net counts are in units of the background rate as before
+            lo, hi = self.norm_roi
+            det_norm = self._cumsum[hi] - self._cumsum[lo]
+            if det_norm > 0:
+                scale = self.bkg_norm / det_norm
+                expected = self.bkg_rate / scale
+                net = raw * scale - self.bkg_rate
+            else:
+                expected = np.zeros(len(self.rois))
+                net = np.zeros(len(self.rois))
+        self.net = net if self.net is None else self.alpha * net + (1 - self.alpha) * self.net
+
+        # Poisson log-likelihood ratio of H1 (ratio x background) over H0
+        llr = raw * self.log_ratio - expected * (self.ratio - 1.0)
+        self.statistic += llr
+        if self.method == 'cusum':
+            np.maximum(self.statistic, 0.0, out=self.statistic)
+            statistic = self.statistic.copy()
+            alarm = statistic > self.threshold
+        else:
+            statistic = self.statistic.copy()
+            alarm = statistic >= self.threshold
+            self.statistic[alarm | (statistic <= self.lower)] = 0.0
+        self.intervals += 1
+        return RoiResult(raw, expected, self.net.copy(), statistic, alarm)
+
+    __call__ = update
+
+
+class GainAdjustment(NamedTuple):
+    "One fine gain change made by a GainStabilizer"
+    time: float         # Wall clock time of the change, seconds since the epoch
+    t: float            # Device time of the change, seconds: livetime or list mode clock
+    old_gain: float
+    new_gain: float
+    centroid: float     # Measured peak centroid, channels
+    counts: float       # Net peak counts the centroid is based on
+
+
+class GainStabilizer:
+    """
+    Host side gain stabilization on a reference peak.
+
+    The counts in the (lo, center, hi) channel window - the triplet the
+    device's own ``auto_stabilize`` takes, in either order - are summed
+    as they arrive, from interval spectra, from the differences of running
+    spectra or from list mode hits; whole spectra are never refitted. Once
+    ``min_counts`` have been collected in the window its centroid is taken,
+    after subtracting a straight line continuum through the ``edge``
+    channels at either end, and the sums start over. When the centroid is
+    off center by more than ``threshold`` (relative) the fine gain is
+    scaled by center / centroid, at most by ``max_step`` per adjustment.
+
+    Every change is logged and kept in ``history``, so that data taken
+    before it can be corrected afterwards; ``gains()`` gives the gain in
+    force at any device time.
+
+    Parameters
+    ----------
+    base : digiBase
+        Device whose fine gain is adjusted; None to only compute and
+        record the adjustments, e.g. when reprocessing files
+    window : tuple
+        (lo, center, hi) channels of the reference peak, lo and hi inclusive
+    threshold : float
+        Relative centroid drift that triggers an adjustment
+    min_counts : int
+        Window counts per centroid measurement
+    max_step : float
+        Largest relative gain change per adjustment
+    edge : int
+        Channels at each end of the window that estimate the continuum;
+        0 to take the plain centroid
+    gain : float
+        Starting fine gain if there is no base
+
+    >>> stab = GainStabilizer(base, (560, 600, 640), threshold=0.005)
+    >>> for words in stream:
+    ...     stab.add_words(words)
+    >>> stab.history
+    """
+    def __init__(self, base: digiBase=None, window: tuple=None, threshold: float=0.005, 
+                 min_counts: int=10000, max_step: float=0.05, edge: int=3, gain: float=None):
+        if window is None or len(window) != 3: raise ValueError("window must be (lo, center, hi)")
+        lo, center, hi = sorted(int(ch) for ch in window)
+        if lo < 0 or hi > 1023 or not lo < center < hi:
+            raise ValueError("window must satisfy 0 <= lo < center < hi <= 1023")
+        if 2 * edge >= hi - lo: raise ValueError("edge channels fill the window")
+        if threshold <= 0.0 or max_step <= 0.0: raise ValueError("threshold and max_step must be > 0")
+        self.base = base
+        self.lo, self.center, self.hi = lo, center, hi
+        self.threshold = threshold
+        self.min_counts = min_counts
+        self.max_step = max_step
+        self.edge = edge
+        if gain is None: gain = base.fine_gain if base is not None else 1.0
+        self.gain = gain
+        self.start_gain = gain
+        self.channels = np.arange(lo, hi + 1, dtype=np.float64)
+        self.history = []
+        self.decoder = HitDecoder()
+        self.log = logging.getLogger('digiBase')
+        self.reset()
+
+    def reset(self):
+        "Start the window sums over, e.g. after the device was cleared"
+        self.counts = np.zeros(self.hi - self.lo + 1, dtype=np.int64)
+        self.centroid = None
+        self.t = 0.0
+        self._last_spectrum = None
+
+    def push(self, spectrum, livetime: float) -> GainAdjustment:
+        """
+        Update from a running spectrum and livetime, as read from the
+        device; only the window of the difference to the previous push
+        is used.
+        """
+        window = np.asarray(spectrum)[self.lo:self.hi + 1]
+        if self._last_spectrum is None:
+            diff = window
+            self._last_spectrum = np.array(window, dtype=np.int64)
+        else:
+            diff = window - self._last_spectrum
+            self._last_spectrum[:] = window
+        return self.update(diff, livetime, window=True)
+
+    def update(self, counts, t: float, window: bool=False) -> GainAdjustment:
+        """
+        Update from the spectrum of one interval, ending at device time t
+        (seconds); counts are the window channels only if window is True.
+        Returns the adjustment made, if any.
+        """
+        counts = np.asarray(counts)
+        self.counts += counts if window else counts[self.lo:self.hi + 1]
+        self.t = t
+        return self._evaluate()
+
+    def add_words(self, words) -> GainAdjustment:
+        "Update from raw list mode words, as read from the device, in run order"
+        t, adc = self.decoder.decode(words)
+        return self.add(t, adc)
+
+    def add(self, t, adc) -> GainAdjustment:
+        "Update from decoded list mode hits; t in microseconds"
+        if len(t) == 0: return None
+        adc = adc[(adc >= self.lo) & (adc <= self.hi)]
+        self.counts += np.bincount(adc - self.lo, minlength=len(self.counts))
+        self.t = int(t[-1]) * 1e-6
+        return self._evaluate()
+
+    def net_counts(self) -> np.ndarray:
+        "Window counts less the straight line continuum through the edge channels"
+        counts = self.counts.astype(np.float64)
+        if self.edge == 0: return counts
+        e = self.edge
+        x0, x1 = self.lo + (e - 1) / 2, self.hi - (e - 1) / 2
+        y0, y1 = counts[:e].mean(), counts[-e:].mean()
+        return counts - (y0 + (y1 - y0) * (self.channels - x0) / (x1 - x0))
+
+    def _evaluate(self) -> GainAdjustment:
+        if self.counts.sum() < self.min_counts: return None
+        net = self.net_counts()
+        total = net.sum()
+        self.counts[:] = 0
+        if total <= 0.0:
+            self.log.warning(f'No peak above the continuum in channels {self.lo}-{self.hi}')
+            return None
+        self.centroid = float(np.dot(self.channels, net) / total)
+        ratio = self.center / self.centroid
+        if abs(ratio - 1.0) <= self.threshold: return None
+        ratio = min(max(ratio, 1.0 - self.max_step), 1.0 + self.max_step)
+        old = self.gain
+        new = min(max(old * ratio, 0.25), 2.0 - 2**-22)
+        if new == old:
+            self.log.warning(f'Peak at {self.centroid:.1f} but fine gain is at its limit {old:.4f}')
+            return None
+        if self.base is not None:
+            # The device may have stopped on a preset since the shadow register
+            # was read; writing back its stale start bit would restart it
+            self.base.refresh()
+            self.base.fine_gain = new
+        self.gain = new
+        adj = GainAdjustment(time(), self.t, old, new, self.centroid, total)
+        self.history.append(adj)
+        self.log.info(f'Peak at {self.centroid:.2f} (expected {self.center}): '
+                 f'fine gain {old:.5f} -> {new:.5f} at t={self.t:.3f} s')
+        return adj
+
+    def gains(self, t) -> np.ndarray:
+        "Fine gain in force at device times t, seconds"
+        changes = np.array([adj.t for adj in self.history])
+        gains = np.array([self.start_gain] + [adj.new_gain for adj in self.history])
+        return gains[np.searchsorted(changes, t, side='right')]
+
+
+def write_background(filename, s:array, exposure:float, comment:str, serial:int,
+                     hv:int=0, disc:int=0, ext_gate:ExtGateMode=ExtGateMode.OFF,
+                     gain:float=0.0, skew:float=None):
+    """
+    Write a spectrum to a DBKG (version 1) file along with the
+    device settings it was acquired with. Given the skew of a 
+    spectrum_snapshot() interval, a version 2 file is written, which
+    has the skew appended.
+    """
+    with open(filename, 'wb') as f:
+        f.write(b'DBKG\x00\x00\x00' + (b'\x01' if skew is None else b'\x02'))
+        f.write(pack('d', datetime.now().timestamp()))
+        f.write(pack('d', exposure))
+        f.write(pack('i', serial))
+        f.write(pack('H', hv))
+        f.write(pack('H', disc))
+        f.write(pack('i', ext_gate.value))
+        f.write(pack('d', gain))
+        if comment is None:
+            f.write(b'\x00'*64)
+        else:
+            f.write(comment.encode('utf-8')[:63].ljust(64, b'\x00'))
+        f.write(np.asarray(s, dtype='i').tobytes())
+        if skew is not None: f.write(pack('d', skew))
+
+def read_spectrum(fileobj) -> tuple[np.ndarray, float, float, object]:
+    """ More modern version to read spectrum file given file-like object"""
+    if fileobj.read(6) != b'DBKG\x00\x00': raise ValueError("Unknown file format")
+    ver, = unpack('>H', fileobj.read(2))
+    t, exp = unpack('2d', fileobj.read(16))
+    if ver > 0:
+        serial, hv, disc, ext_gate, gain = unpack('=i2Hid', fileobj.read(20))
+    comment = fileobj.read(64).decode('utf-8')
+    s = np.array(unpack('1024i', fileobj.read(4096)), 'i')
+    if ver == 0: return s, t, exp, comment
+    if ver == 1: return s, t, exp, (comment, serial, hv, disc, ext_gate, gain)
+    skew, = unpack('d', fileobj.read(8))
+    return s, t, exp, (comment, serial, hv, disc, ext_gate, gain, skew)
+
+def read_background(filename) -> tuple[np.ndarray, float, float, Any]:
+    """Legacy interface to spectrum reader"""
+    with open(filename, 'rb') as f: return read_spectrum(f)
+
+# Record layouts of DBKG spectrum files
+DBKG_V0 = np.dtype([
+    ('magic', 'S6'), ('version', 'u2'), ('time', 'f8'), ('exposure', 'f8'),
+    ('comment', 'S64'), ('counts', 'i4', (1024,))
+])
+DBKG_V1 = np.dtype([
+    ('magic', 'S6'), ('version', 'u2'), ('time', 'f8'), ('exposure', 'f8'),
+    ('serial', 'i4'), ('hv', 'u2'), ('disc', 'u2'), ('ext_gate', 'i4'), ('gain', 'f8'),
+    ('comment', 'S64'), ('counts', 'i4', (1024,))
+])
+DBKG_V2 = np.dtype(DBKG_V1.descr + [('skew', 'f8')])
+# Metadata returned by read_spectra(); settings are 0 for version 0 files, skew
+# for versions 0 and 1
+SPECTRUM_META = np.dtype([
+    ('time', 'f8'), ('exposure', 'f8'), ('serial', 'i4'), ('hv', 'u2'), ('disc', 'u2'),
+    ('ext_gate', 'i4'), ('gain', 'f8'), ('skew', 'f8'), ('version', 'u2'), ('comment', 'S64')
+])
+
+def read_spectra(paths, workers: int=8) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Load many DBKG spectrum files at once.
+
+    Parameters
+    ----------
+    paths : str or list
+        List of files, or a glob pattern (sorted)
+    workers : int
+        Number of files read concurrently
+
+    Returns
+    -------
+    (counts, meta) : tuple of np.ndarray
+        N x 1024 int32 counts and a structured array (SPECTRUM_META)
+        with time, exposure, settings and comment of each file
+    """
+    if isinstance(paths, (str, os.PathLike)): 
+        paths = sorted(glob(os.fspath(paths)))
+    # Workers only fill rows of one raw buffer; decoding is done once per format
+    formats = (DBKG_V0, DBKG_V1, DBKG_V2)
+    raw = np.zeros((len(paths), DBKG_V2.itemsize), dtype=np.uint8)
+    def load(i):
+        with open(paths[i], 'rb') as f: n = f.readinto(raw[i])
+        if raw[i, :6].tobytes() != b'DBKG\x00\x00': 
+            raise ValueError(f"{paths[i]}: unknown file format")
+        ver = int(raw[i, 6]) << 8 | int(raw[i, 7])
+        if ver >= len(formats): 
+            raise ValueError(f"{paths[i]}: unsupported DBKG version {ver}")
+        if n < formats[ver].itemsize: 
+            raise ValueError(f"{paths[i]}: file too short")
+    if workers > 1 and len(paths) > 1:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(load, range(len(paths))))
+    else:
+        for i in range(len(paths)): load(i)
+    counts = np.zeros((len(paths), 1024), dtype=np.int32)
+    meta = np.zeros(len(paths), dtype=SPECTRUM_META)
+    versions = raw[:, 6].astype(np.uint16) << 8 | raw[:, 7]
+    for version, dtype in enumerate(formats):
+        sel = versions == version
+        if not sel.any(): continue
+        rec = np.ascontiguousarray(raw[sel, :dtype.itemsize]).view(dtype)[:, 0]
+        counts[sel] = rec['counts']
+        for name in dtype.names:
+            if name in SPECTRUM_META.names: meta[name][sel] = rec[name]
+        meta['version'][sel] = version
+    return counts, meta
+    
+# DBLM v2 list mode files: a 32-byte header as in v0 files, then independently
+# zlib-compressed blocks of hits and a block index in the footer. A block holds
+# the byte-shuffled uint32 deltas of the hit times (the first relative to the
+# block start time) followed by the uint16 ADC values.
+DBLM_BLOCK_HEADER = '<4sIIqq'   # b'DBLB', # hits, compressed size, first, last time
+DBLM_TRAILER = '<QI4s'          # Index offset, # blocks, b'DBLX'
+DBLM_INDEX = np.dtype([
+    ('offset', '<u8'),          # Block (payload) file offset
+    ('nbytes', '<u4'),          # Compressed size
+    ('nhits',  '<u4'),
+    ('first',  '<i8'),          # First hit time, microseconds
+    ('last',   '<i8'),          # Last hit time, microseconds
+])
+
+def _dblm_header(version, start_time, livetime=0.0, realtime=0.0) -> bytes:
+    return b'DBLM' + pack('>I', version) + pack('3d', start_time, livetime, realtime)
+
+def _pack_block(t, adc, level) -> bytes:
+    dt = np.diff(t, prepend=t[0]).astype('<u4')
+    shuffled = dt.view(np.uint8).reshape(-1, 4).T.tobytes() + \
+        adc.astype('<u2').view(np.uint8).reshape(-1, 2).T.tobytes()
+    return zlib.compress(shuffled, level)
+
+def _unpack_block(payload, nhits, first) -> tuple[np.ndarray, np.ndarray]:
+    raw = np.frombuffer(zlib.decompress(payload), dtype=np.uint8)
+    dt = raw[:4*nhits].reshape(4, nhits).T.copy().view('<u4').ravel()
+    adc = raw[4*nhits:].reshape(2, nhits).T.copy().view('<u2').ravel()
+    t = np.cumsum(dt, dtype=np.int64)
+    t += first
+    return t, adc.astype(np.uint16)
+
+
+class ListModeWriter:
+    """
+    Writer of DBLM version 2 list mode files, which store decoded hits
+    in independently compressed blocks with a time index in the footer
+    so that readers can seek by time and decompress blocks in parallel:
+
+    >>> with ListModeWriter('run.dblm', base=base) as f:
+    ...     while acquiring:
+    ...         f.write(base.hits_array())
+
+    Parameters
+    ----------
+    filename : str
+        Output file
+    start_time : float
+        Run start, as POSIX timestamp; now if None
+    block_hits : int
+        Number of hits per block
+    level : int
+        zlib compression level; the default favours speed
+    base : digiBase
+        Device the hits come from; its livetime and realtime are read
+        into the header at close(). Without one set the livetime and 
+        realtime attributes before closing.
+    """
+    def __init__(self, filename, start_time: float=None, block_hits: int=1 << 18, 
+                 level: int=1, base: 'digiBase'=None):
+        self.filename = filename
+        self.base = base
+        self.start_time = datetime.now().timestamp() if start_time is None else start_time
+        self.block_hits = block_hits
+        self.level = level
+        self.livetime = 0.0
+        self.realtime = 0.0
+        self.nhits = 0
+        self.decoder = HitDecoder()
+        self._index = []
+        self._pending = []
+        self._npending = 0
+        self._last = None
+        self._f = open(filename, 'wb')
+        self._f.write(_dblm_header(2, self.start_time))
+
+    def write(self, words):
+        "Add raw list mode words as read from the device"
+        self.write_hits(*self.decoder.decode(words))
+
+    def write_hits(self, t, adc):
+        "Add decoded hits (times in microseconds, in order, and ADC values)"
+        if len(t) == 0: return
+        t = np.asarray(t, dtype=np.int64)
+        # Blocks store time deltas as unsigned and the index needs sorted times
+        if (self._last is not None and t[0] < self._last) or np.any(np.diff(t) < 0):
+            raise ValueError("Hit times must not decrease")
+        self._last = t[-1]
+        self._pending.append((t, np.asarray(adc, dtype=np.uint16)))
+        self._npending += len(t)
+        self.nhits += len(t)
+        if self._npending >= self.block_hits: self._flush(final=False)
+
+    def _flush(self, final: bool):
+        if self._npending == 0: return
+        t = np.concatenate([p[0] for p in self._pending])
+        adc = np.concatenate([p[1] for p in self._pending])
+        # Blocks end at the block size and wherever a time delta does not fit 32 bits
+        cuts = list(np.flatnonzero(np.diff(t) > 0xffff_ffff) + 1)
+        cuts = sorted(set(cuts + list(range(self.block_hits, len(t), self.block_hits))))
+        bounds = [0] + cuts + [len(t)]
+        for i0, i1 in zip(bounds[:-1], bounds[1:]):
+            if not final and i1 == len(t) and i1 - i0 < self.block_hits:
+                # Keep a partial last block for later
+                self._pending = [(t[i0:], adc[i0:])]
+                self._npending = i1 - i0
+                return
+            self._write_block(t[i0:i1], adc[i0:i1])
+        self._pending = []
+        self._npending = 0
+
+    def _write_block(self, t, adc):
+        payload = _pack_block(t, adc, self.level)
+        self._f.write(pack(DBLM_BLOCK_HEADER, b'DBLB', len(t), len(payload), t[0], t[-1]))
+        self._index.append((self._f.tell(), len(payload), len(t), t[0], t[-1]))
+        self._f.write(payload)
+
+    def close(self):
+        "Write the remaining hits, block index and run times"
+        if self._f is None: return
+        if self.base is not None:
+            status = self.base.status_snapshot(refresh=True)
+            self.livetime, self.realtime = status.livetime, status.realtime
+        self._flush(final=True)
+        index = np.array(self._index, dtype=DBLM_INDEX)
+        offset = self._f.tell()
+        self._f.write(index.tobytes())
+        self._f.write(pack(DBLM_TRAILER, offset, len(index), b'DBLX'))
+        self._f.seek(0)
+        self._f.write(_dblm_header(2, self.start_time, self.livetime, self.realtime))
+        self._f.close()
+        self._f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ListModeReader:
+    """
+    Reader of DBLM list mode files, both the raw word (version 0) 
+    files written by acq and compressed version 2 files. Hit times 
+    are in microseconds of the device clock.
+
+    >>> f = ListModeReader('run.dblm')
+    >>> t, adc = f.read()                        # Everything
+    >>> t, adc = f.read(10_000_000, 20_000_000)  # Hits from 10 s to 20 s
+
+    Use chunks() to process files of any size in constant memory:
+
+    >>> for t, adc in f.chunks():
+    ...     h += np.bincount(adc, minlength=1024)
+
+    A version 2 file without index (the writer did not finish) is 
+    indexed by scanning its block headers.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            hdr = f.read(32)
+            if len(hdr) < 32 or hdr[:4] != b'DBLM': raise ValueError("Unknown file format")
+            self.version, = unpack('>I', hdr[4:8])
+            if self.version not in (0, 2): 
+                raise ValueError(f"Unsupported DBLM version {self.version}")
+            self.start_time, self.livetime, self.realtime = unpack('3d', hdr[8:32])
+            self.index = self._read_index(f) if self.version == 2 else None
+
+    @staticmethod
+    def _read_index(f) -> np.ndarray:
+        size = f.seek(0, os.SEEK_END)
+        trailer_size = calcsize(DBLM_TRAILER)
+        if size >= 32 + trailer_size:
+            f.seek(size - trailer_size)
+            offset, nblocks, magic = unpack(DBLM_TRAILER, f.read(trailer_size))
+            if magic == b'DBLX':
+                f.seek(offset)
+                return np.frombuffer(f.read(nblocks * DBLM_INDEX.itemsize), dtype=DBLM_INDEX)
+        # No footer - recover the index from the block headers
+        index = []
+        hsize = calcsize(DBLM_BLOCK_HEADER)
+        pos = 32
+        while pos + hsize <= size:
+            f.seek(pos)
+            magic, nhits, nbytes, first, last = unpack(DBLM_BLOCK_HEADER, f.read(hsize))
+            if magic != b'DBLB' or pos + hsize + nbytes > size: break
+            index.append((pos + hsize, nbytes, nhits, first, last))
+            pos += hsize + nbytes
+        return np.array(index, dtype=DBLM_INDEX)
+
+    @property
+    def words(self) -> np.ndarray:
+        "The raw words of a version 0 file, memory-mapped"
+        if self.version != 0: raise ValueError("Only version 0 files hold raw words")
+        n = (os.path.getsize(self.filename) - 32) // 4
+        if n == 0: return np.zeros(0, dtype='<u4')
+        return np.memmap(self.filename, dtype='<u4', mode='r', offset=32, shape=(n,))
+
+    @property
+    def nhits(self) -> int:
+        if self.version == 2: return int(self.index['nhits'].sum())
+        return sum(int(np.count_nonzero(chunk < HitDecoder.ROLLOVER))
+                   for chunk in self._word_chunks(1 << 22))
+
+    def _word_chunks(self, chunk_words):
+        words = self.words
+        for i in range(0, len(words), chunk_words):
+            yield words[i:i+chunk_words]
+
+    def _select(self, t0, t1) -> np.ndarray:
+        "Index entries of the blocks overlapping [t0, t1)"
+        i0 = 0 if t0 is None else np.searchsorted(self.index['last'], t0, side='left')
+        i1 = len(self.index) if t1 is None else np.searchsorted(self.index['first'], t1, side='left')
+        return self.index[i0:i1]
+
+    def _load(self, f, entry):
+        f.seek(int(entry['offset']))
+        return _unpack_block(f.read(int(entry['nbytes'])), int(entry['nhits']), int(entry['first']))
+
+    def chunks(self, chunk_words: int=1 << 20, t0: int=None, t1: int=None):
+        """
+        Generate the hits with times in [t0, t1) as (t, adc) chunks, so
+        that memory use does not depend on the length of the run. Version
+        0 files are decoded from the memory-mapped words chunk_words at a
+        time, carrying the rollover state across chunks; version 2 files 
+        yield one chunk per block.
+        """
+        def trim(t, adc):
+            i0 = 0 if t0 is None else np.searchsorted(t, t0, side='left')
+            i1 = len(t) if t1 is None else np.searchsorted(t, t1, side='left')
+            return t[i0:i1], adc[i0:i1]
+        if self.version == 0:
+            decoder = HitDecoder()
+            for words in self._word_chunks(chunk_words):
+                t, adc = decoder.decode(words)
+                if len(t) == 0: continue
+                if t1 is not None and t[0] >= t1: return
+                if t0 is not None and t[-1] < t0: continue
+                yield trim(t, adc)
+            return
+        with open(self.filename, 'rb') as f:
+            for entry in self._select(t0, t1):
+                yield trim(*self._load(f, entry))
+
+    def read(self, t0: int=None, t1: int=None, workers: int=None) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Hits with times in [t0, t1) microseconds (None for open ends) as 
+        (t, adc) arrays. Blocks of version 2 files are decompressed in 
+        parallel by up to workers threads.
+        """
+        if self.version == 0:
+            t, adc = decode_hits(self.words)
+        else:
+            entries = self._select(t0, t1)
+            def load(entry):
+                with open(self.filename, 'rb') as f: return self._load(f, entry)
+            if len(entries) > 1 and workers != 1:
+                with ThreadPoolExecutor(max_workers=workers) as pool:
+                    parts = list(pool.map(load, entries))
+            else:
+                parts = [load(entry) for entry in entries]
+            if len(parts) == 0: return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint16)
+            t = np.concatenate([p[0] for p in parts])
+            adc = np.concatenate([p[1] for p in parts])
+        i0 = 0 if t0 is None else np.searchsorted(t, t0, side='left')
+        i1 = len(t) if t1 is None else np.searchsorted(t, t1, side='left')
+        return t[i0:i1], adc[i0:i1]
+
+
+class ListModeHistogrammer:
+    """
+    Builds 1024-channel spectra of list mode hits in arbitrary time slices.
+
+    Slices are given by their edges in microseconds of the list mode
+    clock, which is real time (it keeps running while the device is 
+    busy with a pulse); hits in [edges[i], edges[i+1]) go to spectra[i].
+    The realtime of a slice is the part of it the clock is known to 
+    have covered: from start (the run start, 0) to the latest rollover
+    epoch or hit seen. The livetime of a slice is not known. Hits are
+    accumulated with one bincount per chunk, so any number of slices 
+    costs the same.
+
+    >>> h = ListModeHistogrammer(np.arange(0, 600_000_001, 10_000_000))
+    >>> for words in stream:              # Live, raw words
+    ...     h.add_words(words)
+    >>> h.add_reader(ListModeReader('run.dblm'))   # Or from a file
+    >>> h.spectra, h.realtime
+    """
+    NCHAN = 1024
+
+    def __init__(self, edges, start: int=0):
+        self.edges = np.asarray(edges, dtype=np.int64)
+        if self.edges.ndim != 1 or len(self.edges) < 2 or np.any(np.diff(self.edges) <= 0):
+            raise ValueError("edges must be at least 2 increasing times")
+        widths = np.diff(self.edges)
+        self._width = int(widths[0]) if np.all(widths == widths[0]) else None
+        self.spectra = np.zeros((len(self.edges) - 1, self.NCHAN), dtype=np.int64)
+        self.decoder = HitDecoder()
+        self.start = start
+        self.t_end = start      # Device clock known to have run until here, us
+
+    @property
+    def realtime(self) -> np.ndarray:
+        "Realtime of each slice in seconds"
+        covered = np.clip(self.edges, self.start, max(self.t_end, self.start))
+        return np.diff(covered) * 1e-6
+
+    def add_words(self, words):
+        "Add raw list mode words, as read from the device, in run order"
+        t, adc = self.decoder.decode(words)
+        self.t_end = max(self.t_end, self.decoder.epoch)
+        self.add(t, adc)
+
+    def add(self, t, adc):
+        "Add decoded hits, with times sorted as they come from the decoder"
+        if len(t) == 0: return
+        self.t_end = max(self.t_end, int(t[-1]))
+        e = self.edges
+        i0 = np.searchsorted(t, e[0], side='left')
+        i1 = np.searchsorted(t, e[-1], side='left')
+        if i0 == i1: return
+        t, adc = t[i0:i1], adc[i0:i1]
+        if self._width is not None:
+            which = (t - e[0]) // self._width
+        else:
+            which = np.searchsorted(e, t, side='right') - 1
+        # Only the slices this chunk touches are binned
+        s0, s1 = int(which[0]), int(which[-1]) + 1
+        bins = (which - s0) * self.NCHAN + adc
+        counts = np.bincount(bins, minlength=(s1 - s0) * self.NCHAN)
+        self.spectra[s0:s1] += counts.reshape(-1, self.NCHAN)
+
+    def add_reader(self, reader, chunk_words: int=1 << 22):
+        "Add the hits of a ListModeReader that fall in the slices"
+        if reader.version == 0:
+            for words in reader._word_chunks(chunk_words):
+                self.add_words(words)
+            return
+        for t, adc in reader.chunks(t0=int(self.edges[0]), t1=int(self.edges[-1])):
+            self.add(t, adc)
+        # Version 2 files keep no rollover words; their realtime and
+        # last hit tell how far the clock ran
+        if len(reader.index) > 0: self.t_end = max(self.t_end, int(reader.index['last'][-1]))
+        self.t_end = max(self.t_end, int(reader.realtime * 1e6))
+
+
+class Coincidences(NamedTuple):
+    """
+    Coincident groups of hits as flat arrays. The hits of group i are
+    t[start[i]:start[i+1]], time ordered; start has one more entry 
+    than there are groups.
+    """
+    start: np.ndarray   # int64, first hit of each group, then the total
+    t: np.ndarray       # int64, corrected hit times, us
+    adc: np.ndarray     # uint16
+    base: np.ndarray    # uint8, index of the base of each hit
+    mask: np.ndarray    # uint64, bit i set if base i has hits in the group
+
+    @property
+    def ngroups(self) -> int:
+        return len(self.start) - 1
+
+    @property
+    def time(self) -> np.ndarray:
+        "Time of the first hit of each group"
+        return self.t[self.start[:-1]]
+
+    @property
+    def multiplicity(self) -> np.ndarray:
+        "Number of hits in each group"
+        return np.diff(self.start)
+
+    @staticmethod
+    def empty() -> 'Coincidences':
+        return Coincidences(np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                            np.zeros(0, dtype=np.uint16), np.zeros(0, dtype=np.uint8),
+                            np.zeros(0, dtype=np.uint64))
+
+    @staticmethod
+    def concatenate(parts) -> 'Coincidences':
+        "Join the results of successive CoincidenceBuilder.pop() calls"
+        parts = [p for p in parts if p.ngroups > 0]
+        if len(parts) == 0: return Coincidences.empty()
+        shift = np.cumsum([0] + [len(p.t) for p in parts[:-1]])
+        start = np.concatenate([p.start[:-1] + s for p, s in zip(parts, shift)] 
+                               + [[shift[-1] + len(parts[-1].t)]])
+        return Coincidences(start, *(np.concatenate([getattr(p, f) for p in parts]) 
+                                     for f in ('t', 'adc', 'base', 'mask')))
+
+
+class CoincidenceBuilder:
+    """
+    Finds coincidences between the list mode hits of several bases.
+
+    Hit times of base i are first brought onto a common clock with
+    t * (1 + drifts[i] * 1e-6) + offsets[i] (offsets in us, drifts in 
+    ppm; each base's oscillator runs at its own rate). The hits of all
+    bases are then merged by time and a hit closer than window to the
+    previous one joins its group. Groups with hits from at least 
+    min_bases different bases are kept.
+
+    Hits are fed per base in time order, as raw words or decoded, and
+    may arrive in chunks of any size. pop() returns the groups no 
+    later hit can join any more - those that ended a window before the
+    time every base has reached - so memory stays bounded however long
+    the run:
+
+    >>> cb = CoincidenceBuilder(3, window=2, offsets=[0, 15, -7])
+    >>> for words in bases.drain():       # Live, from a digiBaseArray
+    ...     for i, w in enumerate(words): cb.add_words(i, w)
+    ...     c = cb.pop()
+    >>> c = Coincidences.concatenate(cb.add_readers(readers))   # From files
+    """
+    POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def __init__(self, nbases: int, window: int, offsets=None, drifts=None, 
+                 min_bases: int=2):
+        if nbases < 1 or nbases > 64: raise ValueError("Between 1 and 64 bases")
+        self.nbases = nbases
+        self.window = window
+        self.offsets = np.zeros(nbases) if offsets is None else np.asarray(offsets, dtype=float)
+        self.drifts = np.zeros(nbases) if drifts is None else np.asarray(drifts, dtype=float)
+        if self.offsets.shape != (nbases,) or self.drifts.shape != (nbases,):
+            raise ValueError("One offset and drift per base")
+        self.min_bases = min_bases
+        self.decoders = [HitDecoder() for i in range(nbases)]
+        self.t_end = [0] * nbases       # Device clock known to have run until here, us
+        self.closed = [False] * nbases
+        self._pending = [[] for i in range(nbases)]
+        self._carry = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.uint16),
+                       np.zeros(0, dtype=np.uint8))
+
+    def correct(self, i: int, t):
+        "Times of base i on the common clock"
+        t = np.asarray(t, dtype=np.int64)
+        drift, offset = self.drifts[i] * 1e-6, self.offsets[i]
+        if drift == 0: return t + int(round(offset))
+        return t + np.rint(t * drift + offset).astype(np.int64)
+
+    def add_words(self, i: int, words):
+        "Add raw list mode words of base i, as read from the device"
+        t, adc = self.decoders[i].decode(words)
+        self.t_end[i] = max(self.t_end[i], self.decoders[i].epoch)
+        self.add(i, t, adc)
+
+    def add(self, i: int, t, adc):
+        "Add decoded hits of base i, in time order"
+        if len(t) == 0: return
+        self.t_end[i] = max(self.t_end[i], int(t[-1]))
+        self._pending[i].append((self.correct(i, t), np.asarray(adc, dtype=np.uint16)))
+
+    def close(self, i: int):
+        "No more hits will come from base i"
+        self.closed[i] = True
+
+    @property
+    def horizon(self) -> float:
+        "Common clock time all open bases have reached"
+        return min((int(self.correct(i, self.t_end[i])) for i in range(self.nbases)
+                    if not self.closed[i]), default=float('inf'))
+
+    def pop(self) -> Coincidences:
+        "The groups completed since the last call"
+        h = self.horizon
+        parts = [self._carry]
+        for i, pending in enumerate(self._pending):
+            if len(pending) == 0: continue
+            t = np.concatenate([p[0] for p in pending])
+            adc = np.concatenate([p[1] for p in pending])
+            k = len(t) if h == float('inf') else np.searchsorted(t, h, side='left')
+            self._pending[i] = [(t[k:], adc[k:])] if k < len(t) else []
+            parts.append((t[:k], adc[:k], np.full(k, i, dtype=np.uint8)))
+        # All these hits are before the horizon; merging the per-base 
+        # runs with a stable sort keeps equal times in base order
+        t, adc, base = (np.concatenate(x) for x in zip(*parts))
+        order = np.argsort(t, kind='stable')
+        t, adc, base = t[order], adc[order], base[order]
+
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(t) > self.window) + 1))
+        # Groups are final when a hit at the horizon cannot join them
+        k = len(t) if h == float('inf') else np.searchsorted(t, h - self.window, side='left')
+        cut = len(t) if k == len(t) else int(starts[np.searchsorted(starts, k, side='right') - 1])
+        self._carry = (t[cut:], adc[cut:], base[cut:])
+        if cut == 0: return Coincidences.empty()
+
+        # Most groups are single hits: only groups with enough hits to
+        # span min_bases bases are looked at further
+        starts = starts[starts < cut]
+        counts = np.diff(np.append(starts, cut))
+        big = counts >= self.min_bases
+        starts, counts = starts[big], counts[big]
+        if len(starts) == 0: return Coincidences.empty()
+        first = np.repeat(starts, counts)
+        hits = first + np.arange(len(first)) - np.repeat(np.cumsum(counts) - counts, counts)
+        t, adc, base = t[hits], adc[hits], base[hits]
+        start = np.concatenate(([0], np.cumsum(counts)))
+        mask = np.bitwise_or.reduceat(np.left_shift(np.uint64(1), base.astype(np.uint64)),
+                                      start[:-1])
+        nbases = CoincidenceBuilder.POPCOUNT[mask.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+        keep = nbases >= self.min_bases
+        if not np.all(keep):
+            counts = counts[keep]
+            hits = np.repeat(keep, np.diff(start))
+            t, adc, base = t[hits], adc[hits], base[hits]
+            start = np.concatenate(([0], np.cumsum(counts)))
+            mask = mask[keep]
+        return Coincidences(start, t, adc, base, mask)
+
+    def finish(self) -> Coincidences:
+        "Close all bases and return the remaining groups"
+        for i in range(self.nbases): self.close(i)
+        return self.pop()
+
+    def add_readers(self, readers, chunk_words: int=1 << 20):
+        """
+        Feed the hits of one ListModeReader per base, always reading
+        next from the base that is furthest behind, and generate the
+        groups as they complete
+        """
+        if len(readers) != self.nbases: raise ValueError("One reader per base")
+        chunks = [reader.chunks(chunk_words) for reader in readers]
+        while not all(self.closed):
+            i = min((i for i in range(self.nbases) if not self.closed[i]),
+                    key=lambda i: int(self.correct(i, self.t_end[i])))
+            chunk = next(chunks[i], None)
+            if chunk is None:
+                self.close(i)
+            else:
+                self.add(i, *chunk)
+            c = self.pop()
+            if c.ngroups > 0: yield c
+
+# DBSA spectrum archives: a 64-byte header followed by fixed-size records, one
+# per spectrum, appended as they are acquired. A record that was only partly
+# written when the writer died is ignored by readers and cut off by the next
+# writer, so the archive stays readable after a crash.
+DBSA_HEADER = '<4sIII48s'       # b'DBSA', version, record size, # channels, comment
+DBSA_RECORD = np.dtype([
+    ('time',     '<f8'),        # POSIX timestamp of the readout
+    ('livetime', '<f8'),
+    ('realtime', '<f8'),
+    ('gain',     '<f8'),
+    ('serial',   '<i4'),
+    ('ext_gate', '<i4'),
+    ('hv',       '<u2'),
+    ('disc',     '<u2'),
+    ('skew',     '<f4'),        # Timing uncertainty of the interval, 0 if stopped
+    ('counts',   '<i4', (1024,)),
+])
+
+
+class SpectrumArchiveWriter:
+    """
+    Append-only single-file archive of a sequence of spectra, e.g.
+    the interval captures of spect -I, with the time, livetime, 
+    realtime and settings of each. Appending to an existing archive
+    continues it.
+
+    >>> with SpectrumArchiveWriter('captures.dbsa') as archive:
+    ...     archive.append(base.spectrum_array(), base.livetime, base.realtime)
+
+    With sync=True every append is flushed to the storage device
+    (fsync) before returning.
+    """
+    def __init__(self, filename, comment: str=None, sync: bool=False):
+        self.filename = filename
+        self.sync = sync
+        self._f = open(filename, 'a+b')
+        size = self._f.seek(0, os.SEEK_END)
+        hsize = calcsize(DBSA_HEADER)
+        if size < hsize:
+            self._f.truncate(0)
+            comment = (comment or '').encode('utf-8')[:47]
+            self._f.write(pack(DBSA_HEADER, b'DBSA', 1, DBSA_RECORD.itemsize, 1024, comment))
+        else:
+            self._f.seek(0)
+            magic, version, record_size, nchan, _ = unpack(DBSA_HEADER, self._f.read(hsize))
+            if magic != b'DBSA' or version != 1 or record_size != DBSA_RECORD.itemsize:
+                raise ValueError("Not a compatible spectrum archive")
+            # Drop a torn record at the end
+            self._f.truncate(hsize + (size - hsize) // record_size * record_size)
+        self._f.flush()
+
+    def append(self, spectrum, livetime: float, realtime: float, time: float=None,
+               serial: int=0, hv: int=0, disc: int=0, 
+               ext_gate: ExtGateMode=ExtGateMode.OFF, gain: float=0.0, skew: float=0.0):
+        "Append a spectrum; time is the POSIX timestamp of its readout (default now)"
+        rec = np.zeros(1, dtype=DBSA_RECORD)
+        rec['time'] = datetime.now().timestamp() if time is None else time
+        rec['livetime'] = livetime
+        rec['realtime'] = realtime
+        rec['gain'] = gain
+        rec['serial'] = serial
+        rec['ext_gate'] = ext_gate.value
+        rec['hv'] = hv
+        rec['disc'] = disc
+        rec['skew'] = skew
+        rec['counts'] = spectrum
+        self._f.write(rec.tobytes())
+        self._f.flush()
+        if self.sync: os.fsync(self._f.fileno())
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SpectrumArchiveReader:
+    """
+    Memory-mapped reader of spectrum archives. Record fields are 
+    available as arrays, the spectra as an N x 1024 array:
+
+    >>> archive = SpectrumArchiveReader('captures.dbsa')
+    >>> archive.counts.shape
+    (86400, 1024)
+    >>> day2 = archive.slice(t0, t0 + 86400)
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        hsize = calcsize(DBSA_HEADER)
+        with open(filename, 'rb') as f:
+            magic, self.version, record_size, nchan, comment = unpack(DBSA_HEADER, f.read(hsize))
+        if magic != b'DBSA': raise ValueError("Unknown file format")
+        if self.version != 1 or record_size != DBSA_RECORD.itemsize:
+            raise ValueError(f"Unsupported spectrum archive version {self.version}")
+        self.comment = comment.rstrip(b'\x00').decode('utf-8')
+        n = (os.path.getsize(filename) - hsize) // record_size
+        if n == 0:
+            self.records = np.zeros(0, dtype=DBSA_RECORD)
+        else:
+            self.records = np.memmap(filename, dtype=DBSA_RECORD, mode='r', 
+                                     offset=hsize, shape=(n,))
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getattr__(self, name):
+        # Record fields: time, livetime, realtime, counts, ...
+        if name != 'records' and name in DBSA_RECORD.names: return self.records[name]
+        raise AttributeError(name)
+
+    def slice(self, t0: float=None, t1: float=None) -> np.ndarray:
+        "Records with readout times in [t0, t1)"
+        t = self.records['time']
+        i0 = 0 if t0 is None else np.searchsorted(t, t0, side='left')
+        i1 = len(t) if t1 is None else np.searchsorted(t, t1, side='left')
+        return self.records[i0:i1]
+
+
+def _pool_map(fn, tasks, jobs: int=None):
+    "Map fn over tasks in a process pool of jobs workers, in order; in process if jobs is 1"
+    if jobs is None: jobs = os.cpu_count() or 1
+    if jobs == 1 or len(tasks) <= 1: return map(fn, tasks)
+    from concurrent.futures import ProcessPoolExecutor
+    def results():
+        # The pool only exists while the results are iterated
+        with ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) as pool:
+            yield from pool.map(fn, tasks)
+    return results()
+
+def _roi_sums(counts, rois) -> np.ndarray:
+    "N x R counts of spectra in the ROIs [lo, hi)"
+    cumsum = np.zeros((len(counts), counts.shape[1] + 1), dtype=np.int64)
+    np.cumsum(counts, axis=1, out=cumsum[:, 1:])
+    return cumsum[:, rois[:, 1]] - cumsum[:, rois[:, 0]]
+
+def _spectra_task(task):
+    "Map step of analyze_spectra: partial sums of a run of DBKG files or archive records"
+    kind, source, i0, i1, rois = task
+    if kind == 'dbkg':
+        counts, meta = read_spectra(source[i0:i1], workers=1)
+        time, exposure = meta['time'], meta['exposure']
+    else:
+        records = SpectrumArchiveReader(source).records[i0:i1]
+        counts, time, exposure = records['counts'], records['time'], records['livetime']
+    return (counts.sum(axis=0, dtype=np.int64), np.array(time), np.array(exposure),
+            counts.sum(axis=1, dtype=np.int64), _roi_sums(counts, rois))
+
+def analyze_spectra(paths, rois=(), jobs: int=None, chunk: int=256) -> dict:
+    """
+    Sum spectra and pull ROI time series out of DBKG files and spectrum
+    archives, spread over a process pool.
+
+    Files are read chunk spectra at a time, each worker returning the sum
+    of its spectra and the time, livetime, total and ROI counts of every
+    one; these are put back together in the order of the input.
+
+    Parameters
+    ----------
+    paths : str or list
+        Files, DBKG or DBSA, or a glob pattern (sorted)
+    rois : array-like
+        N x 2 ROI channel bounds, low inclusive, high exclusive
+    jobs : int
+        Number of worker processes; all cores if None, 1 to run in process
+    chunk : int
+        Spectra per task
+
+    Returns
+    -------
+    dict of np.ndarray
+        spectrum (summed counts), exposure (summed livetime), and per
+        spectrum time, livetime, counts (total), roi_counts (N x R) and 
+        file_index (into files); rois and files
+    """
+    if isinstance(paths, (str, os.PathLike)): paths = sorted(glob(os.fspath(paths)))
+    rois = np.array(rois, dtype=np.intp).reshape(-1, 2)
+    if np.any(rois[:, 0] < 0) or np.any(rois[:, 1] > 1024) or np.any(rois[:, 0] >= rois[:, 1]):
+        raise ValueError("ROIs must satisfy 0 <= lo < hi <= 1024")
+    # Runs of DBKG files are one task per chunk; archives are split by records
+    tasks, owners, dbkg = [], [], []
+    def flush():
+        for i in range(0, len(dbkg), chunk):
+            part = dbkg[i:i + chunk]
+            tasks.append(('dbkg', [p for j, p in part], 0, len(part), rois))
+            owners.append([j for j, p in part])
+        dbkg.clear()
+    for j, path in enumerate(paths):
+        with open(path, 'rb') as f: magic = f.read(4)
+        if magic != b'DBSA':
+            dbkg.append((j, path))
+            continue
+        flush()
+        n = len(SpectrumArchiveReader(path))
+        for i in range(0, n, chunk):
+            tasks.append(('dbsa', path, i, min(i + chunk, n), rois))
+            owners.append([j] * (min(i + chunk, n) - i))
+    flush()
+
+    spectrum = np.zeros(1024, dtype=np.int64)
+    parts = []
+    for part in _pool_map(_spectra_task, tasks, jobs):
+        spectrum += part[0]
+        parts.append(part[1:])
+    def cat(k, dtype, shape=()):
+        if len(parts) == 0: return np.zeros((0,) + shape, dtype=dtype)
+        return np.concatenate([p[k] for p in parts]).astype(dtype)
+    livetime = cat(1, np.float64)
+    return dict(spectrum=spectrum, exposure=livetime.sum(), time=cat(0, np.float64),
+                livetime=livetime, counts=cat(2, np.int64), 
+                roi_counts=cat(3, np.int64, (len(rois),)), rois=rois,
+                file_index=np.array([j for o in owners for j in o], dtype=np.int32),
+                files=np.array([os.fspath(p) for p in paths], dtype=str))
+
+def _epoch_task(task):
+    "Map step of the list mode epoch scan: (first, last, # wraps) of the rollover epochs"
+    filename, w0, w1 = task
+    words = ListModeReader(filename).words[w0:w1]
+    epochs = words[(words & HitDecoder.ROLLOVER) != 0] & HitDecoder.EPOCH_MASK
+    if len(epochs) == 0: return None
+    return int(epochs[0]), int(epochs[-1]), int(np.count_nonzero(np.diff(epochs.astype(np.int64)) < 0))
+
+def _hits_task(task):
+    "Map step of analyze_list_mode: spectra of the time slices a part of a file covers"
+    filename, a, b, epoch, width = task
+    reader = ListModeReader(filename)
+    if reader.version == 0:
+        decoder = HitDecoder()
+        decoder.epoch = epoch
+        t, adc = decoder.decode(reader.words[a:b])
+        t_end = decoder.epoch
+    else:
+        with open(filename, 'rb') as f:
+            parts = [reader._load(f, entry) for entry in reader.index[a:b]]
+        t = np.concatenate([p[0] for p in parts])
+        adc = np.concatenate([p[1] for p in parts])
+        t_end = int(reader.index['last'][b - 1])
+    if len(t) == 0: return 0, np.zeros((0, 1024), dtype=np.int64), t_end, 0
+    s0, s1 = int(t[0]) // width, int(t[-1]) // width + 1
+    h = ListModeHistogrammer(np.arange(s0, s1 + 1, dtype=np.int64) * width)
+    h.add(t, adc)
+    return s0, h.spectra, max(t_end, int(t[-1])), len(t)
+
+def analyze_list_mode(paths, width: float=1.0, rois=(), jobs: int=None,
+                      chunk_words: int=1 << 22) -> dict:
+    """
+    Histogram DBLM list mode files into time slices, spread over a 
+    process pool.
+
+    Files are split into parts of about chunk_words words (blocks of
+    version 2 files); each worker decodes one part and returns the spectra
+    of the slices it covers, which are added up in the end. The hit times
+    of raw word (version 0) files depend on all the rollover words before
+    them, so these are first scanned in parallel for their rollover epochs
+    alone, which tells each part the epoch it starts with.
+
+    Parameters
+    ----------
+    paths : str or list
+        DBLM files, or a glob pattern (sorted); each is a separate run
+    width : float
+        Slice width, seconds of the device clock
+    rois : array-like
+        N x 2 ROI channel bounds, low inclusive, high exclusive
+    jobs : int
+        Number of worker processes; all cores if None, 1 to run in process
+    chunk_words : int
+        Words (or hits) per task
+
+    Returns
+    -------
+    dict of np.ndarray
+        spectrum (summed counts), spectra (slices x 1024), and per slice
+        file_index (into files), start (seconds from the start of the run),
+        realtime (of the list mode clock) and roi_counts (slices x R); 
+        per file start_time and hits;
+        width, rois and files
+    """
+    if isinstance(paths, (str, os.PathLike)): paths = sorted(glob(os.fspath(paths)))
+    rois = np.array(rois, dtype=np.intp).reshape(-1, 2)
+    if np.any(rois[:, 0] < 0) or np.any(rois[:, 1] > 1024) or np.any(rois[:, 0] >= rois[:, 1]):
+        raise ValueError("ROIs must satisfy 0 <= lo < hi <= 1024")
+    width_us = int(round(width * 1e6))
+    if width_us <= 0: raise ValueError("width must be > 0")
+    readers = [ListModeReader(p) for p in paths]
+
+    # Epoch scan of the version 0 files, then the epoch each of their parts starts with
+    scans = [(j, (r.filename, w0, min(w0 + chunk_words, len(r.words))))
+             for j, r in enumerate(readers) if r.version == 0
+             for w0 in range(0, len(r.words), chunk_words)]
+    tasks, owners = [], []
+    epoch, last = 0, None
+    for (j, (filename, w0, w1)), scan in zip(scans, _pool_map(_epoch_task, [s for j, s in scans], jobs)):
+        if j != last: epoch, last = 0, j
+        tasks.append((filename, w0, w1, epoch, width_us))
+        owners.append(j)
+        if scan is None: continue
+        first, end, wraps = scan
+        # Same unwrapping as HitDecoder: a decrease of the 31-bit epoch is a wrap
+        wraps += first < (epoch & HitDecoder.EPOCH_MASK)
+        epoch = epoch - (epoch & HitDecoder.EPOCH_MASK) + end + (wraps << 31)
+    for j, r in enumerate(readers):
+        if r.version != 2: continue
+        # Whole blocks, about chunk_words hits per task
+        bounds = np.searchsorted(np.cumsum(r.index['nhits']), 
+                                 np.arange(chunk_words, r.nhits, chunk_words), side='left') + 1
+        edges = np.unique(np.concatenate(([0], bounds, [len(r.index)])))
+        for a, b in zip(edges[:-1], edges[1:]):
+            tasks.append((r.filename, int(a), int(b), 0, width_us))
+            owners.append(j)
+
+    # Reduce: add up the slices of each file
+    nfiles = len(readers)
+    parts = [[] for j in range(nfiles)]
+    t_end = [int(r.realtime * 1e6) for r in readers]
+    hits = np.zeros(nfiles, dtype=np.int64)
+    for j, (s0, spectra, end, n) in zip(owners, _pool_map(_hits_task, tasks, jobs)):
+        t_end[j] = max(t_end[j], end)
+        hits[j] += n
+        if n > 0: parts[j].append((s0, spectra))
+    spectra, file, start, realtime = [], [], [], []
+    for j in range(nfiles):
+        n = max([-(-t_end[j] // width_us)] + [s0 + len(s) for s0, s in parts[j]])
+        s = np.zeros((n, 1024), dtype=np.int64)
+        for s0, counts in parts[j]: s[s0:s0 + len(counts)] += counts
+        edges = np.arange(n + 1, dtype=np.int64) * width_us
+        spectra.append(s)
+        file.append(np.full(n, j, dtype=np.int32))
+        start.append(edges[:-1] * 1e-6)
+        realtime.append(np.diff(np.clip(edges, 0, t_end[j])) * 1e-6)
+    spectra = np.concatenate(spectra) if nfiles else np.zeros((0, 1024), dtype=np.int64)
+    return dict(spectrum=spectra.sum(axis=0), spectra=spectra, 
+                file_index=np.concatenate(file) if nfiles else np.zeros(0, dtype=np.int32),
+                start=np.concatenate(start) if nfiles else np.zeros(0),
+                realtime=np.concatenate(realtime) if nfiles else np.zeros(0),
+                roi_counts=_roi_sums(spectra, rois), hits=hits,
+                start_time=np.array([r.start_time for r in readers]),
+                width=width, rois=rois, files=np.array([os.fspath(p) for p in paths], dtype=str))
+
+
+def main(argv=None):
+    "Command line interface, installed as the digibase script"
+    from argparse import ArgumentParser
+    parser = ArgumentParser(prog='digibase.py', description='Simple DAQ for ORTEC/AMETEK digiBase')
+    parser.add_argument('--pmt-hv', type=int, default=800)
+    parser.add_argument('--disc', type=int, default=20)
+    parser.add_argument('-X', '--external-gate', default='OFF', choices=['OFF', 'COINCIDENCE', 'ENABLED'])
+    parser.add_argument('-g', '--gain', type=float, default=0.5)
+    parser.add_argument('--realtime-preset', type=float, default=0.0)
+    parser.add_argument('--livetime-preset', type=float, default=0.0)
+    parser.add_argument('--sn', help='S/N of digiBase (in case of >1)')
+    parser.add_argument('--emulate', type=float, metavar='RATE',
+                        help='Run against a software emulated digiBase with the given hit rate (Hz)')
+    parser.add_argument('--record', metavar='TRACE', 
+                        help='Record the USB traffic of the run to a trace file')
+    parser.add_argument('--replay', metavar='TRACE', 
+                        help='Replay a recorded trace instead of talking to a device')
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        help='Replay pace relative to the recording; 0 = as fast as possible')
+    parser.add_argument('-F', '--fast-attach', action='store_true',
+                        help='Do not reset a device that already has its firmware')
+    parser.add_argument('-S', '--stabilize', metavar='LO,CENTER,HI',
+                        help='Keep the peak in this channel window centered by adjusting the fine gain')
+    parser.add_argument('--stabilize-threshold', type=float, default=0.005,
+                        help='Relative peak drift that triggers a gain adjustment')
+    parser.add_argument('--gain-log', metavar='FILE',
+                        help='Write the gain adjustments made by --stabilize to this CSV file')
+    parser.add_argument('-q', '--quiet', action='store_true')
+    parser.add_argument('-L', '--log-level', nargs='?', default='WARNING', const='INFO')
+    parser.add_argument('-M', '--metrics', type=int, nargs='?', const=0, metavar='PORT',
+                        help='Print performance metrics every 10 s; serve them on '
+                        'http://127.0.0.1:PORT/metrics if PORT is given')
+
+    subparsers = parser.add_subparsers(dest='command', help='Run modes')
+    parser_spe = subparsers.add_parser('spect', help='Acquire spectrum, write to file')
+    parser_spe.add_argument('duration', type=float, 
+                            help='Time, in seconds to integrate spectrum')
+    parser_spe.add_argument('filename', 
+                            help='Output file in which spectrum is saved; ' 
+                            'note can contain bracketed expressions {seq} '
+                            'and {serial} which will be replaced by the '
+                            'current sequence of a multi-sequence run '
+                            '(triggered by -I option), and the digiBase '
+                            'S/N, respectively.'
+                            )
+    parser_spe.add_argument('-m', '--comment', help='Short run description (max 63 char)')
+    parser_spe.add_argument('-I', '--interval', type=float, default=0.0, 
+                            help='Slice spectral captures into intervals, if > 0')
+    parser_spe.add_argument('-C', '--continuous', action='store_true',
+                            help='Keep acquiring across intervals; slices are the '
+                            'differences of spectrum snapshots')
+    parser_spe.add_argument('-A', '--archive', action='store_true',
+                            help='Append the spectra to a single spectrum archive '
+                            '(filename) instead of writing one file each')
+
+    parser_det = subparsers.add_parser('detect', help='Detect presence of signal over background')
+    parser_det.add_argument('duration', type=float, help='Integration time of each query interval')
+    parser_det.add_argument('n', type=int, help='Number of intervals')
+    parser_det.add_argument('sig0', type=int, help='Channel # of low side of signal RoI')
+    parser_det.add_argument('sig1', type=int, help='Channel # of high side of signal RoI')
+    parser_det.add_argument('filename', nargs='+', help='Spectrum file for background subtraction')
+    parser_det.add_argument('-a', '--alpha', type=float, default=1.0, 
+                            help='Exponential Moving Average parameter.')
+    parser_det.add_argument('--norm-roi')
+    parser_det.add_argument('-R', '--roi', action='append', default=[], 
+                            help='Additional ROI lo:hi to watch (repeatable)')
+    parser_det.add_argument('--method', default='cusum', choices=['cusum', 'sprt'],
+                            help='Sequential test run per ROI')
+    parser_det.add_argument('--ratio', type=float, default=1.5,
+                            help='Signal to background rate ratio the test is tuned for')
+    parser_det.add_argument('--threshold', type=float, 
+                            help='Alarm threshold of the log-likelihood ratio (default ln 1000)')
+
+    parser_acq = subparsers.add_parser('acq', help='List mode acquisition')
+    parser_acq.add_argument('duration', type=float, help='Acquisition time')
+    parser_acq.add_argument('filename', help='Output file for list mode data')
+    parser_acq.add_argument('--depth', type=int, default=1,
+                            help='Number of list mode read requests kept in flight '
+                                 '(above 1 unverified on hardware)')
+    parser_acq.add_argument('-f', '--format', type=int, default=0, choices=[0, 2],
+                            help='DBLM file version: 0 = raw words, 2 = compressed blocks')
+    parser_acq.add_argument('-W', '--watermark', type=float, default=0.5,
+                            help='Pace device polls to keep the device list buffer below this '
+                                 'fraction of full (0 = poll back to back)')
+    parser_acq.add_argument('--max-interval', type=float, default=0.05,
+                            help='Longest pause between device polls when quiet, in seconds')
+
+    parser_ana = subparsers.add_parser('analyze', help='Offline analysis of spectrum and list mode files')
+    analyzers = parser_ana.add_subparsers(dest='analysis', required=True, help='Analyses')
+    parser_ana_spe = analyzers.add_parser('spect', help='Sum DBKG files and spectrum archives, '
+                                          'and ROI counts of each spectrum')
+    parser_ana_acq = analyzers.add_parser('acq', help='Histogram DBLM files into time slices, '
+                                          'and ROI counts of each slice')
+    parser_ana_acq.add_argument('-w', '--width', type=float, default=1.0,
+                                help='Time slice width, seconds')
+    for p in (parser_ana_spe, parser_ana_acq):
+        p.add_argument('filename', nargs='+', help='Input files (or glob patterns)')
+        p.add_argument('-o', '--output', required=True, help='Output .npz file')
+        p.add_argument('-R', '--roi', action='append', default=[], 
+                       help='ROI lo:hi, high channel exclusive (repeatable)')
+        p.add_argument('-j', '--jobs', type=int, help='Worker processes (default: all cores)')
+
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level)
+    log = logging.getLogger()
+
+    if args.command == 'analyze':
+        paths = [p for name in args.filename for p in (sorted(glob(name)) or [name])]
+        rois = [tuple(int(ch) for ch in roi.replace(':', ',').split(',')) for roi in args.roi]
+        t0 = perf_counter()
+        if args.analysis == 'spect':
+            result = analyze_spectra(paths, rois, jobs=args.jobs)
+            summary = f"{len(result['time'])} spectra, {result['exposure']:.1f} s livetime"
+        else:
+            result = analyze_list_mode(paths, args.width, rois, jobs=args.jobs)
+            summary = f"{result['hits'].sum()} hits in {len(result['start'])} slices"
+        np.savez_compressed(args.output, **result)
+        if not args.quiet:
+            print(f"{len(paths)} files: {summary}, {result['spectrum'].sum()} counts "
+                  f"in {perf_counter() - t0:.1f} s")
+        return
+
+    metrics = None
+    if args.metrics is not None:
+        def report(m):
+            rates, gauges = m['rates'], m['gauges']
+            print(f"Metrics: {rates['bytes_read_per_s']/1e3:.1f} kB/s read, "
+                  f"{rates['hits_per_s']:.0f} hits/s, {m['counters']['empty_polls']} empty polls, "
+                  f"list buffer {100*gauges['list_buffer_occupancy_max']:.0f}% max")
+        metrics = Metrics(callback=report, interval=10.0)
+        if args.metrics > 0: metrics.serve(args.metrics)
+    def timed(name):
+        return nullcontext() if metrics is None else metrics.timed(name)
+
+    if args.replay is not None:
+        transport = ReplayTransport(args.replay, speed=args.replay_speed or None)
+    elif args.emulate is not None:
+        transport = digiBaseEmulator(serial=args.sn or '0', rate=args.emulate, configured=True)
+    else:
+        transport = UsbTransport.find(args.sn, reset=not args.fast_attach)
+    if args.record is not None: transport = RecordingTransport(transport, args.record)
+    try:
+        base = digiBase(transport=transport, metrics=metrics, fast_attach=args.fast_attach)
+
+        # Configure the device to sane defaults    
+        base.clear_spectrum()
+        base.clear_counters()
+
+        hv_was_enabled = base.hv_enabled
+        with base.configure():
+            base.livetime_preset = args.livetime_preset
+            base.realtime_preset = args.realtime_preset
+            base.set_presets(livetime=args.livetime_preset > 0, realtime=args.realtime_preset > 0)
+
+            base.lld = args.disc
+            base.ext_gate = ExtGateMode[args.external_gate]
+
+            # Disable auto gain and zero stabilization
+            base.auto_stabilize()
+
+            # HV and gain settings
+            if base.hv != args.pmt_hv: base.hv = args.pmt_hv
+            base.hv_enabled = True
+            base.fine_gain = args.gain
+        # Let the HV settle if it was just turned on
+        if not hv_was_enabled: sleep(5.0)
+
+        # Settings recorded in spectrum files
+        settings = dict(hv=args.pmt_hv, disc=args.disc, 
+                        ext_gate=ExtGateMode[args.external_gate], gain=args.gain)
+
+        stabilizer = None
+        if args.stabilize is not None:
+            window = tuple(int(ch) for ch in args.stabilize.replace(':', ',').split(','))
+            stabilizer = GainStabilizer(base, window, threshold=args.stabilize_threshold)
+
+        if args.command == 'spect':
+            archive = None
+            if args.archive: archive = SpectrumArchiveWriter(args.filename, comment=args.comment)
+            def save(spectrum, status, seq, skew=0.0):
+                with timed('file_write'):
+                    if archive is not None:
+                        archive.append(spectrum, status.livetime, status.realtime,
+                                       serial=int(base.serial), skew=skew, **settings)
+                    else:
+                        filename = args.filename.format(seq=seq, serial=base.serial)
+                        write_background(filename, spectrum, status.livetime, args.comment,
+                                         serial=int(base.serial), **settings,
+                                         skew=skew if args.continuous else None)
+            base.set_acq_mode_pha()
+            base.start()
+            t0 = datetime.now()
+            t1 = t0
+            run_time = timedelta(seconds=args.duration)
+            interval = timedelta(seconds=args.interval)
+            iseq = 0
+            last = SpectrumSnapshot(np.zeros(1024, dtype=np.int64), 0.0, 0.0, t0.timestamp(), 0.0)
+            done = False
+            if interval == timedelta(0) and (args.livetime_preset > 0 or args.realtime_preset > 0):
+                # A preset ends the run: sleep until the device stops rather than for the duration
+                done = base.wait_until_done(timeout=args.duration)
+                if not done: log.info(f'Presets not reached in {args.duration} s')
+            while (elapsed_time := datetime.now() - t0) < run_time and not done:
+                if interval > timedelta(0.0) and datetime.now() - t1 > interval:
+                    if args.continuous:
+                        snap = base.spectrum_snapshot()
+                        part = snap.since(last)
+                        last = snap
+                        save(part.spectrum, part, iseq, part.skew)
+                        log.info(f'Slice {iseq}: livetime {part.livetime:.2f} s skew {part.skew*1e3:.1f} ms')
+                    else:
+                        base.stop()
+                        spectrum = base.spectrum_array()
+                        status = base.status_snapshot(refresh=True)
+                        base.start()
+                        save(spectrum, status, iseq)
+                    t1 = datetime.now()
+                    iseq += 1
+                if stabilizer is not None:
+                    stabilizer.push(base.spectrum_array(), base.livetime)
+                    settings['gain'] = stabilizer.gain
+                if not args.quiet: print("Elapsed time: " + str(elapsed_time), end='\r')
+                # Wake up for the next slice or the end of the run, and to show progress
+                wake = run_time if interval == timedelta(0) else min(t1 - t0 + interval, run_time)
+                sleeptime = (wake - (datetime.now() - t0)) / timedelta(seconds=1.0)
+                if not args.quiet: sleeptime = min(sleeptime, 0.25)
+                if stabilizer is not None: sleeptime = min(sleeptime, 1.0)
+                if sleeptime > 0.0: sleep(sleeptime)
+            base.stop()
+            if args.continuous:
+                part = base.spectrum_snapshot().since(last)
+                spectrum, status, skew = part.spectrum, part, part.skew
+            else:
+                spectrum = base.spectrum_array()
+                status = base.status_snapshot(refresh=True)
+                skew = 0.0
+            if not args.quiet: 
+                print("Elapsed time: " + str(elapsed_time))
+                print(f"Collected {spectrum.sum()} counts")
+                print(f"Livetime {status.livetime:.3f} s")
+                print(f"Realtime {status.realtime:.3f} s")
+            save(spectrum, status, iseq, skew)
+            if archive is not None: archive.close()
+        elif args.command == 'detect':
+            base.set_acq_mode_pha()
+            base.start()
+            bkg_spectra, bkg_meta = read_spectra(args.filename)
+            bkg = bkg_spectra.sum(axis=0, dtype=np.int32)
+            exp_bkg = bkg_meta['exposure'].sum()
+            log.debug(f'Total background counts {np.sum(bkg)} in {exp_bkg} s')
+
+            # The first ROI is the one printed, any further --roi are logged
+            rois = [(args.sig0, args.sig1)]
+            for roi in args.roi:
+                lo, hi = roi.replace(':', ',').split(',')
+                rois.append((int(lo), int(hi)))
+            # Optional mode normalizes not on exposure time but a portion of the spectrum
+            norm_roi = None
+            if args.norm_roi is not None:
+                nr0, nr1 = args.norm_roi.split(',')
+                norm_roi = (int(nr0), int(nr1))
+            detector = RoiDetector(bkg, exp_bkg, rois, norm_roi=norm_roi, alpha=args.alpha, 
+                                   ratio=args.ratio, method=args.method, threshold=args.threshold)
+            log.debug(f'ROI background rates {detector.bkg_rate}')
+            spectrum_last = np.zeros(1024, dtype=np.int32)
+
+            try:
+                for i in range(args.n):
+                    sleep(args.duration)
+                    spectrum = base.spectrum_array().astype(np.int32)
+                    result = detector.push(spectrum, base.livetime)
+                    cspec = np.sum(spectrum - spectrum_last)
+                    spectrum_last = spectrum
+                    print(datetime.now(), '-', 
+                          f'cs: {cspec:.1f} craw {result.raw[0]} counts {result.net[0]:.2f}', flush=True)
+                    for j, (lo, hi) in enumerate(detector.rois):
+                        if j > 0: 
+                            log.info(f'ROI {lo}:{hi} craw {result.raw[j]} counts {result.net[j]:.2f} '
+                                     f'{args.method} {result.statistic[j]:.2f}')
+                        if result.alarm[j]:
+                            log.warning(f'ROI {lo}:{hi} signal: {args.method} statistic '
+                                        f'{result.statistic[j]:.2f} > {detector.threshold:.2f}')
+            except KeyboardInterrupt:
+                print("User terminated run")
+            base.stop()
+        elif args.command == 'acq':
+            nhits = 0
+            base.set_acq_mode_list()
+            scheduler = None
+            if args.watermark > 0:
+                scheduler = PollScheduler(watermark=args.watermark, max_interval=args.max_interval)
+            stream = base.list_mode_stream(depth=args.depth, scheduler=scheduler)
+            stream.start()
+            t0 = datetime.now()
+            run_time = timedelta(seconds=args.duration)
+            if args.format == 2:
+                fhits = ListModeWriter(args.filename, start_time=t0.timestamp(), base=base)
+            else:
+                fhits = open(args.filename, 'wb')
+                fhits.write(b'DBLM\x00\x00\x00\x00')
+                fhits.write(pack('d', t0.timestamp()))
+                fhits.seek(16, os.SEEK_CUR)
+            elapsed_time = timedelta(0)
+            for hits in stream.blocks(timeout=0.25):
+                nhits += len(hits)
+                if len(hits) > 0: 
+                    with timed('file_write'): fhits.write(hits)
+                    if stabilizer is not None: stabilizer.add_words(hits)
+                elapsed_time = datetime.now() - t0
+                if elapsed_time >= run_time: stream.stop()
+                if not args.quiet: print("Elapsed time: " + str(elapsed_time), end='\r')
+            stream.stop()
+            if not args.quiet: print("Elapsed time: " + str(elapsed_time))
+            if args.format == 2:
+                fhits.close()
+                status = base.status_snapshot()
+            else:
+                status = base.status_snapshot()
+                fhits.seek(16, os.SEEK_SET)
+                fhits.write(pack('d', status.livetime))
+                fhits.write(pack('d', status.realtime))
+                fhits.close()
+            if not args.quiet:
+                print(f"Collected {nhits} hits")
+                print(f"Livetime {status.livetime:.3f} s")
+                print(f"Realtime {status.realtime:.3f} s")
+                print(f"Ring buffer high water {stream.high_water} words, "
+                      f"largest device read {stream.max_read} words")
+                if scheduler is not None:
+                    s = scheduler.summary()
+                    print(f"Polls {s['polls']} ({s['empty_polls']} empty, {s['busy_polls']} back to back), "
+                          f"slept {s['sleep_time']:.1f} s, peak rate {s['peak_rate']:.0f} words/s, "
+                          f"device buffer peak {100*s['max_occupancy']:.0f}%")
+            if stream.overflow: log.warning('Device list buffer overflowed during the run')
+        if stabilizer is not None:
+            log.info(f'Gain stabilization made {len(stabilizer.history)} adjustments, '
+                     f'fine gain now {stabilizer.gain:.5f}')
+            if args.gain_log is not None:
+                with open(args.gain_log, 'w') as f:
+                    f.write(','.join(GainAdjustment._fields) + '\n')
+                    for adj in stabilizer.history: f.write(','.join(str(x) for x in adj) + '\n')
+    finally:
+        # Finish the trace however the run ends
+        if args.record is not None: transport.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,15 @@
+# Fixtures shared by the tests
+
+import pytest
+
+class FakeClock:
+    "Manually advanced time source for the emulator"
+    def __init__(self):
+        self.t = 0.0
+
+    def __call__(self):
+        return self.t
+
+@pytest.fixture
+def clock():
+    return FakeClock()
@@ -0,0 +1,76 @@
+# Tests of digiBaseArray against emulated bases - no hardware needed
+
+import pytest
+import numpy as np
+from time import monotonic
+import digibase
+
+@pytest.fixture
+def bases():
+    emus = [digibase.digiBaseEmulator(serial=str(sn), rate=5000.0, configured=True, seed=sn)
+            for sn in (11, 12, 13)]
+    bases = digibase.digiBaseArray(bases=[digibase.digiBase(transport=e) for e in emus])
+    yield bases
+    bases.close()
+
+def test_lookup(bases):
+    assert bases.serials == ['11', '12', '13']
+    assert bases['12'] is bases[1]
+    with pytest.raises(KeyError): bases['99']
+
+def test_fast_attach():
+    emus = [digibase.digiBaseEmulator(serial=str(sn), configured=True) for sn in (21, 22)]
+    with digibase.digiBaseArray(transports=emus, fast_attach=True) as bases:
+        assert bases.serials == ['21', '22']
+        assert all(base.attach_time > 0 for base in bases)
+
+def test_configure(bases):
+    bases.configure(verify=True, hv=800, lld=10, ext_gate=digibase.ExtGateMode.ENABLED,
+                    presets=dict(realtime=True), realtime_preset=10.0, mode='pha')
+    for base in bases:
+        assert base.hv == 800
+        assert base.lld == 10
+        assert base.realtime_preset == 10.0
+        assert base.status_snapshot().ext_gate == digibase.ExtGateMode.ENABLED
+    with pytest.raises(ValueError): bases.configure(volts=800)
+
+def test_snapshot(bases):
+    bases.configure(mode='pha', lld=0)
+    bases.clear()
+    bases.start()
+    snap = bases.snapshot()
+    bases.stop()
+    assert snap.spectra.shape == (3, 1024)
+    assert snap.livetime.shape == (3,)
+    assert snap.skew >= 0.0
+
+def test_drain(bases):
+    bases.configure(mode='list', lld=0)
+    bases.start()
+    later = monotonic() + 1000.0
+    for base in bases: base.transport.clock = lambda: later
+    words = bases.drain()
+    assert len(words) == 3
+    assert all(len(w) == 32768 for w in words)
+    assert all(len(w) == 0 for w in bases.drain())
+
+class ClosingEmulator(digibase.digiBaseEmulator):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+def test_close():
+    "Bases opened by the array are closed with it, bases handed in are not"
+    emus = [ClosingEmulator(serial=str(sn), configured=True) for sn in (31, 32)]
+    with digibase.digiBaseArray(transports=emus) as bases:
+        assert not any(emu.closed for emu in emus)
+    assert all(emu.closed for emu in emus)
+    assert all(base.transport is None for base in bases)
+    emu = ClosingEmulator(serial='33', configured=True)
+    base = digibase.digiBase(transport=emu)
+    with digibase.digiBaseArray(bases=[base]):
+        pass
+    assert not emu.closed and base.lld == base.lld
+    with pytest.raises(ValueError, match='No bases'):
+        digibase.digiBaseArray(bases=[])
@@ -0,0 +1,52 @@
+# Tests of the asyncio interface against emulated bases - no hardware needed
+
+import asyncio
+import numpy as np
+import digibase
+
+def make_base(serial, rate=5000.0):
+    emu = digibase.digiBaseEmulator(serial=serial, rate=rate, configured=True, seed=int(serial))
+    return digibase.AsyncDigiBase(digibase.digiBase(transport=emu))
+
+def test_async_pha():
+    async def run():
+        abases = [make_base(str(sn)) for sn in (1, 2)]
+        await asyncio.gather(*(a.configure(verify=True, hv=800, lld=0, mode='pha') for a in abases))
+        await asyncio.gather(*(a.clear() for a in abases))
+        await asyncio.gather(*(a.start() for a in abases))
+        await asyncio.sleep(0.2)
+        spectra = await asyncio.gather(*(a.spectrum() for a in abases))
+        status = await asyncio.gather(*(a.status() for a in abases))
+        await asyncio.gather(*(a.stop() for a in abases))
+        for a in abases: await a.close()
+        return spectra, status
+    spectra, status = asyncio.run(run())
+    assert all(s.shape == (1024,) and s.sum() > 0 for s in spectra)
+    assert all(st.hv == 800 and st.livetime > 0 for st in status)
+
+def test_async_stream():
+    async def run():
+        abase = make_base('7', rate=20000.0)
+        await abase.configure(lld=0, mode='list')
+        nwords = 0
+        async with abase.list_mode_stream(poll=0.01) as stream:
+            async for block in stream:
+                nwords += len(block)
+                # Other commands to the device still go through
+                status = await abase.status()
+                if status.realtime >= 0.2: await stream.stop()
+        await abase.close()
+        return nwords
+    assert asyncio.run(run()) > 1000
+
+def test_async_wait_until_done():
+    async def run():
+        abase = make_base('3')
+        await abase.configure(mode='pha', presets=dict(realtime=True), realtime_preset=0.2)
+        await abase.start()
+        done = await abase.wait_until_done(timeout=2.0)
+        status = await abase.status()
+        await abase.close()
+        return done, status
+    done, status = asyncio.run(run())
+    assert done and not status.busy and status.realtime == 0.2
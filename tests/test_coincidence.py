@@ -0,0 +1,86 @@
+# Tests of the coincidence builder on simulated hits of several bases - no hardware needed
+
+import pytest
+import numpy as np
+import digibase
+
+OFFSETS = [0.0, 120.0, -45.0]
+DRIFTS = [0.0, 30.0, -12.0]
+
+def encode(t, adc):
+    "List mode words of sorted hit times, with rollover words"
+    words = (adc.astype(np.uint32) << 21) | (t & 0x1f_ffff).astype(np.uint32)
+    bounds = np.arange(1, t[-1] // (1 << 21) + 1, dtype=np.int64) << 21
+    rollover = (0x8000_0000 | (bounds & 0x7fff_ffff)).astype(np.uint32)
+    return np.insert(words, np.searchsorted(t, bounds), rollover)
+
+@pytest.fixture
+def hits():
+    "Raw hits of 3 bases: singles plus 2000 coincidences, on drifting clocks"
+    rng = np.random.default_rng(5)
+    common = [rng.uniform(0, 5e6, 3000) for i in range(3)]
+    for tc in rng.uniform(0, 5e6, 2000):
+        for i in rng.choice(3, rng.integers(2, 4), replace=False):
+            common[i] = np.append(common[i], tc + rng.uniform(0, 1.0))
+    result = []
+    for i in range(3):
+        tc = np.sort(common[i])
+        t = np.rint((tc - OFFSETS[i]) / (1 + DRIFTS[i] * 1e-6)).astype(np.int64) + 1000
+        result.append((t, rng.integers(0, 1024, len(t)).astype(np.uint16)))
+    return result
+
+def reference(cb, hits):
+    "Plain loop over the merged hits"
+    merged = sorted((int(t), i, int(a)) for i, (ts, adcs) in enumerate(hits)
+                    for t, a in zip(cb.correct(i, ts), adcs))
+    groups, group = [], [merged[0]]
+    for hit in merged[1:]:
+        if hit[0] - group[-1][0] > cb.window:
+            groups.append(group)
+            group = []
+        group.append(hit)
+    groups.append(group)
+    return [g for g in groups if len({h[1] for h in g}) >= cb.min_bases]
+
+def test_coincidences(hits):
+    cb = digibase.CoincidenceBuilder(3, window=3, offsets=OFFSETS, drifts=DRIFTS)
+    for i, (t, adc) in enumerate(hits): cb.add(i, t, adc)
+    c = cb.finish()
+    ref = reference(cb, hits)
+    assert c.ngroups == len(ref)
+    assert 2000 <= c.ngroups < 2100
+    assert np.array_equal(c.multiplicity, [len(g) for g in ref])
+    assert np.array_equal(c.t, [h[0] for g in ref for h in g])
+    assert np.array_equal(c.base, [h[1] for g in ref for h in g])
+    assert np.array_equal(c.adc, [h[2] for g in ref for h in g])
+    assert np.array_equal(c.mask, [sum(1 << b for b in {h[1] for h in g}) for g in ref])
+
+def test_streaming(hits):
+    cb = digibase.CoincidenceBuilder(3, window=3, offsets=OFFSETS, drifts=DRIFTS)
+    for i, (t, adc) in enumerate(hits): cb.add(i, t, adc)
+    whole = cb.finish()
+    # Raw words fed in uneven chunks, the bases taking turns
+    rng = np.random.default_rng(6)
+    cb = digibase.CoincidenceBuilder(3, window=3, offsets=OFFSETS, drifts=DRIFTS)
+    words = [np.array_split(encode(t, adc), rng.integers(50, 80)) for t, adc in hits]
+    parts = []
+    for j in range(max(len(w) for w in words)):
+        for i in range(3):
+            if j < len(words[i]): cb.add_words(i, words[i][j])
+        parts.append(cb.pop())
+        # Held back are at most the hits beyond the slowest base
+        assert len(cb._carry[0]) < 1000
+    parts.append(cb.finish())
+    c = digibase.Coincidences.concatenate(parts)
+    for a, b in zip(c, whole): assert np.array_equal(a, b)
+
+def test_readers(tmp_path, hits):
+    readers = []
+    for i, (t, adc) in enumerate(hits):
+        filename = tmp_path / f'base{i}.dblm'
+        with digibase.ListModeWriter(filename, block_hits=1000) as f: f.write(encode(t, adc))
+        readers.append(digibase.ListModeReader(filename))
+    cb = digibase.CoincidenceBuilder(3, window=3, offsets=OFFSETS, drifts=DRIFTS, min_bases=3)
+    c = digibase.Coincidences.concatenate(cb.add_readers(readers))
+    assert c.ngroups > 500 and np.all(c.mask == 7)
+    assert np.all(np.diff(c.time) > 0)
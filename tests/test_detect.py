@@ -0,0 +1,65 @@
+# Tests of the ROI detection engine - no hardware needed
+
+import pytest
+import numpy as np
+import digibase
+
+@pytest.fixture
+def background():
+    rng = np.random.default_rng(4)
+    shape = 20 * np.exp(-np.arange(1024) / 200.0) + 0.5
+    return rng.poisson(shape * 100), 100.0, shape
+
+ROIS = [(100, 140), (300, 360), (500, 501), (0, 1024)]
+
+def test_roi_sums(background):
+    bkg, exposure, shape = background
+    det = digibase.RoiDetector(bkg, exposure, ROIS)
+    assert np.allclose(det.bkg_rate, [bkg[lo:hi].sum() / exposure for lo, hi in ROIS])
+    spectrum = np.arange(1024)
+    result = det.update(spectrum, 1.0)
+    assert result.raw.tolist() == [spectrum[lo:hi].sum() for lo, hi in ROIS]
+    assert np.allclose(result.net, result.raw - det.bkg_rate)
+
+def test_bad_roi(background):
+    bkg, exposure, _ = background
+    with pytest.raises(ValueError):
+        digibase.RoiDetector(bkg, exposure, [(10, 2000)])
+    with pytest.raises(ValueError):
+        digibase.RoiDetector(bkg, exposure, [(10, 20)], norm_roi=(30, 30))
+
+@pytest.mark.parametrize('method', ['cusum', 'sprt'])
+def test_alarm(background, method):
+    bkg, exposure, shape = background
+    rng = np.random.default_rng(5)
+    det = digibase.RoiDetector(bkg, exposure, ROIS[:2], method=method, ratio=1.2)
+    # Background only: no alarms
+    alarms = [det.update(rng.poisson(shape), 1.0).alarm for i in range(200)]
+    assert not np.any(alarms)
+    # A line in the second ROI raises an alarm there only, quickly
+    line = np.zeros(1024)
+    line[320:340] = 2.0
+    first = None
+    for i in range(30):
+        result = det.update(rng.poisson(shape + line), 1.0)
+        assert not result.alarm[0]
+        if result.alarm[1] and first is None: first = i
+    assert first is not None and first < 10
+
+def test_push_norm_roi(background):
+    "Cumulative spectra with a norm ROI reproduce the detect formula"
+    bkg, exposure, shape = background
+    rng = np.random.default_rng(6)
+    det = digibase.RoiDetector(bkg, exposure, [(300, 360)], norm_roi=(600, 900), alpha=0.5)
+    rate = bkg / exposure
+    spectrum = np.zeros(1024, dtype=np.int64)
+    counts = None
+    for i in range(5):
+        last = spectrum.copy()
+        spectrum += rng.poisson(shape * 2)
+        result = det.push(spectrum, 2.0 * (i + 1))
+        diff = spectrum - last
+        bkg_sub = rate[600:900].sum() / diff[600:900].sum() * diff - rate
+        c = bkg_sub[300:360].sum()
+        counts = c if counts is None else 0.5 * c + 0.5 * counts
+        assert result.net[0] == pytest.approx(counts)
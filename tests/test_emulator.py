@@ -0,0 +1,277 @@
+# Tests against the software emulated digiBase - no hardware needed
+
+import pytest
+import numpy as np
+from time import sleep, monotonic
+import digibase
+
+@pytest.fixture
+def firmware(tmp_path, monkeypatch):
+    (tmp_path / 'digiBase.rbf').write_bytes(bytes(range(256)) * 653)
+    (tmp_path / 'digiBaseRH.rbf').write_bytes(bytes(75463))
+    monkeypatch.setenv('DIGIBASE_FIRMWARE_PATH', str(tmp_path))
+
+@pytest.fixture
+def base(clock):
+    emu = digibase.digiBaseEmulator(serial='1234', rate=2000.0, configured=True,
+                                    clock=clock, seed=1)
+    return digibase.digiBase(transport=emu)
+
+@pytest.mark.parametrize('rh', [False, True])
+def test_firmware_load(firmware, rh):
+    emu = digibase.digiBaseEmulator(rh=rh, serial='42')
+    base = digibase.digiBase(transport=emu)
+    assert base.isRH == rh
+    assert base.serial == '42'
+    assert emu.configured
+    assert len(emu.firmware) == (75463 if rh else 166965)
+
+@pytest.mark.parametrize('rh', [False, True])
+def test_warm_attach(rh):
+    emu = digibase.digiBaseEmulator(rh=rh, configured=True)
+    digibase.digiBase(transport=emu)
+    assert emu.firmware == b''
+
+@pytest.mark.parametrize('rh', [False, True])
+def test_fast_attach(firmware, rh):
+    emu = digibase.digiBaseEmulator(rh=rh, configured=True)
+    base = digibase.digiBase(transport=emu)
+    base.hv = 850
+    commands = []
+    write = emu.write
+    def counting_write(endpoint, data, timeout=None):
+        commands.append(bytes(data[:1]))
+        return write(endpoint, data, timeout)
+    emu.write = counting_write
+    base = digibase.digiBase(transport=emu, fast_attach=True)
+    # Only the firmware probe and one status read
+    assert commands == [b'\x06', b'\x01']
+    assert base.hv == 850 and base.attach_time > 0
+    # Cold devices still get their firmware, read from disk only once
+    digibase._read_firmware.cache_clear()
+    for i in range(3):
+        emu = digibase.digiBaseEmulator(rh=rh)
+        digibase.digiBase(transport=emu, fast_attach=True)
+        assert emu.configured
+    assert digibase._read_firmware.cache_info().misses == 1
+
+def test_configure(base):
+    with base.configure(verify=True):
+        base.hv = 800
+        base.lld = 24
+        base.ext_gate = digibase.ExtGateMode.COINCIDENCE
+        base.hv_enabled = True
+    assert base.hv == 800
+    assert base.lld == 24
+    assert base.ext_gate == digibase.ExtGateMode.COINCIDENCE
+    base.fine_gain = 0.75
+    assert abs(base.fine_gain - 0.75) < 0.001
+    assert base.hv_readback == 800
+
+def test_pha_preset(base, clock):
+    base.lld = 0
+    base.livetime_preset = 2.0
+    base.set_presets(livetime=True)
+    base.set_acq_mode_pha()
+    base.clear_counters()
+    base.start()
+    clock.t += 5.0
+    status = base.status_snapshot()
+    assert not status.busy
+    assert status.livetime == 2.0
+    counts = base.spectrum_array().sum()
+    assert 3600 < counts < 4400
+    assert sum(base.spectrum) == counts
+
+def test_list_mode(base, clock):
+    base.lld = 0
+    base.set_acq_mode_list()
+    base.start()
+    decoder = digibase.HitDecoder()
+    times = []
+    for i in range(50):
+        clock.t += 0.1
+        while len(words := base.hits_array()) > 0:
+            times.append(decoder.decode(words)[0])
+    base.stop()
+    t = np.concatenate(times)
+    assert 9000 < len(t) < 11000
+    assert np.all(np.diff(t) >= 0)
+    assert t[-1] < 5_000_000 and t[-1] > 4_900_000
+    assert decoder.rollovers == 2
+
+def test_list_mode_overflow(base, clock):
+    base.transport.rate = 1e6
+    base.set_acq_mode_list()
+    stream = base.list_mode_stream(status_interval=0.0)
+    stream.start()
+    clock.t += 1.0
+    nwords = sum(len(block) for block in stream)
+    assert stream.overflow
+    assert nwords == 32768
+    assert stream.max_read == 1024
+
+def test_list_mode_stream_paced(base, clock):
+    base.transport.rate = 1e4
+    base.set_acq_mode_list()
+    stream = base.list_mode_stream(scheduler=digibase.PollScheduler(max_interval=0.01))
+    stream.start()
+    clock.t += 1.0
+    sleep(0.1)
+    stream.stop()
+    t, adc = digibase.decode_hits(np.concatenate(list(stream)))
+    assert 9000 < len(t) < 11000 and not stream.overflow
+    assert stream.scheduler.polls > 2 and stream.scheduler.sleep_time > 0
+
+def test_poll_scheduler(clock):
+    "Polls paced against a simulated device buffer read at most 1024 words at a time"
+    sched = digibase.PollScheduler(watermark=0.5, max_interval=0.05, clock=clock)
+    level = peak = 0.0
+    for rate, duration in ((0, 1.0), (200_000, 2.0), (1_000, 2.0)):
+        t_end = clock.t + duration
+        while clock.t < t_end:
+            n = int(min(level, 1024))
+            level -= n
+            dt = sched.update(n) + 1e-4
+            clock.t += dt
+            level += rate * dt
+            peak = max(peak, level)
+    assert peak < 0.5 * 32768
+    assert sched.max_occupancy < 0.5
+    assert sched.peak_rate == pytest.approx(200_000, rel=0.1)
+    assert sched.busy_polls > 0 and sched.empty_polls > 0
+    # Quiet again: back to the longest pause
+    assert sched.update(0) == 0.05
+
+def preset_base(**presets):
+    "A base on the real clock, set up for a PHA run with presets, counting status reads"
+    emu = digibase.digiBaseEmulator(rate=1000.0, configured=True)
+    base = digibase.digiBase(transport=emu)
+    base.apply_settings(mode='pha', presets={key: True for key in presets}, 
+                        **{key + '_preset': val for key, val in presets.items()})
+    emu.reads = 0
+    write = emu.write
+    def counting_write(endpoint, data, timeout=None):
+        if bytes(data[:1]) == b'\x01': emu.reads += 1
+        return write(endpoint, data, timeout)
+    emu.write = counting_write
+    return base
+
+def test_wait_until_done():
+    base = preset_base(livetime=0.3)
+    base.start()
+    t0 = monotonic()
+    assert base.wait_until_done(timeout=5.0)
+    assert 0.3 <= monotonic() - t0 < 0.5
+    assert base.transport.reads < 10
+    assert base.livetime == pytest.approx(0.3, abs=0.021)
+    # Still running at the timeout
+    base = preset_base(realtime=10.0)
+    base.start()
+    t0 = monotonic()
+    assert not base.wait_until_done(timeout=0.2)
+    assert monotonic() - t0 < 0.3
+
+def test_status_watcher():
+    base = preset_base(realtime=0.3)
+    watcher = digibase.StatusWatcher(base, interval=0.05)
+    stopped = []
+    watcher.on('stopped', stopped.append)
+    with watcher:
+        base.start()
+        assert watcher.wait('started', timeout=1.0)
+        assert watcher.wait('stopped', timeout=2.0)
+        assert not watcher.wait('stopped', timeout=0.1)
+        watcher.watch('hv_on', 6, 1)
+        sleep(0.1)
+        base.hv_enabled = True
+        assert watcher.wait('hv_on', timeout=1.0)
+    assert len(stopped) == 1 and not stopped[0].busy
+    assert stopped[0].realtime == pytest.approx(0.3)
+
+@pytest.mark.parametrize('rh', [False, True])
+def test_hits_burst(clock, rh):
+    emu = digibase.digiBaseEmulator(rh=rh, rate=1e5, configured=True, clock=clock, seed=3)
+    base = digibase.digiBase(transport=emu)
+    base.set_acq_mode_list()
+    base.start()
+    clock.t += 0.2
+    words = np.concatenate([w.copy() for w in base.hits_burst(depth=4)])
+    assert len(words) > 10000
+    # Nothing left over on the endpoint, the next command works as usual
+    assert len(base.hits_array()) == 0
+    assert base.status_snapshot().busy
+
+def test_spectrum_snapshot(base, clock):
+    "Interval spectra from snapshots of a running acquisition add up"
+    base.lld = 0
+    base.set_acq_mode_pha()
+    base.start()
+    last = base.spectrum_snapshot()
+    total = last.spectrum.astype(np.int64)
+    for i in range(5):
+        clock.t += 1.0
+        snap = base.spectrum_snapshot()
+        part = snap.since(last)
+        last = snap
+        assert part.livetime == pytest.approx(1.0)
+        assert 1600 < part.spectrum.sum() < 2400
+        assert part.skew >= 0.0
+        total += part.spectrum
+    assert base.status_snapshot().busy
+    assert np.array_equal(total, base.spectrum_array())
+
+@pytest.mark.parametrize('mode', ['pha', 'list'])
+def test_gain_stabilizer(base, clock, mode):
+    "The photopeak at 600 x fine gain 0.5 is pulled onto channel 330"
+    base.lld = 0
+    stab = digibase.GainStabilizer(base, (280, 330, 380), threshold=0.005, min_counts=2000)
+    assert stab.gain == 0.5
+    base.set_acq_mode_pha() if mode == 'pha' else base.set_acq_mode_list()
+    base.start()
+    for i in range(60):
+        clock.t += 1.0
+        if mode == 'pha':
+            stab.push(base.spectrum_array(), base.livetime)
+        else:
+            while len(words := base.hits_array()) > 0: stab.add_words(words)
+    base.stop()
+    assert base.fine_gain == pytest.approx(0.55, rel=0.01)
+    assert stab.gain == pytest.approx(base.fine_gain, abs=1e-6)
+    # Adjusted at most 5% at a time, then held within the threshold
+    gains = [stab.start_gain] + [adj.new_gain for adj in stab.history]
+    assert np.all(np.abs(np.diff(gains) / gains[:-1]) <= 0.05 + 1e-9)
+    assert 2 <= len(stab.history) < 8 and stab.history[-1].t < 40
+    assert abs(stab.centroid / 330 - 1) < 0.01
+    first = stab.history[0]
+    assert first.centroid < 320 and first.old_gain == 0.5
+    assert stab.gains([0.0, first.t, 59.0]).tolist() == [0.5, first.new_gain, stab.gain]
+
+def test_gain_stabilizer_after_preset(base, clock):
+    "A correction after the device stopped on its preset does not restart it"
+    base.livetime_preset = 2.0
+    base.set_presets(livetime=True)
+    base.set_acq_mode_pha()
+    base.clear_counters()
+    base.start()
+    clock.t += 5.0
+    stab = digibase.GainStabilizer(base, (280, 330, 380), gain=0.5, min_counts=100)
+    counts = np.zeros(1024, dtype=int)
+    counts[300] = 1000
+    assert stab.update(counts, 5.0) is not None
+    status = base.status_snapshot(refresh=True)
+    assert not status.busy and status.livetime == 2.0
+    assert base.fine_gain == pytest.approx(stab.gain, abs=1e-6)
+
+def test_gain_stabilizer_offline():
+    "Without a base only the adjustments are computed; the continuum is subtracted"
+    rng = np.random.default_rng(3)
+    stab = digibase.GainStabilizer(window=(400, 450, 500), gain=1.0, min_counts=5000)
+    counts = np.bincount(np.concatenate((np.rint(rng.normal(440, 10, 20000)).astype(int),
+                                         rng.integers(0, 1024, 60000))), minlength=1024)
+    adj = stab.update(counts, 10.0)
+    assert adj.centroid == pytest.approx(440, abs=1.0)
+    assert adj.new_gain == pytest.approx(450 / adj.centroid)
+    assert stab.update(np.zeros(1024, dtype=int), 20.0) is None and stab.gain == adj.new_gain
+    with pytest.raises(ValueError):
+        digibase.GainStabilizer(window=(400, 450), gain=1.0)
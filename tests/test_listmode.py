@@ -0,0 +1,181 @@
+# Tests of the DBLM list mode file readers and writers - no hardware needed
+
+import pytest
+import numpy as np
+from struct import pack
+import digibase
+
+def make_words(n, rate=1e5, seed=0):
+    "List mode words of n hits at the given rate, with rollover words"
+    rng = np.random.default_rng(seed)
+    t = np.cumsum(rng.exponential(1e6 / rate, n)).astype(np.int64)
+    adc = rng.integers(0, 1024, n).astype(np.uint32)
+    words = (adc << 21) | (t & 0x1f_ffff).astype(np.uint32)
+    bounds = np.arange(1, t[-1] // (1 << 21) + 1, dtype=np.int64) << 21
+    rollover = (0x8000_0000 | (bounds & 0x7fff_ffff)).astype(np.uint32)
+    return np.insert(words, np.searchsorted(t, bounds), rollover), t, adc
+
+def write_v0(filename, words):
+    with open(filename, 'wb') as f:
+        f.write(b'DBLM\x00\x00\x00\x00' + pack('3d', 1.7e9, 2.0, 3.0))
+        f.write(words.tobytes())
+
+@pytest.fixture
+def hits():
+    return make_words(200_000)
+
+def test_v2_roundtrip(tmp_path, hits):
+    words, t, adc = hits
+    filename = tmp_path / 'run.dblm'
+    with digibase.ListModeWriter(filename, start_time=1.7e9, block_hits=10_000) as f:
+        for chunk in np.array_split(words, 37): f.write(chunk)
+        f.livetime, f.realtime = 2.0, 3.0
+    reader = digibase.ListModeReader(filename)
+    assert reader.version == 2
+    assert (reader.start_time, reader.livetime, reader.realtime) == (1.7e9, 2.0, 3.0)
+    assert reader.nhits == len(t)
+    assert len(reader.index) == 20
+    t2, adc2 = reader.read()
+    assert np.array_equal(t2, t) and np.array_equal(adc2, adc)
+    assert filename.stat().st_size < words.nbytes
+
+def test_v2_seek(tmp_path, hits):
+    words, t, adc = hits
+    filename = tmp_path / 'run.dblm'
+    with digibase.ListModeWriter(filename, block_hits=5_000) as f: f.write(words)
+    t0, t1 = 250_000, 1_234_567
+    sel = (t >= t0) & (t < t1)
+    ts, adcs = digibase.ListModeReader(filename).read(t0, t1, workers=4)
+    assert np.array_equal(ts, t[sel]) and np.array_equal(adcs, adc[sel])
+
+def test_v2_times_decreasing(tmp_path):
+    filename = tmp_path / 'run.dblm'
+    with digibase.ListModeWriter(filename) as f:
+        with pytest.raises(ValueError):
+            f.write_hits([100, 200, 50, 60], [1, 2, 3, 4])
+        f.write_hits([100, 200], [1, 2])
+        with pytest.raises(ValueError):
+            f.write_hits([150, 300], [3, 4])
+        f.write_hits([200, 300], [3, 4])
+    t, adc = digibase.ListModeReader(filename).read()
+    assert t.tolist() == [100, 200, 200, 300] and adc.tolist() == [1, 2, 3, 4]
+
+def test_v2_recover_index(tmp_path, hits):
+    words, t, adc = hits
+    filename = tmp_path / 'run.dblm'
+    f = digibase.ListModeWriter(filename, block_hits=10_000)
+    f.write(words)
+    f._f.close()    # Crash before close(): full blocks only, no footer
+    t2, adc2 = digibase.ListModeReader(filename).read()
+    assert len(t2) == 200_000
+    assert np.array_equal(t2, t[:len(t2)])
+
+def test_v0(tmp_path, hits):
+    words, t, adc = hits
+    filename = tmp_path / 'run.dblm'
+    write_v0(filename, words)
+    reader = digibase.ListModeReader(filename)
+    assert reader.version == 0 and reader.realtime == 3.0
+    t2, adc2 = reader.read()
+    assert np.array_equal(t2, t) and np.array_equal(adc2, adc)
+
+@pytest.mark.parametrize('version', [0, 2])
+def test_chunks(tmp_path, hits, version):
+    words, t, adc = hits
+    filename = tmp_path / 'run.dblm'
+    if version == 0:
+        write_v0(filename, words)
+    else:
+        with digibase.ListModeWriter(filename, block_hits=7_000) as f: f.write(words)
+    reader = digibase.ListModeReader(filename)
+    chunks = list(reader.chunks(chunk_words=10_000))
+    assert max(len(c[0]) for c in chunks) <= 10_000
+    assert np.array_equal(np.concatenate([c[0] for c in chunks]), t)
+    assert np.array_equal(np.concatenate([c[1] for c in chunks]), adc)
+    assert reader.nhits == len(t)
+    t0, t1 = 333_333, 999_999
+    sel = (t >= t0) & (t < t1)
+    part = list(reader.chunks(chunk_words=10_000, t0=t0, t1=t1))
+    assert np.array_equal(np.concatenate([c[0] for c in part]), t[sel])
+
+def test_v0_memmap(tmp_path, hits):
+    words, t, adc = hits
+    filename = tmp_path / 'run.dblm'
+    write_v0(filename, words)
+    mapped = digibase.ListModeReader(filename).words
+    assert isinstance(mapped, np.memmap)
+    assert np.array_equal(mapped, words)
+
+def reference_spectra(t, adc, edges):
+    return np.array([np.bincount(adc[(t >= lo) & (t < hi)], minlength=1024)
+                     for lo, hi in zip(edges[:-1], edges[1:])])
+
+@pytest.mark.parametrize('edges', [
+    np.arange(0, 2_100_000, 100_000),
+    np.array([50_000, 60_000, 400_000, 401_000, 1_500_000, 5_000_000]),
+])
+def test_histogram_words(hits, edges):
+    words, t, adc = hits
+    h = digibase.ListModeHistogrammer(edges)
+    for chunk in np.array_split(words, 13): h.add_words(chunk)
+    assert np.array_equal(h.spectra, reference_spectra(t, adc, edges))
+    # The clock ran to the last hit: slices beyond it have no realtime
+    covered = np.clip(edges, 0, t[-1])
+    assert np.allclose(h.realtime, np.diff(covered) * 1e-6)
+
+@pytest.mark.parametrize('version', [0, 2])
+def test_histogram_reader(tmp_path, hits, version):
+    words, t, adc = hits
+    filename = tmp_path / 'run.dblm'
+    if version == 0:
+        write_v0(filename, words)
+    else:
+        with digibase.ListModeWriter(filename, block_hits=7_000) as f: f.write(words)
+    edges = np.arange(250_000, 1_750_001, 250_000)
+    h = digibase.ListModeHistogrammer(edges)
+    h.add_reader(digibase.ListModeReader(filename), chunk_words=10_000)
+    assert np.array_equal(h.spectra, reference_spectra(t, adc, edges))
+    assert np.allclose(h.realtime, 0.25)
+
+def test_histogram_v2_realtime(tmp_path, hits):
+    "The clock of a v2 file ran for its header realtime, not its livetime"
+    words, t, adc = hits
+    filename = tmp_path / 'run.dblm'
+    with digibase.ListModeWriter(filename) as f:
+        f.write(words)
+        f.livetime, f.realtime = 1.0, 2.5
+    h = digibase.ListModeHistogrammer(np.arange(0, 3_000_001, 500_000))
+    h.add_reader(digibase.ListModeReader(filename))
+    assert t[-1] < 2_000_000
+    assert np.allclose(h.realtime, [0.5] * 5 + [0.0])
+
+def test_analyze_list_mode(tmp_path, hits):
+    # A slow run whose 31-bit epoch wraps (after 2147 s) in a raw word file, and a v2 file
+    slow = make_words(20_000, rate=5.0, seed=3)
+    write_v0(tmp_path / 'a.dblm', slow[0])
+    with digibase.ListModeWriter(tmp_path / 'b.dblm', block_hits=7_000) as f: f.write(hits[0])
+    result = digibase.analyze_list_mode(tmp_path / '*.dblm', width=0.5, rois=[(100, 200)],
+                                        jobs=2, chunk_words=3_000)
+    assert slow[1][-1] > 1 << 31
+    assert result['hits'].tolist() == [20_000, 200_000]
+    for i, (words, t, adc) in enumerate((slow, hits)):
+        spectra = result['spectra'][result['file_index'] == i]
+        assert len(spectra) == t[-1] // 500_000 + 1
+        edges = np.arange(len(spectra) + 1) * 500_000
+        assert np.array_equal(spectra, reference_spectra(t, adc, edges))
+    assert np.array_equal(result['roi_counts'][:, 0], result['spectra'][:, 100:200].sum(axis=1))
+    assert np.allclose(result['realtime'][:-1][result['file_index'][:-1] == 1], 0.5)
+
+def test_v2_times_from_base(tmp_path, hits):
+    "The header livetime and realtime come from the base at close"
+    words, t, adc = hits
+    clock = [0.0]
+    emu = digibase.digiBaseEmulator(rate=100.0, configured=True, clock=lambda: clock[0])
+    base = digibase.digiBase(transport=emu)
+    base.set_acq_mode_list()
+    base.start()
+    with digibase.ListModeWriter(tmp_path / 'run.dblm', base=base) as f:
+        f.write(words)
+        clock[0] += 2.5
+    reader = digibase.ListModeReader(tmp_path / 'run.dblm')
+    assert reader.livetime == pytest.approx(2.5) and reader.realtime == pytest.approx(2.5)
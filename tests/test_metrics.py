@@ -0,0 +1,45 @@
+# Tests of the performance metrics registry - no hardware needed
+
+from urllib.request import urlopen
+import numpy as np
+import digibase
+
+def test_metrics(clock):
+    reports = []
+    metrics = digibase.Metrics(callback=reports.append, interval=0.0)
+    emu = digibase.digiBaseEmulator(serial='77', rate=1e4, configured=True, clock=clock, seed=2)
+    base = digibase.digiBase(transport=emu, metrics=metrics)
+    assert metrics.serial == '77'
+    base.spectrum_array()
+    base.set_acq_mode_list()
+    stream = base.list_mode_stream(status_interval=0.0)
+    stream.start()
+    clock.t += 2.5
+    for block in stream.blocks(timeout=0.05):
+        if len(block) == 0: stream.stop()
+    snap = metrics.snapshot()
+    counters = snap['counters']
+    assert snap['commands']['spectrum']['count'] == 1
+    assert snap['commands']['status_read']['count'] >= 1
+    assert snap['commands']['hits']['count'] >= 2
+    assert counters['list_words'] == stream.words
+    assert 0 < counters['hits'] < counters['list_words']
+    assert counters['empty_polls'] >= 1
+    assert counters['bytes_read'] >= 4096 + 4 * stream.words
+    assert 0 < snap['gauges']['list_buffer_occupancy_max'] <= 1.0
+    assert reports and 'rates' in reports[-1]
+
+    server = metrics.serve(0)
+    try:
+        text = urlopen(f'http://127.0.0.1:{server.server_port}/metrics').read().decode()
+    finally:
+        server.shutdown()
+    assert f'digibase_list_words_total{{serial="77"}} {stream.words}' in text
+    assert 'digibase_command_seconds_count{serial="77",command="spectrum"} 1' in text
+    assert 'digibase_command_seconds_bucket{serial="77",command="spectrum",le="+Inf"} 1' in text
+
+def test_no_metrics():
+    emu = digibase.digiBaseEmulator(configured=True)
+    base = digibase.digiBase(transport=emu)
+    assert base.metrics is None
+    assert len(base.spectrum_array()) == 1024
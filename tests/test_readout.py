@@ -0,0 +1,294 @@
+# Tests of the readout paths against a fake pyusb device - no hardware needed
+
+import sys, gc, threading
+from array import array
+from time import sleep
+import pytest
+import numpy as np
+import usb.core, usb.util
+import digibase
+
+class FakeDevice:
+    "Stand-in for a configured digiBase behind pyusb; responses are kept per thread"
+    idVendor = 0x0a2d
+    idProduct = 0x000f
+    iSerialNumber = 3
+    serial_number = '1234'
+    bus = address = 1
+
+    def __init__(self):
+        self.status = bytearray(80)
+        self.spectrum = np.arange(1024, dtype=np.uint32) * 3
+        self.words = np.zeros(0, dtype=np.uint32)   # List buffer
+        self.words_at_stop = np.zeros(0, dtype=np.uint32)
+        self.commands = []
+        self.empty_read_time = 0.002
+        self._lock = threading.Lock()
+        self._responses = {}
+
+    def reset(self): pass
+    def set_configuration(self): pass
+    def get_active_configuration(self): return object()
+
+    def write(self, endpoint, data, timeout=None):
+        data = bytes(data)
+        with self._lock:
+            self.commands.append(data[:1])
+            op = data[0] if len(data) > 0 else None
+            resp = b''
+            if op == 0x00:
+                was_busy = self.status[1] & 1
+                self.status[:] = data[1:81]
+                # Busy (bit 8) follows start (bit 1); the last hits arrive at stop
+                start = (self.status[0] >> 1) & 1
+                self.status[1] = (self.status[1] & 0xfe) | start
+                if was_busy and not start:
+                    self.words = np.concatenate((self.words, self.words_at_stop))
+                    self.words_at_stop = self.words_at_stop[:0]
+                resp = b'\x00'
+            elif op == 0x01:
+                resp = bytes(self.status)
+            elif op == 0x06:
+                resp = b'\x01'
+            elif op == 0x80:
+                if self.status[0] & 1:
+                    resp = self.spectrum.tobytes()
+                else:
+                    resp = self.words[:1024].tobytes()
+                    self.words = self.words[1024:]
+            self._responses.setdefault(threading.get_ident(), []).append(resp)
+        return len(data)
+
+    def read(self, endpoint, size_or_buffer, timeout=None):
+        with self._lock:
+            resp = self._responses[threading.get_ident()].pop(0)
+        # An empty endpoint answers after a while
+        if len(resp) == 0: sleep(self.empty_read_time)
+        if isinstance(size_or_buffer, int): return array('B', resp[:size_or_buffer])
+        memoryview(size_or_buffer).cast('B')[:len(resp)] = resp
+        return len(resp)
+
+@pytest.fixture
+def dev(monkeypatch):
+    dev = FakeDevice()
+    monkeypatch.setattr(usb.core, 'find', lambda find_all=False, **kw: [dev] if find_all else dev)
+    monkeypatch.setattr(usb.util, 'get_string', lambda d, i: d.serial_number)
+    monkeypatch.setattr(usb.util, 'release_interface', lambda d, i: None)
+    monkeypatch.setattr(usb.util, 'dispose_resources', lambda d: None)
+    yield dev
+    # Close the bases while pyusb is still patched
+    gc.collect()
+
+def test_spectrum_array(dev):
+    base = digibase.digiBase()
+    base.set_acq_mode_pha()
+    s = base.spectrum_array()
+    assert s.dtype == np.uint32 and np.array_equal(s, dev.spectrum)
+    assert s.tolist() == list(base.spectrum)
+    # Views of the one readout buffer
+    assert np.shares_memory(s, base.spectrum_array())
+
+def test_hits_array(dev):
+    base = digibase.digiBase()
+    base.set_acq_mode_list()
+    dev.words = np.arange(1500, dtype=np.uint32)
+    first = base.hits_array().copy()
+    second = base.hits_array()
+    assert len(first) == 1024
+    assert np.array_equal(np.concatenate((first, second)), np.arange(1500))
+    assert len(base.hits_array()) == 0
+
+def run_stream(stream, consume, seconds=10.0):
+    "Consume the stream in a thread; fail rather than hang if it deadlocks"
+    blocks = []
+    t = threading.Thread(target=lambda: consume(stream, blocks), daemon=True)
+    t.start()
+    t.join(seconds)
+    assert not t.is_alive(), "Stream consumer deadlocked"
+    return np.concatenate(blocks) if blocks else np.zeros(0, dtype=np.uint32)
+
+def test_list_mode_stream_drain(dev):
+    "Words the device still holds when stopped are all read out"
+    base = digibase.digiBase()
+    base.set_acq_mode_list()
+    dev.words = np.arange(50_000, dtype=np.uint32)
+    dev.words_at_stop = np.arange(50_000, 60_000, dtype=np.uint32)
+    def consume(stream, blocks):
+        for block in stream.blocks(timeout=0.01):
+            blocks.append(block)
+            if sum(len(b) for b in blocks) >= 50_000: stream.stop()
+    stream = digibase.ListModeStream(base, capacity=1 << 16, block_size=4096)
+    stream.start()
+    words = run_stream(stream, consume)
+    assert np.array_equal(words, np.arange(60_000))
+    assert stream.words == 60_000 and stream.dropped == 0 and stream.error is None
+    assert stream.max_read == 1024 and not stream.overflow
+
+def test_list_mode_stream_stop_race(dev):
+    "A stop landing between an empty read and the check of the stop flag loses nothing"
+    base = digibase.digiBase()
+    base.set_acq_mode_list()
+    dev.empty_read_time = 0.0
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        for i in range(200):
+            dev.words_at_stop = np.arange(1000, dtype=np.uint32)
+            stream = digibase.ListModeStream(base, capacity=4096)
+            stream.start()
+            sleep(0.002)
+            stream.stop()
+            assert stream.words == 1000
+    finally:
+        sys.setswitchinterval(interval)
+
+def test_list_mode_stream_stop_when_idle(dev):
+    "stop() from the consumer on an idle block"
+    base = digibase.digiBase()
+    base.set_acq_mode_list()
+    def consume(stream, blocks):
+        for block in stream.blocks(timeout=0.01):
+            blocks.append(block)
+            if len(block) == 0: stream.stop()
+    stream = digibase.ListModeStream(base)
+    stream.start()
+    assert len(run_stream(stream, consume)) == 0
+
+def test_list_mode_stream_device_stopped(dev):
+    "The reader notices the device stopping on its own and flags the overflow"
+    base = digibase.digiBase()
+    base.set_acq_mode_list()
+    dev.words = np.arange(3000, dtype=np.uint32)
+    stream = digibase.ListModeStream(base, status_interval=0.01)
+    stream.start()
+    dev.status[1] &= 0xfe
+    words = run_stream(stream, lambda stream, blocks: blocks.extend(stream))
+    assert np.array_equal(words, np.arange(3000)) and stream.overflow
+
+def test_configure(dev):
+    "Setters in a configure() block make one status register write"
+    base = digibase.digiBase()
+    dev.commands.clear()
+    with base.configure(verify=True):
+        base.lld = 24
+        base.hv = 800
+        base.ext_gate = digibase.ExtGateMode.ENABLED
+        # Getters see the pending values without a device read
+        assert base.lld == 24
+    assert dev.commands == [b'\x01', b'\x00', b'\x01']
+    base.refresh()
+    assert base.lld == 24 and base.ext_gate == digibase.ExtGateMode.ENABLED
+    # A failing block discards its changes
+    with pytest.raises(ZeroDivisionError):
+        with base.configure():
+            base.lld = 50
+            1 / 0
+    assert base.lld == 24
+    assert digibase.bit_register(int.from_bytes(dev.status, 'little'))[170:180] == 24
+
+def test_max_age(dev):
+    "Getters reuse a status register copy younger than max_age"
+    base = digibase.digiBase(max_age=0.5)
+    dev.commands.clear()
+    for i in range(10): base.lld, base.hv
+    assert dev.commands.count(b'\x01') == 0
+    sleep(0.6)
+    base.lld
+    assert dev.commands.count(b'\x01') == 1
+    base = digibase.digiBase()
+    dev.commands.clear()
+    for i in range(10): base.lld
+    assert dev.commands.count(b'\x01') == 10
+
+def test_list_mode_stream_keeps_settings(dev):
+    "The reader's status checks do not undo settings changed meanwhile"
+    base = digibase.digiBase()
+    base.set_acq_mode_list()
+    dev.empty_read_time = 0.0
+    stream = digibase.ListModeStream(base, status_interval=0.0)
+    stream.start()
+    device = lambda: digibase.bit_register(int.from_bytes(dev.status, 'little'))
+    try:
+        for i in range(300):
+            base.lld = i % 100
+            base.hv = 800 + i % 2
+            assert device()[170:180] == i % 100
+    finally:
+        stream.stop()
+
+def test_apply_settings(dev):
+    "Presets and mode go out with the other settings in one write"
+    base = digibase.digiBase()
+    device = lambda: digibase.bit_register(int.from_bytes(dev.status, 'little'))
+    base.apply_settings(presets=dict(livetime=True, realtime=True))
+    assert device()[2] == 1 and device()[3] == 1
+    dev.commands.clear()
+    base.apply_settings(verify=True, lld=30, mode='pha', presets=dict(realtime=True))
+    assert dev.commands == [b'\x01', b'\x00', b'\x01']
+    st = device()
+    assert st[0] == 1 and st[2] == 0 and st[3] == 1 and st[170:180] == 30
+    # List mode needs its reset pulse ahead of the settings write
+    dev.commands.clear()
+    base.apply_settings(verify=True, lld=40, mode='list')
+    assert dev.commands == [b'\x01', b'\x00', b'\x00', b'\x00', b'\x01']
+    assert device()[0] == 0 and device()[170:180] == 40
+
+def test_hits_burst_lock(dev):
+    "Other threads' commands get through while the consumer holds a burst"
+    base = digibase.digiBase()
+    base.set_acq_mode_list()
+    dev.words = np.arange(20_000, dtype=np.uint32)
+    burst = base.hits_burst(depth=2)
+    words = [next(burst).copy()]
+    t = threading.Thread(target=base.refresh, daemon=True)
+    t.start()
+    t.join(2.0)
+    assert not t.is_alive()
+    words.extend(w.copy() for w in burst)
+    assert np.array_equal(np.concatenate(words), np.arange(20_000))
+
+def test_status_watcher_keeps_settings(dev):
+    "The watcher's status reads do not undo settings changed meanwhile"
+    base = digibase.digiBase()
+    dev.empty_read_time = 0.0
+    device = lambda: digibase.bit_register(int.from_bytes(dev.status, 'little'))
+    with digibase.StatusWatcher(base, interval=0) as watcher:
+        for i in range(1000):
+            base.lld = i % 100
+            base.hv = 800 + i % 2
+            assert device()[170:180] == i % 100
+    assert watcher.reads > 0 and watcher.error is None
+
+def test_hits_burst_error(dev, monkeypatch):
+    "A failing read ends the burst with its own exception, not the drain's"
+    base = digibase.digiBase()
+    base.set_acq_mode_list()
+    dev.words = np.arange(20_000, dtype=np.uint32)
+    read, calls = dev.read, []
+    def failing(endpoint, size_or_buffer, timeout=None):
+        read(endpoint, size_or_buffer, timeout)
+        calls.append(endpoint)
+        raise usb.core.USBTimeoutError('First' if len(calls) == 1 else 'Drain')
+    monkeypatch.setattr(dev, 'read', failing)
+    with pytest.raises(usb.core.USBTimeoutError, match='First'):
+        list(base.hits_burst(depth=4))
+
+def test_configure_threads(dev):
+    "Other threads neither join a configure() block nor see its pending values"
+    base = digibase.digiBase()
+    base.lld = 10
+    seen = []
+    def other():
+        seen.append(base.lld)
+        base.hv = 900
+    with base.configure():
+        base.lld = 30
+        t = threading.Thread(target=other, daemon=True)
+        t.start()
+        t.join(0.2)
+        assert t.is_alive() and not seen
+        assert dev.commands[-1] != b'\x00'
+    t.join(2.0)
+    assert seen == [30]
+    st = digibase.bit_register(int.from_bytes(dev.status, 'little'))
+    assert st[170:180] == 30 and st[336:352] == 900 * 4 // 5
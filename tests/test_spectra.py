@@ -0,0 +1,93 @@
+# Tests of the spectrum file readers and writers - no hardware needed
+
+import os, sys, subprocess
+import numpy as np
+import digibase
+
+def test_archive(tmp_path):
+    filename = tmp_path / 'captures.dbsa'
+    rng = np.random.default_rng(1)
+    spectra = rng.poisson(50, (30, 1024))
+    with digibase.SpectrumArchiveWriter(filename, comment='test run') as archive:
+        for i in range(20):
+            archive.append(spectra[i], livetime=i + 0.5, realtime=i + 1.0, time=1000.0 + i,
+                           serial=4886, hv=800, disc=24, gain=0.5)
+    # Torn record at the end from a crash
+    with open(filename, 'ab') as f: f.write(b'\x01' * 100)
+    assert len(digibase.SpectrumArchiveReader(filename)) == 20
+    with digibase.SpectrumArchiveWriter(filename) as archive:
+        for i in range(20, 30):
+            archive.append(spectra[i], livetime=i + 0.5, realtime=i + 1.0, time=1000.0 + i,
+                           skew=0.002)
+
+    archive = digibase.SpectrumArchiveReader(filename)
+    assert archive.comment == 'test run'
+    assert len(archive) == 30
+    assert np.array_equal(archive.counts, spectra)
+    assert np.array_equal(archive.livetime, np.arange(30) + 0.5)
+    assert archive.hv[0] == 800 and archive.serial[19] == 4886 and archive.hv[20] == 0
+    assert archive.skew[0] == 0.0 and np.allclose(archive.skew[20:], 0.002)
+    part = archive.slice(1005.0, 1010.0)
+    assert np.array_equal(part['counts'], spectra[5:10])
+
+def test_read_spectra(tmp_path):
+    rng = np.random.default_rng(2)
+    spectra = rng.poisson(20, (40, 1024))
+    for i in range(40):
+        filename = tmp_path / f'bkg-{i:03d}.dat'
+        if i % 4 == 0:
+            # Version 0 file
+            with open(filename, 'wb') as f:
+                f.write(b'DBKG\x00\x00\x00\x00' + np.array([100.0 + i, 2.5]).tobytes())
+                f.write(b'old'.ljust(64, b'\x00') + spectra[i].astype('i').tobytes())
+        elif i % 4 == 3:
+            # Version 2 file, with the skew of a continuous mode slice
+            digibase.write_background(filename, spectra[i], 2.5, f'#{i}', serial=4886,
+                                      hv=800, disc=24, gain=0.5, skew=0.001 * i)
+        else:
+            digibase.write_background(filename, spectra[i], 2.5, f'#{i}', serial=4886,
+                                      hv=800, disc=24, gain=0.5)
+    counts, meta = digibase.read_spectra(str(tmp_path / 'bkg-*.dat'))
+    assert np.array_equal(counts, spectra)
+    assert np.all(meta['exposure'] == 2.5)
+    assert meta['version'].tolist() == [[0, 1, 1, 2][i % 4] for i in range(40)]
+    assert meta['time'][4] == 104.0 and meta['comment'][5] == b'#5'
+    assert meta['hv'][1] == 800 and meta['hv'][0] == 0 and meta['hv'][3] == 800
+    assert meta['skew'][3] == 0.003 and meta['skew'][2] == 0.0
+    for i in (0, 1, 3):
+        s, t, exp, extra = digibase.read_background(tmp_path / f'bkg-{i:03d}.dat')
+        assert np.array_equal(s, counts[i]) and exp == meta['exposure'][i]
+    assert extra[1] == 4886 and extra[6] == 0.003
+
+def test_import_without_usb(tmp_path):
+    # The file readers need neither pyusb nor the CLI and asyncio machinery
+    code = f'''
+import sys
+sys.modules['usb'] = None
+import numpy as np, digibase
+digibase.write_background({str(tmp_path / 'bkg.dat')!r}, np.arange(1024), 1.0, 'no usb', 1)
+assert digibase.read_background({str(tmp_path / 'bkg.dat')!r})[0][5] == 5
+for name in ('usb.core', 'argparse', 'asyncio', 'http.server'):
+    assert name not in sys.modules, name
+'''
+    subprocess.run([sys.executable, '-c', code], check=True,
+                   cwd=os.path.join(os.path.dirname(__file__), '..'))
+
+def test_analyze_spectra(tmp_path):
+    rng = np.random.default_rng(3)
+    spectra = rng.poisson(20, (50, 1024))
+    for i in range(30):
+        digibase.write_background(tmp_path / f'bkg-{i:03d}.dat', spectra[i], 2.0, f'#{i}', 1)
+    with digibase.SpectrumArchiveWriter(tmp_path / 'run.dbsa') as archive:
+        for i in range(30, 50):
+            archive.append(spectra[i], livetime=1.0, realtime=1.0, time=2000.0 + i)
+    paths = sorted(tmp_path.glob('bkg-*.dat'))[:15] + [tmp_path / 'run.dbsa'] + \
+        sorted(tmp_path.glob('bkg-*.dat'))[15:]
+    result = digibase.analyze_spectra(paths, rois=[(10, 20), (500, 600)], jobs=2, chunk=7)
+    order = list(range(15)) + list(range(30, 50)) + list(range(15, 30))
+    assert np.array_equal(result['spectrum'], spectra.sum(axis=0))
+    assert result['exposure'] == 30 * 2.0 + 20 * 1.0
+    assert np.array_equal(result['counts'], spectra[order].sum(axis=1))
+    assert np.array_equal(result['roi_counts'][:, 1], spectra[order, 500:600].sum(axis=1))
+    assert result['file_index'].tolist() == list(range(15)) + [15] * 20 + list(range(16, 31))
+    assert result['time'][15] == 2030.0
@@ -0,0 +1,168 @@
+# Tests of USB traffic recording and replay - no hardware needed
+
+import gzip, threading
+from struct import pack
+import pytest
+import numpy as np
+import digibase
+
+def session(base, clock=None):
+    "Some device traffic; returns what was read"
+    with base.configure():
+        base.hv = 800
+        base.lld = 10
+    base.set_acq_mode_list()
+    base.start()
+    if clock is not None: clock.t += 0.5
+    words = [w.copy() for w in base.hits_burst(depth=3)]
+    base.stop()
+    base.set_acq_mode_pha()
+    base.start()
+    if clock is not None: clock.t += 0.5
+    spectrum = base.spectrum_array().copy()
+    return np.concatenate(words), spectrum, base.status_snapshot(refresh=True)
+
+@pytest.mark.parametrize('rh', [False, True])
+def test_record_replay(tmp_path, clock, rh):
+    trace = tmp_path / 'session.dbtr'
+    emu = digibase.digiBaseEmulator(rh=rh, serial='4886', rate=1e4, configured=True,
+                                    clock=clock, seed=7)
+    rec = digibase.RecordingTransport(emu, trace)
+    base = digibase.digiBase(transport=rec)
+    recorded = session(base, clock)
+    with pytest.raises(TimeoutError):
+        rec.read(0x82, 80)     # Nothing was asked for
+    rec.close()
+
+    replay = digibase.ReplayTransport(trace, speed=None)
+    assert replay.serial == '4886'
+    base = digibase.digiBase(transport=replay)
+    assert base.isRH == rh
+    replayed = session(base)
+    assert np.array_equal(replayed[0], recorded[0]) and len(recorded[0]) > 1000
+    assert np.array_equal(replayed[1], recorded[1])
+    assert replayed[2] == recorded[2]
+    with pytest.raises(TimeoutError):
+        replay.read(0x82, 80)
+    with pytest.raises(EOFError):
+        base.spectrum_array()
+
+def test_replay_diverged(tmp_path):
+    trace = tmp_path / 'session.dbtr'
+    rec = digibase.RecordingTransport(digibase.digiBaseEmulator(configured=True), trace)
+    base = digibase.digiBase(transport=rec)
+    base.hv = 800
+    rec.close()
+    base = digibase.digiBase(transport=digibase.ReplayTransport(trace))
+    with pytest.raises(ValueError):
+        base.hv = 900
+
+def test_replay_truncated(tmp_path):
+    "A trace whose recording was not closed replays up to its last complete record"
+    trace = tmp_path / 'session.dbtr'
+    rec = digibase.RecordingTransport(digibase.digiBaseEmulator(configured=True), trace)
+    base = digibase.digiBase(transport=rec)
+    for i in range(2000): base.lld = i % 1000
+    rec.close()
+    events = digibase.ReplayTransport(trace).events
+    data = trace.read_bytes()
+    trace.write_bytes(data[:len(data) // 2])
+    replay = digibase.ReplayTransport(trace)
+    assert 0 < len(replay.events) < len(events)
+    assert replay.events == events[:len(replay.events)]
+
+POLL, STATUS = b'\x80', b'\x01'
+
+def status_write(lld=0, start=False):
+    reg = digibase.bit_register(0)
+    reg[1] = int(start)
+    reg[170:180] = lld
+    return b'\x00' + reg.reg.to_bytes(80, 'little')
+
+def write_trace(filename, exchanges):
+    "A trace of (command, response) exchanges on endpoints 0x02 / 0x82"
+    records = [(digibase.TRACE_OPEN, 0, 0, b'')]
+    for cmd, resp in exchanges:
+        records += [(digibase.TRACE_WRITE, 0x02, len(cmd), cmd),
+                    (digibase.TRACE_READ, 0x82, 132_000, resp)]
+    with gzip.open(filename, 'wb') as f:
+        f.write(pack(digibase.DBTR_HEADER, b'DBTR', 1, 0x000f, 4) + b'4886')
+        for i, (kind, endpoint, count, payload) in enumerate(records):
+            f.write(pack(digibase.DBTR_RECORD, kind, endpoint, count, i * 1e-3, 1e-4, len(payload)))
+            f.write(payload)
+
+def exchange(replay, cmd):
+    replay.write(0x02, cmd)
+    return bytes(replay.read(0x82, 132_000))
+
+@pytest.fixture
+def status():
+    "A status register response, not acquiring"
+    return bytes(2) + bytes(range(2, 80))
+
+def test_replay_skips_queries(tmp_path, status):
+    "Rule 1: empty polls and status reads before the next call are dropped"
+    write_trace(tmp_path / 't.dbtr', [(STATUS, status), (POLL, b''), (status_write(10), b'\x00')])
+    replay = digibase.ReplayTransport(tmp_path / 't.dbtr', speed=None)
+    replay.open()
+    assert exchange(replay, status_write(10)) == b'\x00'
+    assert replay.skipped_queries == 2 and replay._status == status
+    # A poll that returned data is not dropped
+    write_trace(tmp_path / 't.dbtr', [(POLL, b'\x01\x00\x00\x00'), (STATUS, status)])
+    replay = digibase.ReplayTransport(tmp_path / 't.dbtr', speed=None)
+    replay.open()
+    assert exchange(replay, STATUS) == status and exchange(replay, POLL) == b'\x01\x00\x00\x00'
+    assert replay.skipped_queries == 0 and replay.reordered == 1
+
+def test_replay_reorders_commands(tmp_path):
+    "Rule 2: a command with a response is taken from behind queries, not other commands"
+    words = np.arange(10, dtype='<u4').tobytes()
+    write_trace(tmp_path / 't.dbtr', [(POLL, words), (status_write(10), b'\x00')])
+    replay = digibase.ReplayTransport(tmp_path / 't.dbtr', speed=None)
+    replay.open()
+    assert exchange(replay, status_write(10)) == b'\x00'
+    assert exchange(replay, POLL) == words
+    assert replay.reordered == 1
+    write_trace(tmp_path / 't.dbtr', [(status_write(5), b'\x00'), (status_write(10), b'\x00')])
+    replay = digibase.ReplayTransport(tmp_path / 't.dbtr', speed=None)
+    replay.open()
+    with pytest.raises(ValueError):
+        exchange(replay, status_write(10))
+
+def test_replay_answers_extra_queries(tmp_path, status):
+    "Rule 3: queries not in the trace get an empty poll or the last status"
+    write_trace(tmp_path / 't.dbtr', [(STATUS, status), (status_write(start=True), b'\x00'),
+                                      (status_write(), b'\x00')])
+    replay = digibase.ReplayTransport(tmp_path / 't.dbtr', speed=None)
+    replay.open()
+    assert exchange(replay, STATUS) == status
+    assert exchange(replay, STATUS) == status
+    assert exchange(replay, POLL) == b''
+    exchange(replay, status_write(start=True))
+    st = digibase.bit_register(int.from_bytes(exchange(replay, STATUS), 'little'))
+    assert st[1] == 1 and st[8] == 1
+    assert replay.extra_queries == 3
+    exchange(replay, status_write())
+    # Past the end of the trace
+    with pytest.raises(EOFError):
+        exchange(replay, POLL)
+    # No status to answer with before one was recorded
+    write_trace(tmp_path / 't.dbtr', [(POLL, b''), (status_write(), b'\x00')])
+    replay = digibase.ReplayTransport(tmp_path / 't.dbtr', speed=None)
+    replay.open()
+    with pytest.raises(ValueError):
+        exchange(replay, STATUS)
+
+def test_replay_threads(tmp_path, status):
+    "Queries from two threads get their responses in the order they were written"
+    write_trace(tmp_path / 't.dbtr', [(STATUS, status)] * 2000)
+    replay = digibase.ReplayTransport(tmp_path / 't.dbtr', speed=None)
+    replay.open()
+    bad = []
+    def run():
+        for i in range(1000):
+            if exchange(replay, STATUS) != status: bad.append(i)
+    threads = [threading.Thread(target=run) for i in range(2)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    assert not bad and replay.position == 4001